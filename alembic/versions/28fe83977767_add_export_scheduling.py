@@ -0,0 +1,28 @@
+"""Add export scheduling
+
+Revision ID: 28fe83977767
+Revises: e730bd308471
+Create Date: 2026-10-18 10:47:05.913264
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '28fe83977767'
+down_revision = 'e730bd308471'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('export', sa.Column('start_date', sa.DateTime))
+    op.add_column('export', sa.Column('fingerprint', sa.String))
+    # Pending exports (without a start date) are queued for the scheduler
+    op.create_index('ix_export_fingerprint', 'export', ['fingerprint'])
+
+
+def downgrade():
+    op.drop_index('ix_export_fingerprint', 'export')
+    op.drop_column('export', 'fingerprint')
+    op.drop_column('export', 'start_date')
@@ -0,0 +1,34 @@
+"""Add export file format
+
+Revision ID: e730bd308471
+Revises: fa6460f5386f
+Create Date: 2026-10-18 10:12:31.482915
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e730bd308471'
+down_revision = 'fa6460f5386f'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    file_format = sa.Enum('csv', 'sqlite', name='export_file_format')
+    file_format.create(op.get_bind(), checkfirst=True)
+
+    # Existing exports were all generated as CSV files
+    op.add_column(
+        'export',
+        sa.Column(
+            'file_format',
+            file_format,
+            nullable=False,
+            server_default='csv'))
+
+
+def downgrade():
+    op.drop_column('export', 'file_format')
+    sa.Enum(name='export_file_format').drop(op.get_bind(), checkfirst=True)
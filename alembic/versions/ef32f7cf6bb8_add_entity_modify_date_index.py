@@ -0,0 +1,23 @@
+"""Add entity modify date index
+
+Revision ID: ef32f7cf6bb8
+Revises: 28fe83977767
+Create Date: 2026-10-18 14:12:31.402187
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'ef32f7cf6bb8'
+down_revision = '28fe83977767'
+branch_labels = None
+
+from alembic import op
+
+
+def upgrade():
+    # Delta exports look up entities modified since the last export
+    op.create_index('ix_entity_modify_date', 'entity', ['modify_date'])
+
+
+def downgrade():
+    op.drop_index('ix_entity_modify_date', 'entity')
@@ -5,33 +5,54 @@ This module does the actual heavy-lifting wereas the others just
 offer an interface (gui or cli, etc)
 """
 
+import codecs
+from contextlib import contextmanager
+import hashlib
 import inspect
+import io
+import json
+import os
+import uuid
 
 import csv
 from collections import OrderedDict
+from itertools import islice
 
+from dateutil.parser import parse as parse_date
 from pyramid.config import aslist
 from pyramid.path import DottedNameResolver
+import sqlalchemy as sa
 
 from .. import log
-from . import codebook
+from . import codebook, sqlite
 
 from .pid import PidPlan
 from .enrollment import EnrollmentPlan
 from .visit import VisitPlan
-from .schema import SchemaPlan
+from .schema import SchemaPlan, invalidate_catalog
 
 
 plans = [PidPlan, EnrollmentPlan, VisitPlan, SchemaPlan.list_all]
 
 
-def list_all(dbsession, include_rand=True, include_private=True):
+# Default number of rows fetched from the database at a time
+FETCH_SIZE = 10000
+
+# Describes the contents of an export so that the next one can be a delta
+MANIFEST_FILE_NAME = 'manifest.json'
+
+# Lists rows that were deleted since a previous export
+TOMBSTONES_FILE_NAME = 'tombstones.csv'
+
+
+def list_all(dbsession, include_rand=True, include_private=True, redis=None):
     """
     Lists all available data files
 
     Arguments:
     ids -- (Optional) Only list schemata with specific ids
     include_rand -- (Optional) Include randomization data files
+    redis -- (Optional) redis connection used to cache the schemata catalog
 
     Returns:
     An ordered dictionary (name, plan) items.
@@ -45,7 +66,8 @@ def list_all(dbsession, include_rand=True, include_private=True):
                 exportables = plan(
                     dbsession,
                     include_rand=include_rand,
-                    include_private=include_private
+                    include_private=include_private,
+                    redis=redis
                 )
 
                 for exportable in exportables:
@@ -58,23 +80,467 @@ def list_all(dbsession, include_rand=True, include_private=True):
     return all
 
 
-def write_data(buffer, query):
+def write_data(buffer,
+               query,
+               fetch_size=FETCH_SIZE,
+               use_copy=False,
+               progress=None):
     """
     Dumps a query to a CSV file using the specified buffer
-    Each record in the query is accessed as a `namedtuple`.
 
-    See `namedtuple`.
+    Rows are streamed from a server-side cursor in batches of ``fetch_size``
+    and written as plain tuples so that memory use does not grow with the
+    size of the table.
 
     Arguments:
     buffer -- a file object which will be used to write data contents
     query -- SQLAlchemy query that will be writen to a CSV file.
              Note that the column names will be used as the header.
+    fetch_size -- (Optional) number of rows to fetch at a time
+    use_copy -- (Optional) let PostgreSQL generate the CSV contents with
+                ``COPY``, if the query is running on PostgreSQL.
+                Only use this for queries whose values need no
+                further processing in Python. Booleans, empty strings and
+                line endings are rendered as they are by the Python writer,
+                other values use PostgreSQL's text output, which matches
+                Python's for integers, numerics, strings and dates (but
+                not necessarily for floats or fractional seconds).
+    progress -- (Optional) callback that is passed the number of rows
+                written since the last call, as they are written
+
+    Returns:
+    The number of rows written
     """
+    if use_copy and _is_copyable(query):
+        count = _copy_data(buffer, query, progress)
+        buffer.flush()
+        return count
+
+    fetch_size = fetch_size or FETCH_SIZE
     fieldnames = [d['name'] for d in query.column_descriptions]
-    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(r._asdict() for r in query)
+    writer = csv.writer(buffer)
+    writer.writerow(fieldnames)
+
+    rows = iter(query.yield_per(fetch_size))
+    count = 0
+
+    while True:
+        batch = list(islice(rows, fetch_size))
+        if not batch:
+            break
+        writer.writerows(batch)
+        count += len(batch)
+        if progress is not None:
+            progress(len(batch))
+
     buffer.flush()
+    return count
+
+
+def _is_copyable(query):
+    """
+    Checks if the query's connection supports ``COPY ... TO STDOUT``
+    """
+    dialect = query.session.get_bind().dialect
+    return dialect.name == 'postgresql' and dialect.driver == 'psycopg2'
+
+
+def _copy_data(buffer, query, progress=None):
+    """
+    Dumps a query to a CSV file using PostgreSQL's ``COPY`` command
+
+    The query is run on the session's current connection so that it sees
+    the same transaction (and snapshot) as the rest of the export.
+
+    Returns the number of rows copied.
+    """
+    connection = query.session.connection()
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY ({}) TO STDOUT WITH (FORMAT CSV, HEADER, ENCODING \'UTF8\')'
+            .format(_render_statement(
+                connection, cursor, _copy_statement(query))),
+            _CopyWriter(buffer, progress))
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def _copy_statement(query):
+    """
+    Adapts a query's columns so that ``COPY`` renders them as `csv.writer`
+
+    ``COPY`` renders booleans as ``t``/``f`` and quotes empty strings
+    (to distinguish them from NULL), whereas the Python writer renders
+    ``True``/``False`` and leaves both empty.
+    """
+    statement = query.statement
+    types = [d['type'] for d in query.column_descriptions]
+
+    if not any(_is_adapted(t) for t in types):
+        return statement
+
+    # Selecting every row of an ordered subquery keeps its order
+    subquery = statement.alias('copied')
+    adapted = []
+
+    for column in subquery.columns:
+        if isinstance(column.type, sa.Boolean):
+            column = sa.case([
+                (column.is_(sa.true()), sa.literal('True')),
+                (column.is_(sa.false()), sa.literal('False')),
+            ]).label(column.name)
+        elif _is_adapted(column.type):
+            column = sa.func.nullif(column, '', type_=column.type) \
+                .label(column.name)
+        adapted.append(column)
+
+    return sa.select(adapted)
+
+
+def _is_adapted(type_):
+    """
+    Helper method to check if a column type is adapted for ``COPY``
+    """
+    return isinstance(type_, sa.Boolean) or (
+        # Enumerations can't be compared to an empty string
+        isinstance(type_, sa.String) and not isinstance(type_, sa.Enum))
+
+
+def _render_statement(connection, cursor, statement):
+    """
+    Renders a statement as a literal SQL string for the connection's cursor
+
+    Parameters are processed by their types for the connection's dialect
+    and then interpolated by the DBAPI cursor.
+    """
+    dialect = connection.dialect
+    compiled = statement.compile(dialect=dialect)
+    params = {}
+
+    for key, value in compiled.params.items():
+        processor = (
+            compiled.binds[key].type
+            .dialect_impl(dialect)
+            .bind_processor(dialect))
+        params[key] = value if processor is None else processor(value)
+
+    if params:
+        return cursor.mogrify(str(compiled), params).decode('utf-8')
+    else:
+        # Nothing to interpolate, but still need to unescape the
+        # paramstyle's percent signs
+        return str(compiled).replace('%%', '%')
+
+
+class _CopyWriter(object):
+    """
+    Decodes the raw ``COPY`` output into a text buffer
+
+    ``COPY`` terminates rows with ``\\n``, so line breaks outside of quoted
+    values are translated to ``\\r\\n`` as written by `csv.writer`.
+    """
+
+    def __init__(self, buffer, progress=None):
+        self.buffer = buffer
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.progress = progress
+        self.header = True
+        # Whether the previous chunk ended inside of a quoted value
+        self.quoted = False
+
+    def write(self, data):
+        if self.progress is not None:
+            # Approximate, since quoted values may contain line breaks
+            lines = data.count(b'\n')
+            if self.header and lines:
+                lines -= 1
+                self.header = False
+            self.progress(lines)
+
+        # Escaped quotes ("") toggle the state twice, so only the parity
+        # of the quotes seen so far matters
+        segments = data.split(b'"')
+        outside = 1 if self.quoted else 0
+        for i in range(outside, len(segments), 2):
+            segments[i] = segments[i].replace(b'\n', b'\r\n')
+        self.quoted ^= bool((len(segments) - 1) % 2)
+
+        return self.buffer.write(self.decoder.decode(b'"'.join(segments)))
+
+
+def estimate_rows(query):
+    """
+    Estimates the number of rows a query will return
+
+    Uses the query planner's statistics, so the query is not actually run.
+
+    Arguments:
+    query -- SQLAlchemy query to estimate
+
+    Returns:
+    The estimated number of rows, or None if it cannot be estimated
+    """
+    if not _is_copyable(query):
+        return None
+
+    connection = query.session.connection()
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute('EXPLAIN (FORMAT JSON) {}'.format(
+            _render_statement(connection, cursor, query.statement)))
+        (explained,) = cursor.fetchone()
+        return int(explained[0]['Plan']['Plan Rows'])
+    finally:
+        cursor.close()
+
+
+@contextmanager
+def open_member(zfp, name):
+    """
+    Opens a text file that writes directly into a zip archive member
+
+    Arguments:
+    zfp -- a ``ZipFile`` opened for writing
+    name -- the name of the member in the archive
+    """
+    with zfp.open(name, mode='w', force_zip64=True) as member:
+        with io.TextIOWrapper(member, encoding='utf-8', newline='') as fp:
+            yield fp
+
+
+def get_watermark(dbsession):
+    """
+    Determines the point in time up to which an export is complete
+
+    Rows written by transactions that are still in progress may carry a
+    modification date earlier than the time of the export, so the watermark
+    is pulled back to the start of the oldest open transaction. Subsequent
+    delta exports starting at this watermark may therefore repeat some rows,
+    which consumers should merge by id.
+
+    Arguments:
+    dbsession -- the database session the export will run in
+
+    Returns:
+    The timestamp to use as the ``since`` of the next delta export
+    """
+    activity = sa.table(
+        'pg_stat_activity',
+        sa.column('datname'),
+        sa.column('xact_start'))
+    query = (
+        dbsession.query(
+            sa.cast(
+                sa.func.least(
+                    sa.func.now(),
+                    sa.func.min(activity.c.xact_start)),
+                sa.DateTime))
+        .filter(activity.c.datname == sa.func.current_database()))
+    return query.scalar()
+
+
+def write_tombstones(buffer, plans, since):
+    """
+    Dumps the rows deleted from each data file since a point in time
+
+    Arguments:
+    buffer -- a file object which will be used to write data contents
+    plans -- the export plans whose deletions should be listed
+    since -- only list rows deleted on or after this timestamp
+    """
+    writer = csv.writer(buffer)
+    writer.writerow(['file', 'id', 'delete_date'])
+
+    for plan in plans:
+        for id, delete_date in plan.deleted(since):
+            writer.writerow([plan.file_name, id, delete_date.isoformat()])
+
+    buffer.flush()
+
+
+def write_manifest(buffer, since, watermark, file_names):
+    """
+    Dumps the description of an export as JSON
+
+    Arguments:
+    buffer -- a file object which will be used to write data contents
+    since -- the timestamp the export is a delta from, if any
+    watermark -- the timestamp the next delta export should start from
+    file_names -- the data files included in the export
+    """
+    json.dump({
+        'since': since.isoformat() if since else None,
+        'watermark': watermark.isoformat() if watermark else None,
+        'files': sorted(file_names),
+        'tombstones': TOMBSTONES_FILE_NAME if since else None,
+    }, buffer, indent=2)
+    buffer.flush()
+
+
+def read_watermark(path):
+    """
+    Reads the watermark of a previous export's manifest
+
+    Arguments:
+    path -- path to a manifest file
+
+    Returns:
+    The timestamp from which to start a delta export
+    """
+    with open(path) as fp:
+        manifest = json.load(fp)
+
+    return parse_date(manifest['watermark'])
+
+
+def iter_codebook(dbsession, plans):
+    """
+    Generates the codebook rows of several data files
+
+    Codebooks of schema plans are generated in bulk (see
+    `SchemaPlan.bulk_codebook`), all others are generated individually.
+
+    Arguments:
+    dbsession -- the database session
+    plans -- the export plans to generate codebooks for
+
+    Returns:
+    An iterator of codebook rows, in the order of the plans
+    """
+    plans = list(plans)
+    schema_plans = [p for p in plans if isinstance(p, SchemaPlan)]
+    bulk = SchemaPlan.bulk_codebook(dbsession, schema_plans)
+    bulk_rows = OrderedDict((p.name, []) for p in schema_plans)
+
+    for row in bulk:
+        bulk_rows[row['table']].append(row)
+
+    for plan in plans:
+        if isinstance(plan, SchemaPlan):
+            rows = bulk_rows[plan.name]
+        else:
+            rows = plan.codebook()
+        for row in rows:
+            yield row
+
+
+def codebook_fingerprint(plans):
+    """
+    Generates a digest of everything the codebook of the plans depends on
+
+    Schema plans are identified by their catalog entry (i.e. their published
+    versions), all others by their codebook rows.
+
+    Arguments:
+    plans -- the export plans the codebook is generated for
+
+    Returns:
+    A hex digest string
+    """
+    state = []
+
+    for plan in plans:
+        if isinstance(plan, SchemaPlan):
+            state.append(plan.to_json())
+        else:
+            state.append(list(plan.codebook()))
+
+    encoded = json.dumps(state, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def get_codebook(dbsession, export_dir, plans):
+    """
+    Looks up the prebuilt codebook of the plans, building it if necessary
+
+    The codebook is stored in the export directory as both a CSV file
+    (for downloads and exports) and a JSON file of rows by table
+    (for the codebook viewer), keyed by `codebook_fingerprint`.
+
+    Arguments:
+    dbsession -- the database session
+    export_dir -- the directory to store the codebook in
+    plans -- the export plans to generate the codebook for
+
+    Returns:
+    A tuple of the codebook fingerprint and the path to the CSV file
+    """
+    plans = list(plans)
+    fingerprint = codebook_fingerprint(plans)
+    path = _codebook_path(export_dir, fingerprint, 'csv')
+
+    if not os.path.exists(path):
+        rows = list(iter_codebook(dbsession, plans))
+
+        tables = OrderedDict((p.name, []) for p in plans)
+        for row in rows:
+            tables[row['table']].append(row)
+
+        # The CSV file is published last, so that if it exists,
+        # the JSON file does too
+        with _open_atomic(
+                _codebook_path(export_dir, fingerprint, 'json')) as fp:
+            json.dump(tables, fp, default=lambda v: v.isoformat())
+
+        with _open_atomic(path) as fp:
+            write_codebook(fp, rows)
+
+    return fingerprint, path
+
+
+def read_codebook(export_dir, fingerprint):
+    """
+    Reads the rows of a prebuilt codebook
+
+    The most recently read codebook is kept in memory, since it will only
+    change once a schema is published or retracted.
+
+    Arguments:
+    export_dir -- the directory the codebook is stored in
+    fingerprint -- the fingerprint returned by `get_codebook`
+
+    Returns:
+    A dictionary of codebook rows by table
+    """
+    cached = _codebook_cache.get(fingerprint)
+
+    if cached is None:
+        path = _codebook_path(export_dir, fingerprint, 'json')
+        with open(path) as fp:
+            cached = json.load(fp, object_pairs_hook=OrderedDict)
+        _codebook_cache.clear()
+        _codebook_cache[fingerprint] = cached
+
+    return cached
+
+
+_codebook_cache = {}
+
+
+def _codebook_path(export_dir, fingerprint, ext):
+    """
+    Helper method to locate a prebuilt codebook file
+    """
+    file_name = codebook.ARTIFACT_FILE_NAME.format(
+        fingerprint=fingerprint, ext=ext)
+    return os.path.join(export_dir, file_name)
+
+
+@contextmanager
+def _open_atomic(path):
+    """
+    Opens a file for writing that only appears at the path once complete
+    """
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4())
+    try:
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as fp:
+            yield fp
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def write_codebook(buffer, rows):
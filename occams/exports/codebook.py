@@ -24,6 +24,9 @@ HEADER = [
 # File name for the generated codebook
 FILE_NAME = 'codebook.csv'
 
+# File name for prebuilt codebooks, by catalog fingerprint and format
+ARTIFACT_FILE_NAME = 'codebook-{fingerprint}.{ext}'
+
 
 class types:
     """
@@ -19,6 +19,8 @@ class EnrollmentPlan(ExportPlan):
 
     title = _(u'Enrollments')
 
+    is_copyable = True
+
     def codebook(self):
 
         return iter([
@@ -51,7 +53,8 @@ class EnrollmentPlan(ExportPlan):
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             since=None):
         session = self.dbsession
         CreateUser = aliased(models.User)
         ModifyUser = aliased(models.User)
@@ -81,4 +84,17 @@ class EnrollmentPlan(ExportPlan):
             .order_by(models.Enrollment.id,
                       models.Study.title,
                       models.Patient.pid))
+
+        if since is not None:
+            query = query.filter(models.Enrollment.modify_date >= since)
+
         return query
+
+    def fingerprint(self, **options):
+        return self._fingerprint(
+            options,
+            models.Enrollment,
+            related=(models.Patient, models.Site, models.Study, models.User))
+
+    def deleted(self, since):
+        return self._query_deleted(u'enrollment', since)
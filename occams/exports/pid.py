@@ -31,6 +31,8 @@ class PidPlan(ExportPlan):
 
     title = _(u'Patient Identifiers')
 
+    is_copyable = True
+
     @reify
     def reftypes(self):
         return list(
@@ -65,7 +67,8 @@ class PidPlan(ExportPlan):
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             since=None):
         session = self.dbsession
         query = (
             session.query(
@@ -117,4 +120,18 @@ class PidPlan(ExportPlan):
                 ModifyUser.key.label('modify_user'))
             .order_by(models.Patient.id))
 
+        if since is not None:
+            query = query.filter(models.Patient.modify_date >= since)
+
         return query
+
+    def fingerprint(self, **options):
+        return self._fingerprint(
+            options,
+            models.Patient,
+            related=(
+                models.Site, models.Enrollment, models.Study,
+                models.PatientReference, models.ReferenceType, models.User))
+
+    def deleted(self, since):
+        return self._query_deleted(u'patient', since)
@@ -1,3 +1,22 @@
+import hashlib
+import json
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+# Audit trail maintained by the pg-audit-json extension,
+# used to find records that have been deleted since a previous export
+audit_log = sa.Table(
+    'log',
+    sa.MetaData(),
+    sa.Column('table_name', sa.String),
+    sa.Column('action', sa.String),
+    sa.Column('action_tstamp_stm', sa.DateTime(timezone=True)),
+    sa.Column('row_data', JSONB),
+    schema='audit')
+
+
 class ExportPlan(object):
     """
     An export plan
@@ -12,6 +31,8 @@ class ExportPlan(object):
 
     is_enabled = True       # Flag to disable org-spcific-hard-coded forms
 
+    is_copyable = False     # Data can be dumped directly by the database
+
     versions = []           # All versions avaialble
 
     def __init__(self, dbsession=None):
@@ -33,7 +54,8 @@ class ExportPlan(object):
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             since=None):
         """
         Generate export data
 
@@ -45,12 +67,113 @@ class ExportPlan(object):
                               default: False
         ignore_private -- (Optional) De-identity private information
                           default: True
+        since -- (Optional) Only include records created or modified at or
+                 after this date (i.e. a delta since a previous export)
+                 default: None
 
         Returns:
         An iterator of row data
         """
         raise NotImplemented  # pragma: nocover
 
+    def deleted(self, since):
+        """
+        Generate the records that have been deleted since a previous export
+
+        Parameters:
+        since -- Only include records deleted at or after this date
+
+        Returns:
+        An iterator of (id, delete_date) rows
+        """
+        raise NotImplemented  # pragma: nocover
+
+    def _query_deleted(self, table_name, since):
+        """
+        Helper method to query deleted records from the audit trail
+        """
+        return (
+            self.dbsession.query(
+                audit_log.c.row_data['id'].astext.cast(sa.Integer)
+                .label('id'),
+                audit_log.c.action_tstamp_stm.label('delete_date'))
+            .filter(audit_log.c.table_name == table_name)
+            .filter(audit_log.c.action == 'D')
+            .filter(audit_log.c.action_tstamp_stm >= since)
+            .order_by(audit_log.c.action_tstamp_stm))
+
+    def fingerprint(self,
+                    use_choice_labels=False,
+                    expand_collections=False,
+                    ignore_private=True):
+        """
+        Generate a digest of the current state of the data file
+
+        Data files generated with the same fingerprint are interchangeable,
+        so a previously generated file can be reused instead of querying the
+        database again.
+
+        Parameters:
+        (see `data`)
+
+        Returns:
+        A hex digest string, or None if the data file cannot be fingerprinted
+        """
+        return None
+
+    def _fingerprint(self, options, model, *criteria, related=(), **state):
+        """
+        Helper method to fingerprint a data file based on its source table
+
+        Covers the row count and the latest id and modification date of the
+        table, the row count and latest modification date of the tables
+        joined into the data file, the columns of the data file, and the
+        export options.
+
+        Parameters:
+        options -- the export options passed to `data`
+        model -- the mapped class the data file rows are generated from
+        criteria -- (Optional) filters of the rows in the data file
+        related -- (Optional) mapped classes of the tables joined into the
+                   data file (e.g. for the patient's site), so that edits to
+                   them also change the fingerprint
+        state -- (Optional) additional values that affect the data file
+        """
+        query = self.dbsession.query(
+            sa.func.count(model.id),
+            sa.func.max(model.id),
+            sa.func.max(model.modify_date))
+
+        for criterion in criteria:
+            query = query.filter(criterion)
+
+        count, max_id, max_modify_date = query.one()
+
+        related_state = {}
+        for related_model in related:
+            related_count, related_modify_date = (
+                self.dbsession.query(
+                    sa.func.count(related_model.id),
+                    sa.func.max(related_model.modify_date))
+                .one())
+            related_state[related_model.__tablename__] = \
+                [related_count, related_modify_date]
+
+        columns = [d['name'] for d in self.data(**options).column_descriptions]
+
+        state.update({
+            'name': self.name,
+            'columns': columns,
+            'options': options,
+            'count': count,
+            'max_id': max_id,
+            'max_modify_date': max_modify_date,
+            'related': related_state,
+        })
+
+        encoded = json.dumps(state, sort_keys=True, default=str)
+        return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
     def to_json(self):
         """
         Serialize to JSON
@@ -8,12 +8,16 @@ Also incorporates:
 
 """
 
+from collections import defaultdict
 from datetime import datetime
-from sqlalchemy import orm, null, cast, String, literal_column
+import json
+from types import SimpleNamespace
+from sqlalchemy import orm, null, cast, Integer, String, literal_column
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg
 
 
 from .. import models
-from .plan import ExportPlan
+from .plan import ExportPlan, audit_log
 from .codebook import types, row
 from ..reporting import build_report
 from ..utils.sql import group_concat, to_date
@@ -23,6 +27,8 @@ class SchemaPlan(ExportPlan):
 
     is_system = False
 
+    is_copyable = True
+
     @classmethod
     def from_sql(cls, dbsession, record):
         """
@@ -47,22 +53,27 @@ class SchemaPlan(ExportPlan):
         return cls.from_sql(dbsession, query.one())
 
     @classmethod
-    def list_all(cls, dbsession, include_rand=True, include_private=True):
+    def list_all(cls,
+                 dbsession,
+                 include_rand=True,
+                 include_private=True,
+                 redis=None):
         """
         Lists all the schema plans
+
+        If a redis connection is specified, the catalog of schemata is
+        shared across processes until it is invalidated (see
+        `invalidate_catalog`) or expires.
         """
-        subquery = _list_schemata_info(dbsession).subquery()
-        query = dbsession.query(subquery)
+        records = _get_catalog(dbsession, redis)
 
         if not include_rand:
-            query = query.filter(~subquery.c.has_rand)
+            records = [r for r in records if not r.has_rand]
 
         if not include_private:
-            query = query.filter(~subquery.c.has_private)
-
-        query = query.order_by(subquery.c.title)
+            records = [r for r in records if not r.has_private]
 
-        return [cls.from_sql(dbsession, r) for r in query]
+        return [cls.from_sql(dbsession, r) for r in records]
 
     @property
     def _is_aeh_partner_form(self):
@@ -75,7 +86,70 @@ class SchemaPlan(ExportPlan):
                 'IPartnerDisclosure'))
 
     def codebook(self):
-        session = self.dbsession
+        query = (
+            self.dbsession.query(models.Attribute)
+            .join(models.Schema)
+            .filter(models.Schema.name == self.name)
+            .filter(models.Schema.publish_date.in_(self.versions))
+            .filter(models.Schema.retract_date == null()))
+
+        query = (
+            query.order_by(
+                models.Attribute.name,
+                models.Schema.publish_date))
+
+        return self._codebook(query)
+
+    @classmethod
+    def bulk_codebook(cls, dbsession, plans):
+        """
+        Generates the codebooks of several schema plans at once
+
+        All published attributes (and their choices) are fetched in two
+        queries instead of two queries per plan plus a lazy load of choices
+        per attribute.
+
+        Parameters:
+        dbsession -- the database session
+        plans -- the schema plans to generate codebooks for
+
+        Returns:
+        An iterator of codebook rows in the order of the plans
+        """
+        plans = list(plans)
+
+        if not plans:
+            return
+
+        query = (
+            dbsession.query(models.Attribute)
+            .join(models.Schema)
+            .options(
+                orm.contains_eager(models.Attribute.schema),
+                orm.selectinload(models.Attribute.choices))
+            .filter(models.Schema.name.in_([p.name for p in plans]))
+            .filter(models.Schema.publish_date != null())
+            .filter(models.Schema.retract_date == null())
+            .order_by(
+                models.Schema.name,
+                models.Attribute.name,
+                models.Schema.publish_date))
+
+        attributes = defaultdict(list)
+        for attribute in query:
+            attributes[attribute.schema.name].append(attribute)
+
+        for plan in plans:
+            versions = set(plan.versions)
+            for row in plan._codebook(
+                    a for a in attributes[plan.name]
+                    if a.schema.publish_date in versions):
+                yield row
+
+    def _codebook(self, attributes):
+        """
+        Helper method to generate the codebook rows from the attributes
+        """
         knowns = [
             row('id', self.name, types.NUMBER, decimal_places=0,
                 is_required=True, is_system=True),
@@ -125,19 +199,7 @@ class SchemaPlan(ExportPlan):
         for column in knowns:
             yield column
 
-        query = (
-            session.query(models.Attribute)
-            .join(models.Schema)
-            .filter(models.Schema.name == self.name)
-            .filter(models.Schema.publish_date.in_(self.versions))
-            .filter(models.Schema.retract_date == null()))
-
-        query = (
-            query.order_by(
-                models.Attribute.name,
-                models.Schema.publish_date))
-
-        for attribute in query:
+        for attribute in attributes:
             yield row(attribute.name, attribute.schema.name, attribute.type,
                       decimal_places=attribute.decimal_places,
                       form=attribute.schema.title,
@@ -164,15 +226,23 @@ class SchemaPlan(ExportPlan):
         for column in footer:
             yield column
 
+    def _version_ids(self):
+        """
+        Helper method to list the ids of the exported versions
+        """
+        ids_query = (
+            self.dbsession.query(models.Schema.id)
+            .filter(models.Schema.name == self.name)
+            .filter(models.Schema.publish_date.in_(self.versions)))
+        return [id for id, in ids_query]
+
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             since=None):
         session = self.dbsession
-        ids_query = (
-            session.query(models.Schema.id)
-            .filter(models.Schema.publish_date.in_(self.versions)))
-        ids = [id for id, in ids_query]
+        ids = self._version_ids()
 
         report = build_report(
             session,
@@ -182,213 +252,234 @@ class SchemaPlan(ExportPlan):
             use_choice_labels=use_choice_labels,
             ignore_private=ignore_private)
 
-        query = (
-            session.query(report.c.id.label('id'))
-            .add_columns(
-                session.query(models.Patient.pid)
-                .join(models.Context,
-                      (models.Context.external == u'patient')
-                      & (models.Context.key == models.Patient.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .correlate(report)
-                .as_scalar()
-                .label('pid'))
-            .add_columns(
-                session.query(models.Site.name)
-                .select_from(models.Patient)
-                .join(models.Site)
-                .join(models.Context,
-                      (models.Context.external == u'patient')
-                      & (models.Context.key == models.Patient.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .correlate(report)
-                .as_scalar()
-                .label('site'))
+        # Each context is aggregated once per exported entity and then joined
+        # to the report, rather than looked up with a subquery for every row.
+
+        def contexts(external):
+            """
+            Helper to query the contexts of the exported entities
+            """
+            query = (
+                session.query(models.Context.entity_id.label('entity_id'))
+                .join(models.Entity, models.Context.entity)
+                .filter(models.Entity.schema_id.in_(ids))
+                .filter(models.Context.external == external))
+            if since is not None:
+                query = query.filter(models.Entity.modify_date >= since)
+            return query
+
+        patient = (
+            contexts(u'patient')
+            .join(models.Patient, models.Context.key == models.Patient.id)
+            .join(models.Site, models.Patient.site)
             .add_columns(
-                session.query(group_concat(models.Study.name, ';'))
-                .select_from(models.Enrollment)
-                .join(models.Study)
-                .join(models.Context,
-                      (models.Context.external == u'enrollment')
-                      & (models.Context.key == models.Enrollment.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .group_by(models.Context.entity_id)
-                .correlate(report)
-                .as_scalar()
-                .label('enrollment'))
+                models.Patient.pid.label('pid'),
+                models.Site.name.label('site'))
+            .subquery())
+
+        enrollment = (
+            contexts(u'enrollment')
+            .join(models.Enrollment,
+                  models.Context.key == models.Enrollment.id)
+            .join(models.Study, models.Enrollment.study)
             .add_columns(
-                session.query(group_concat(models.Enrollment.id, ';'))
-                .select_from(models.Enrollment)
-                .join(models.Context,
-                      (models.Context.external == u'enrollment')
-                      & (models.Context.key == models.Enrollment.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .group_by(models.Context.entity_id)
-                .correlate(report)
-                .as_scalar()
+                group_concat(models.Study.name, ';').label('enrollment'),
+                group_concat(models.Enrollment.id, ';')
                 .label('enrollment_ids'))
-            )
+            .group_by(models.Context.entity_id)
+            .subquery())
+
+        query = (
+            session.query(report.c.id.label('id'))
+            .outerjoin(patient, patient.c.entity_id == report.c.id)
+            .outerjoin(enrollment, enrollment.c.entity_id == report.c.id)
+            .add_columns(
+                patient.c.pid.label('pid'),
+                patient.c.site.label('site'),
+                enrollment.c.enrollment.label('enrollment'),
+                enrollment.c.enrollment_ids.label('enrollment_ids')))
 
         if self._is_aeh_partner_form:
             PartnerPatient = orm.aliased(models.Patient)
+            partner = (
+                contexts(u'partner')
+                .join(models.Partner,
+                      models.Context.key == models.Partner.id)
+                .outerjoin(PartnerPatient, models.Partner.enrolled_patient)
+                .add_columns(
+                    models.Partner.id.label('partner_id'),
+                    PartnerPatient.pid.label('partner_pid'))
+                .subquery())
             query = (
                 query
+                .outerjoin(partner, partner.c.entity_id == report.c.id)
                 .add_columns(
-                    session.query(models.Partner.id)
-                    .select_from(models.Partner)
-                    .join(models.Context,
-                          (models.Context.external == u'partner')
-                          & (models.Context.key == models.Partner.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('partner_id'))
-                .add_columns(
-                    session.query(PartnerPatient.pid)
-                    .select_from(models.Partner)
-                    .join(PartnerPatient, models.Partner.enrolled_patient)
-                    .join(models.Context,
-                          (models.Context.external == u'partner')
-                          & (models.Context.key == models.Partner.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('partner_pid')))
+                    partner.c.partner_id.label('partner_id'),
+                    partner.c.partner_pid.label('partner_pid')))
 
         if self.has_rand:
+            stratum = (
+                contexts(u'stratum')
+                .join(models.Stratum,
+                      models.Context.key == models.Stratum.id)
+                .join(models.Arm, models.Stratum.arm)
+                .add_columns(
+                    models.Stratum.block_number.label('block_number'),
+                    models.Stratum.randid.label('randid'),
+                    models.Arm.title.label('arm_name'))
+                .subquery())
             query = (
                 query
+                .outerjoin(stratum, stratum.c.entity_id == report.c.id)
                 .add_columns(
-                    session.query(models.Stratum.block_number)
-                    .select_from(models.Stratum)
-                    .join(models.Context,
-                          (models.Context.external == u'stratum')
-                          & (models.Context.key == models.Stratum.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('block_number'))
-                .add_columns(
-                    session.query(models.Stratum.randid)
-                    .select_from(models.Stratum)
-                    .join(models.Context,
-                          (models.Context.external == u'stratum')
-                          & (models.Context.key == models.Stratum.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('randid'))
-                .add_columns(
-                    session.query(models.Arm.title)
-                    .select_from(models.Stratum)
-                    .join(models.Context,
-                          (models.Context.external == u'stratum')
-                          & (models.Context.key == models.Stratum.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .join(models.Stratum.arm)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('arm_name')))
-
-        query = (
-            query
+                    stratum.c.block_number.label('block_number'),
+                    stratum.c.randid.label('randid'),
+                    stratum.c.arm_name.label('arm_name')))
+
+        visit_cycles = (
+            contexts(u'visit')
+            .join(models.Visit, models.Context.key == models.Visit.id)
+            .join(models.Visit.cycles)
+            .join(models.Cycle.study)
             .add_columns(
-                session.query(group_concat(models.Study.title
-                                           + literal_column(u"'('")
-                                           + cast(models.Cycle.week, String)
-                                           + literal_column(u"')'"),
-                                           literal_column(u"';'")))
-                .select_from(models.Visit)
-                .join(models.Visit.cycles)
-                .join(models.Cycle.study)
-                .join(models.Context,
-                      (models.Context.external == u'visit')
-                      & (models.Context.key == models.Visit.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .group_by(models.Context.entity_id)
-                .correlate(report)
-                .as_scalar()
+                group_concat(models.Study.title
+                             + literal_column(u"'('")
+                             + cast(models.Cycle.week, String)
+                             + literal_column(u"')'"),
+                             literal_column(u"';'"))
                 .label('visit_cycles'))
+            .group_by(models.Context.entity_id)
+            .subquery())
+
+        visit = (
+            contexts(u'visit')
+            .join(models.Visit, models.Context.key == models.Visit.id)
             .add_columns(
-                session.query(models.Visit.id)
-                .select_from(models.Visit)
-                .join(models.Context,
-                      (models.Context.external == u'visit')
-                      & (models.Context.key == models.Visit.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .correlate(report)
-                .as_scalar()
-                .label('visit_id'))
+                models.Visit.id.label('visit_id'),
+                models.Visit.visit_date.label('visit_date'))
+            .subquery())
+
+        query = (
+            query
+            .outerjoin(visit_cycles, visit_cycles.c.entity_id == report.c.id)
+            .outerjoin(visit, visit.c.entity_id == report.c.id)
             .add_columns(
-                session.query(models.Visit.visit_date)
-                .select_from(models.Visit)
-                .join(models.Context,
-                      (models.Context.external == u'visit')
-                      & (models.Context.key == models.Visit.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .correlate(report)
-                .as_scalar()
-                .label('visit_date'))
-        )
+                visit_cycles.c.visit_cycles.label('visit_cycles'),
+                visit.c.visit_id.label('visit_id'),
+                visit.c.visit_date.label('visit_date')))
 
         query = query.add_columns(
             *[c for c in report.columns if c.name != 'id'])
 
+        if since is not None:
+            query = query.filter(report.c.modify_date >= since)
+
+        query = query.order_by(report.c.id)
+
         return query
 
+    def fingerprint(self, **options):
+        ids = self._version_ids()
+        return self._fingerprint(
+            options,
+            models.Entity,
+            models.Entity.schema_id.in_(ids),
+            related=(
+                models.Context, models.Patient, models.Site,
+                models.Enrollment, models.Study, models.Visit, models.Cycle,
+                models.Arm, models.Stratum),
+            versions=sorted(ids))
+
+    def deleted(self, since):
+        return (
+            self._query_deleted(u'entity', since)
+            .filter(
+                audit_log.c.row_data['schema_id'].astext.cast(Integer)
+                .in_(self._version_ids())))
+
+
+# Redis key of the cached catalog of exportable schemata
+CATALOG_KEY = 'exports:catalog'
+
+# Number of seconds the catalog is cached if never invalidated
+CATALOG_EXPIRE = 3600
+
+
+def invalidate_catalog(redis):
+    """
+    Discards the cached catalog of exportable schemata
+
+    Should be called once changes to the catalog (e.g. a schema is published
+    or retracted, or randomization data is uploaded) are committed.
+
+    Parameters:
+    redis -- the redis connection the catalog is cached in
+    """
+    if redis is not None:
+        redis.delete(CATALOG_KEY)
+
+
+def _get_catalog(dbsession, redis=None):
+    """
+    Helper method to fetch the catalog of schemata, ordered by title
+    """
+    if redis is not None:
+        cached = redis.get(CATALOG_KEY)
+        if cached is not None:
+            return [SimpleNamespace(**r) for r in json.loads(cached)]
+
+    subquery = _list_schemata_info(dbsession).subquery()
+    query = dbsession.query(subquery).order_by(subquery.c.title)
+    records = [r._asdict() for r in query]
+
+    if redis is not None:
+        redis.set(CATALOG_KEY, json.dumps(records), ex=CATALOG_EXPIRE)
+
+    return [SimpleNamespace(**r) for r in records]
+
 
 def _list_schemata_info(dbsession):
-    InnerSchema = orm.aliased(models.Schema)
-    OuterSchema = orm.aliased(models.Schema)
+    """
+    Helper method to query the catalog of exportable schemata
+
+    Each flag is computed once for all schemata via grouped subqueries
+    rather than per schema name.
+    """
+    private_query = (
+        dbsession.query(models.Schema.name.label('name'))
+        .join(models.Attribute, models.Schema.attributes)
+        .filter(models.Attribute.is_private)
+        .distinct()
+        .subquery('private'))
+
+    rand_query = (
+        dbsession.query(models.Schema.name.label('name'))
+        .select_from(models.Stratum)
+        .join(models.Context,
+              (models.Context.external == 'stratum')
+              & (models.Context.key == models.Stratum.id))
+        .join(models.Entity, models.Context.entity)
+        .join(models.Schema, models.Entity.schema)
+        .distinct()
+        .subquery('rand'))
 
     schemata_query = (
-        dbsession.query(OuterSchema.name.label('name'))
-        .add_columns(literal_column("'schema'").label('type'))
-        .add_columns(
-            dbsession.query(models.Attribute)
-            .filter(models.Attribute.is_private)
-            .join(InnerSchema)
-            .filter(InnerSchema.name == OuterSchema.name)
-            .correlate(OuterSchema)
-            .exists()
-            .label('has_private'))
-        .add_columns(
-            dbsession.query(models.Entity)
-            .join(models.Entity.contexts)
-            .filter(models.Context.external == 'stratum')
-            .join(models.Stratum, models.Context.key == models.Stratum.id)
-            .join(InnerSchema, models.Entity.schema)
-            .filter(InnerSchema.name == OuterSchema.name)
-            .correlate(OuterSchema)
-            .exists()
-            .label('has_rand'))
-        .add_columns(
-            dbsession.query(InnerSchema.title)
-            .select_from(InnerSchema)
-            .filter(InnerSchema.name == OuterSchema.name)
-            .filter(InnerSchema.publish_date != null())
-            .filter(InnerSchema.retract_date == null())
-            .order_by(InnerSchema.publish_date.desc())
-            .limit(1)
-            .correlate(OuterSchema)
-            .as_scalar()
-            .label('title'))
-        .add_columns(
-            dbsession.query(
-                group_concat(to_date(InnerSchema.publish_date), ';'))
-            .filter(InnerSchema.name == OuterSchema.name)
-            .filter(InnerSchema.publish_date != null())
-            .filter(InnerSchema.retract_date == null())
-            .group_by(InnerSchema.name)
-            .correlate(OuterSchema)
-            .as_scalar()
+        dbsession.query(
+            models.Schema.name.label('name'),
+            literal_column("'schema'").label('type'),
+            (private_query.c.name != null()).label('has_private'),
+            (rand_query.c.name != null()).label('has_rand'),
+            array_agg(
+                aggregate_order_by(
+                    models.Schema.title,
+                    models.Schema.publish_date.desc()))[1].label('title'),
+            group_concat(to_date(models.Schema.publish_date), ';')
             .label('versions'))
-        .filter(OuterSchema.publish_date != null())
-        .filter(OuterSchema.retract_date == null()))
-
-    schemata_query = (
-        schemata_query
-        .group_by(OuterSchema.name)
+        .outerjoin(private_query, private_query.c.name == models.Schema.name)
+        .outerjoin(rand_query, rand_query.c.name == models.Schema.name)
+        .filter(models.Schema.publish_date != null())
+        .filter(models.Schema.retract_date == null())
+        .group_by(models.Schema.name, private_query.c.name, rand_query.c.name)
         .from_self())
 
     return schemata_query
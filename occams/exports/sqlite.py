@@ -0,0 +1,166 @@
+"""
+SQLite Export Utilities
+
+Writes data files as tables of a single SQLite database, so that they can
+be queried directly instead of re-parsing CSV files.
+"""
+
+from contextlib import contextmanager
+from datetime import date, datetime, time
+from decimal import Decimal
+from itertools import islice
+import json
+import sqlite3
+
+from . import codebook
+from .codebook import types
+
+
+# File name for the generated database
+FILE_NAME = 'export.sqlite'
+
+# Table name for the codebook
+CODEBOOK_TABLE = 'codebook'
+
+# Columns that are indexed if a data file has them
+INDEXED_COLUMNS = ['id', 'pid', 'visit_id']
+
+
+@contextmanager
+def open_database(path):
+    """
+    Opens a new SQLite database for writing data files into
+
+    The database is only meant to be written once, so journaling is
+    disabled and all writes are committed at the end.
+
+    Arguments:
+    path -- the path of the database file to create
+    """
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        yield connection
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def write_table(connection, name, query, rows, fetch_size, progress=None):
+    """
+    Dumps a query into a new table of the database
+
+    Arguments:
+    connection -- an open database connection (See `open_database`)
+    name -- the name of the table
+    query -- SQLAlchemy query that will be written to the table.
+             Note that the column names will be used as the table columns.
+    rows -- Code book rows of the data file, used to type the columns.
+            Columns not in the codebook (e.g. expanded collections) are left
+            untyped.
+    fetch_size -- number of rows to fetch from the query and insert at a time
+    progress -- (Optional) callback that is passed the number of rows
+                written since the last call, as they are written
+
+    Returns:
+    The number of rows written
+    """
+    column_types = dict((r['field'], _column_type(r)) for r in rows)
+    fieldnames = [d['name'] for d in query.column_descriptions]
+
+    columns = ', '.join(
+        ' '.join(filter(None, [_quote(f), column_types.get(f)]))
+        for f in fieldnames)
+    connection.execute('CREATE TABLE {} ({})'.format(_quote(name), columns))
+
+    insert = 'INSERT INTO {} VALUES ({})'.format(
+        _quote(name), ', '.join('?' * len(fieldnames)))
+
+    records = iter(query.yield_per(fetch_size))
+    count = 0
+
+    while True:
+        batch = [[_adapt(v) for v in r] for r in islice(records, fetch_size)]
+        if not batch:
+            break
+        connection.executemany(insert, batch)
+        count += len(batch)
+        if progress is not None:
+            progress(len(batch))
+
+    # Indexing after the inserts is much cheaper than maintaining the index
+    for column in INDEXED_COLUMNS:
+        if column in fieldnames:
+            connection.execute('CREATE INDEX {} ON {} ({})'.format(
+                _quote('ix_{}_{}'.format(name, column)),
+                _quote(name),
+                _quote(column)))
+
+    return count
+
+
+def write_codebook(connection, rows):
+    """
+    Dumps the codebook into its own table of the database
+
+    Arguments:
+    connection -- an open database connection (See `open_database`)
+    rows -- Code book rows. Seee `occams.codebook`
+    """
+    connection.execute('CREATE TABLE {} ({})'.format(
+        _quote(CODEBOOK_TABLE),
+        ', '.join(_quote(f) for f in codebook.HEADER)))
+
+    insert = 'INSERT INTO {} VALUES ({})'.format(
+        _quote(CODEBOOK_TABLE), ', '.join('?' * len(codebook.HEADER)))
+
+    def choices2string(choices):
+        choices = choices or []
+        return ';'.join(['%s=%s' % c for c in choices])
+
+    connection.executemany(insert, (
+        [_adapt(choices2string(r['choices']) if f == 'choices' else r[f])
+         for f in codebook.HEADER]
+        for r in rows))
+
+    connection.execute('CREATE INDEX {} ON {} ({})'.format(
+        _quote('ix_{}_table'.format(CODEBOOK_TABLE)),
+        _quote(CODEBOOK_TABLE),
+        _quote('table')))
+
+
+def _column_type(row):
+    """
+    Helper method to determine the SQLite type of a codebook row
+    """
+    if row['is_collection']:
+        # Collections are delimited strings
+        return 'TEXT'
+    elif row['type'] == types.NUMBER:
+        return 'INTEGER' if row['decimal_places'] == 0 else 'NUMERIC'
+    elif row['type'] == types.BOOLEAN:
+        return 'INTEGER'
+    else:
+        # Dates are stored as ISO-8601 strings, which sort correctly
+        return 'TEXT'
+
+
+def _adapt(value):
+    """
+    Helper method to convert values to types supported by SQLite
+    """
+    if isinstance(value, Decimal):
+        return float(value)
+    elif isinstance(value, (date, datetime, time)):
+        return value.isoformat()
+    elif isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def _quote(identifier):
+    """
+    Helper method to quote a table or column name
+    """
+    return '"{}"'.format(identifier.replace('"', '""'))
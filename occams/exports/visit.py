@@ -17,6 +17,8 @@ class VisitPlan(ExportPlan):
 
     title = _(u'Visits')
 
+    is_copyable = True
+
     def codebook(self):
         return iter([
             row('id', self.name, types.NUMBER, decimal_places=0,
@@ -42,7 +44,8 @@ class VisitPlan(ExportPlan):
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             since=None):
         session = self.dbsession
         CreateUser = aliased(models.User)
         ModifyUser = aliased(models.User)
@@ -67,4 +70,19 @@ class VisitPlan(ExportPlan):
             .join(CreateUser, models.Visit.create_user)
             .join(ModifyUser, models.Visit.modify_user)
             .order_by(models.Visit.id))
+
+        if since is not None:
+            query = query.filter(models.Visit.modify_date >= since)
+
         return query
+
+    def fingerprint(self, **options):
+        return self._fingerprint(
+            options,
+            models.Visit,
+            related=(
+                models.Patient, models.Site, models.Cycle, models.Study,
+                models.User))
+
+    def deleted(self, since):
+        return self._query_deleted(u'visit', since)
@@ -67,6 +67,8 @@ from .storage import (  # noqa
     HasEntities,
 )
 
+from .snapshots import get_snapshot  # noqa
+
 # run configure_mappers after defining all of the models to ensure
 # all relationships can be setup
 configure_mappers()
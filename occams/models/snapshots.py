@@ -0,0 +1,234 @@
+"""
+Read-only snapshots of published schemata
+
+Published schemata do not change, so instead of walking their attributes
+and choices through the session (lazy loading and sorting them on every
+request), data entry works off of a plain in-memory copy that is loaded
+once per process.
+
+Snapshots mirror the parts of the `Schema`, `Attribute` and `Choice` API
+used by data entry, so either can be used interchangeably.
+"""
+
+from collections import OrderedDict
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from .schema import Schema, Attribute, Choice
+
+
+# Snapshots of published schemata by (id, publish date)
+_snapshots = {}
+
+# Attribute columns that are copied into snapshots
+ATTRIBUTE_COLUMNS = (
+    'id', 'name', 'title', 'description', 'type', 'order',
+    'is_collection', 'is_required', 'is_private', 'is_system',
+    'is_readonly', 'is_shuffled', 'widget', 'decimal_places',
+    'collection_min', 'collection_max', 'value_min', 'value_max',
+    'pattern', 'constraint_logic', 'skip_logic')
+
+
+def get_snapshot(schema):
+    """
+    Returns the read-only snapshot of a published schema
+
+    Snapshots are loaded the first time a published schema version is
+    requested and reused for the lifetime of the process.
+    Drafts can still change, so they are returned as-is.
+
+    Arguments:
+    schema -- the schema to snapshot
+
+    Returns:
+    A `SchemaSnapshot`, or the schema itself if it is not published
+    """
+    if schema.id is None or schema.publish_date is None:
+        return schema
+
+    key = (schema.id, schema.publish_date)
+    snapshot = _snapshots.get(key)
+
+    if snapshot is None:
+        snapshot = _snapshots[key] = SchemaSnapshot.load(schema)
+
+    return snapshot
+
+
+def invalidate_snapshots(*args, **kw):
+    """
+    Discards all snapshots
+
+    Called whenever schemata, attributes or choices are changed in this
+    process, published schemata are not otherwise expected to change.
+    """
+    _snapshots.clear()
+
+
+def listen_for_changes(handler):
+    """
+    Calls a handler whenever schemata, attributes or choices are changed
+    in this process
+
+    Must be called once mappers are configured.
+
+    Arguments:
+    handler -- an attribute event handler
+    """
+    sa.event.listen(Schema.attributes, 'append', handler)
+    sa.event.listen(Schema.attributes, 'remove', handler)
+    sa.event.listen(Attribute.choices, 'append', handler)
+    sa.event.listen(Attribute.choices, 'remove', handler)
+    sa.event.listen(Attribute.attributes, 'append', handler)
+    sa.event.listen(Attribute.attributes, 'remove', handler)
+    for column in ('title', 'description', 'retract_date'):
+        sa.event.listen(getattr(Schema, column), 'set', handler)
+    for column in ATTRIBUTE_COLUMNS:
+        sa.event.listen(getattr(Attribute, column), 'set', handler)
+    for column in ('name', 'title', 'description', 'order'):
+        sa.event.listen(getattr(Choice, column), 'set', handler)
+
+
+@sa.event.listens_for(orm.Mapper, 'after_configured', once=True)
+def _listen_for_changes():
+    listen_for_changes(invalidate_snapshots)
+
+
+class _Snapshot(object):
+    """
+    Base class for immutable snapshots
+    """
+
+    __slots__ = ('__weakref__',)
+
+    def __init__(self, **values):
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Snapshots are read-only')
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.name)
+
+
+class SchemaSnapshot(_Snapshot):
+    """
+    Snapshot of a published schema
+    """
+
+    __slots__ = (
+        'id', 'name', 'title', 'description', 'publish_date',
+        'retract_date', 'attributes', '_children', '_leafs')
+
+    @classmethod
+    def load(cls, schema):
+        """
+        Loads the snapshot of a schema with all attributes and choices
+        """
+        session = orm.object_session(schema)
+
+        if session is None:
+            records = sorted(schema.attributes.values(), key=lambda a: a.order)
+        else:
+            # Snapshots may be requested in the middle of changes to
+            # other objects (e.g. while populating an entity)
+            with session.no_autoflush:
+                records = (
+                    session.query(Attribute)
+                    .filter(Attribute.schema_id == schema.id)
+                    .options(orm.selectinload(Attribute.choices))
+                    .order_by(Attribute.order)
+                    .all())
+        children = dict((a.id, []) for a in records)
+        children[None] = []
+        for record in records:
+            children[record.parent_attribute_id].append(record)
+
+        def snapshot(record, parent):
+            attribute = AttributeSnapshot(
+                parent_attribute=parent,
+                choices=OrderedDict(
+                    (c.name, ChoiceSnapshot(
+                        id=c.id, name=c.name, title=c.title,
+                        description=c.description, order=c.order))
+                    for c in sorted(
+                        record.choices.values(), key=lambda c: c.order)),
+                **dict((k, getattr(record, k)) for k in ATTRIBUTE_COLUMNS))
+            object.__setattr__(attribute, '_children', tuple(
+                snapshot(r, attribute) for r in children[record.id]))
+            object.__setattr__(attribute, 'attributes', OrderedDict(
+                (a.name, a) for a in attribute._children))
+            return attribute
+
+        top = tuple(snapshot(r, None) for r in children[None])
+        everything = [a for t in top for a in t.iterlist()]
+
+        return cls(
+            id=schema.id,
+            name=schema.name,
+            title=schema.title,
+            description=schema.description,
+            publish_date=schema.publish_date,
+            retract_date=schema.retract_date,
+            attributes=OrderedDict((a.name, a) for a in everything),
+            _children=top,
+            _leafs=tuple(
+                a for a in sorted(everything, key=lambda a: a.order)
+                if a.type != 'section'))
+
+    def itertraverse(self):
+        """
+        Iterates through the top-level attributes in order
+        """
+        return iter(self._children)
+
+    def iterleafs(self):
+        """
+        Lists all attributes flattened without their sections
+        """
+        return iter(self._leafs)
+
+    def iterlist(self):
+        """
+        Flattens the schema into a sorted list of all children
+        """
+        return (a for t in self._children for a in t.iterlist())
+
+
+class AttributeSnapshot(_Snapshot):
+    """
+    Snapshot of an attribute of a published schema
+    """
+
+    __slots__ = ATTRIBUTE_COLUMNS + (
+        'parent_attribute', 'attributes', 'choices', '_children')
+
+    def itertraverse(self):
+        """
+        Iterates through the sub-attributes in order
+        """
+        return iter(self._children)
+
+    def iterlist(self):
+        """
+        Flattens the attribute into an sorted list with all children
+        """
+        yield self
+        for child in self._children:
+            yield from child.iterlist()
+
+    def iterchoices(self):
+        """
+        Iterates through the choices in order
+        """
+        return iter(self.choices.values())
+
+
+class ChoiceSnapshot(_Snapshot):
+    """
+    Snapshot of a choice of a published schema
+    """
+
+    __slots__ = ('id', 'name', 'title', 'description', 'order')
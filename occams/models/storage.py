@@ -3,19 +3,19 @@ Storage models
 """
 
 from datetime import date
-import re
 
 import sqlalchemy as sa
 from sqlalchemy import orm
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm.attributes import flag_modified, set_committed_value
 from sqlalchemy.orm.collections import attribute_mapped_collection
 
 from .metadata import Referenceable, Describeable, Modifiable
 from .meta import Base
 from .schema import Schema
-from ..exc import ConstraintError
+from .validators import get_validator
 
 
 class Context(Base, Referenceable, Modifiable):
@@ -128,103 +128,13 @@ class Entity(Base, Referenceable, Modifiable):
             raise KeyError(key)
 
     def __setitem__(self, key, value):
-        if key not in self.schema.attributes:
-            raise KeyError(key)
-
-        attribute = self.schema.attributes[key]
-
-        def check_length(func, op, limit, value):
-            """
-            Perform limit check operation
-            :param func: Callback function to perform the actual operation,
-                         must return true for pass
-            :param op: label for the function
-            :param limit: raw limit value (an integer)
-            :param value: value to validate
-            """
-            if attribute.type in ('string', 'text'):
-                value = len(value)
-            elif attribute.type in ('number'):
-                limit = Decimal(limit)
-            elif attribute.type in ('date'):
-                limit = date.fromtimestamp(limit)
-            elif attribute.type in ('datetime'):
-                limit = datetime.fromtimestamp(limit)
-            else:
-                raise NotImplementedError(
-                    'Cannot coerce limit for type: %s' % attribute.type)
-
-            if not func(value, limit):
-                raise ConstraintError(
-                    attribute.schema.name,
-                    attribute.name,
-                    limit, op, value,
-                    value)
-
-        def convert(value, type_):
-            if value is None:
-                return value
-            elif type_ == 'boolean':
-                return bool(value)
-            elif type_ == 'choice' and value not in attribute.choices:
-                raise ConstraintError(
-                    attribute.schema.name,
-                    attribute.name,
-                    [n for n in attribute.choices], value)
-            return value
-
-        if attribute.is_collection:
-            value = [convert(v, attribute.type) for v in value]
-        else:
-            value = convert(value, attribute.type)
-
-        if value is not None:
-            if attribute.is_collection:
-                if attribute.collection_min is not None and \
-                        attribute.collection_min > len(value):
-                    raise ConstraintError(
-                        atttribute.schema.name,
-                        attribute.name,
-                        attribute.collection_min,
-                        value
-                    )
-                elif attribute.collection_max is not None and \
-                        attribute.collection_max < len(value):
-                    raise ConstraintError(
-                        atttribute.schema.name,
-                        attribute.name,
-                        attribute.collection_max,
-                        value
-                    )
-            else:
-                if attribute.value_min is not None:
-                    check_length(
-                        lambda length, limit: limit <= length,
-                        '<=',
-                        attribute.value_min,
-                        value
-                    )
-
-                if attribute.value_max is not None:
-                    check_length(
-                        lambda length, limit: limit >= length,
-                        '>=',
-                        attribute.value_max,
-                        value
-                    )
-
-                if attribute.pattern is not None \
-                        and not re.match(attribute.pattern, str(value)):
-                    raise ConstraintError(
-                        attribute.schema.name, attribute.name, attribute.pattern, value)
-
-        self.data[key] = value
-
-
+        self.data[key] = get_validator(self.schema)(key, value)
+        flag_modified(self, 'data')
 
     def __delitem__(self, key):
         if key in self.schema.attributes:
             self.data[key] = None
+            flag_modified(self, 'data')
         else:
             raise KeyError(key)
 
@@ -248,21 +158,78 @@ class Entity(Base, Referenceable, Modifiable):
 
     def clear(self):
         self.data.clear()
+        flag_modified(self, 'data')
 
     def setdefault(self, key, default=None):
-        return self.data.setdefault(key, default)
+        value = self.data.setdefault(key, default)
+        flag_modified(self, 'data')
+        return value
 
     def pop(self, key, default=None):
-        return self.data.pop(key, default)
+        value = self.data.pop(key, default)
+        flag_modified(self, 'data')
+        return value
 
     def popitem(self):
-        return self.data.popitem()
+        value = self.data.popitem()
+        flag_modified(self, 'data')
+        return value
 
     def copy(self):
         return copy(self.data)
 
-    def update(other={}):
-        return self.data.update(other)
+    def update(self, other={}):
+        """
+        Sets multiple values, validating them all in one pass
+        """
+        validator = get_validator(self.schema)
+        self.data.update(validator.validate_all(other))
+        flag_modified(self, 'data')
+
+    def patch(self, other={}):
+        """
+        Sets multiple values, only writing the ones that changed
+
+        Stored entities are flushed right away, writing a patch of the
+        values that differ from the stored document (i.e.
+        ``data || :changes``) instead of the whole document, in the same
+        UPDATE as any other changes of the entity. Entities are not updated
+        at all if nothing changed. Pending changes of other objects are
+        left to the next flush.
+
+        New entities, and entities whose document was replaced or changed
+        in place (See `flag_modified`), are written in full on the next
+        flush instead.
+
+        Returns:
+        A dictionary of the changed values
+        """
+        values = get_validator(self.schema).validate_all(other)
+        changes = dict(
+            (key, value) for key, value in values.items()
+            if key not in self.data or self.data[key] != value)
+
+        if not changes:
+            return changes
+
+        state = sa.inspect(self)
+
+        # Without pending changes the document is the stored one
+        if not state.persistent or 'data' in state.committed_state:
+            self.data.update(changes)
+            flag_modified(self, 'data')
+            return changes
+
+        data = dict(self.data)
+        data.update(changes)
+
+        self.data = Entity.data.op('||')(sa.cast(changes, JSONB))
+        state.session.flush([self])
+
+        # The patched document is already known, don't load it back
+        set_committed_value(self, 'data', data)
+
+        return changes
 
     @declared_attr
     def __table_args__(cls):
@@ -279,7 +246,8 @@ class Entity(Base, Referenceable, Modifiable):
                 ondelete='CASCADE'),
             sa.Index('ix_%s_schema_id' % cls.__tablename__, 'schema_id'),
             sa.Index('ix_%s_state_id' % cls.__tablename__, 'state_id'),
-            sa.Index('ix_%s_collect_date' % cls.__tablename__, 'collect_date'))
+            sa.Index('ix_%s_collect_date' % cls.__tablename__, 'collect_date'),
+            sa.Index('ix_%s_modify_date' % cls.__tablename__, 'modify_date'))
 
 
 class HasEntities(object):
@@ -1,4 +1,6 @@
 from datetime import datetime, timedelta
+import hashlib
+import json
 import os
 import re
 import uuid
@@ -1188,6 +1190,13 @@ class Export(Base,
 
     use_choice_labels = sa.Column(sa.Boolean, nullable=False, default=False)
 
+    file_format = sa.Column(
+        sa.Enum('csv', 'sqlite', name='export_file_format'),
+        nullable=False,
+        default='csv',
+        server_default='csv',
+        doc='Format of the data files in the export archive')
+
     notify = sa.Column(
         sa.Boolean,
         nullable=False,
@@ -1199,6 +1208,18 @@ class Export(Base,
         nullable=False,
         default='pending')
 
+    start_date = sa.Column(
+        sa.DateTime,
+        doc='When the export was started, if it is no longer queued')
+
+    fingerprint = sa.Column(
+        sa.String,
+        doc="""
+            Digest of the contents and options of the export.
+            Queued exports identical to a running export are completed
+            with its file instead of being generated again.
+            """)
+
     contents = sa.Column(
         JSONB,
         nullable=False,
@@ -1244,6 +1265,18 @@ class Export(Base,
     def redis_key(self):
         return self.__tablename__ + ':' + self.name
 
+    @staticmethod
+    def make_fingerprint(contents, **options):
+        """
+        Generates the fingerprint of an export's contents and options
+        """
+        state = {
+            'contents': sorted(contents, key=lambda v: v['name']),
+            'options': options,
+        }
+        encoded = json.dumps(state, sort_keys=True, default=str)
+        return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
     @declared_attr
     def __table_args__(cls):
         return (
@@ -1256,7 +1289,10 @@ class Export(Base,
                 cls.name, name=u'uq_%s_name' % cls.__tablename__),
             sa.Index(
                 'ix_%s_owner_user_id' % cls.__tablename__,
-                cls.owner_user_id))
+                cls.owner_user_id),
+            sa.Index(
+                'ix_%s_fingerprint' % cls.__tablename__,
+                cls.fingerprint))
 
 
 class Survey(Base, Referenceable, Modifiable):
@@ -0,0 +1,233 @@
+"""
+Entity data validators
+
+Validators are compiled once per published schema version so that saving
+an entity only has to check its values, instead of resolving attributes,
+coercing limits and compiling patterns on every assignment.
+"""
+
+from datetime import date, datetime
+from decimal import Decimal
+import re
+import weakref
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from .snapshots import get_snapshot, listen_for_changes
+from ..exc import ConstraintError
+
+
+# Compiled validators of published schemata by snapshot, so that they are
+# discarded along with their snapshot (See `snapshots.invalidate_snapshots`)
+_validators = weakref.WeakKeyDictionary()
+
+# Compiled validators of drafts, discarded whenever a schema changes
+_draft_validators = weakref.WeakKeyDictionary()
+
+
+def get_validator(schema):
+    """
+    Returns the compiled validator of a schema
+
+    Validators of published schemata are cached along with their snapshot.
+    Drafts can still change, so their validators are only cached until
+    a schema, attribute or choice is changed in this process.
+
+    Arguments:
+    schema -- the schema to validate entity data against
+
+    Returns:
+    A `SchemaValidator`
+    """
+    snapshot = get_snapshot(schema)
+
+    cache = _draft_validators if snapshot is schema else _validators
+    validator = cache.get(snapshot)
+
+    if validator is None:
+        validator = cache[snapshot] = SchemaValidator(snapshot)
+
+    return validator
+
+
+def invalidate_draft_validators(*args, **kw):
+    """
+    Discards the validators of all drafts
+    """
+    _draft_validators.clear()
+
+
+@sa.event.listens_for(orm.Mapper, 'after_configured', once=True)
+def _listen_for_changes():
+    listen_for_changes(invalidate_draft_validators)
+
+
+class SchemaValidator(object):
+    """
+    Validates entity data against a schema
+    """
+
+    __slots__ = ('fields',)
+
+    def __init__(self, schema):
+        self.fields = dict(
+            (attribute.name, FieldValidator(schema.name, attribute))
+            for attribute in schema.attributes.values())
+
+    def __call__(self, key, value):
+        """
+        Validates the value of a single attribute
+
+        Raises:
+        KeyError -- if the attribute is not in the schema
+        ConstraintError -- if the value is invalid
+
+        Returns:
+        The value to store
+        """
+        return self.fields[key](value)
+
+    def validate_all(self, data):
+        """
+        Validates a dictionary of attribute values in one pass
+
+        Raises:
+        KeyError -- if an attribute is not in the schema
+        ConstraintError -- if a value is invalid
+
+        Returns:
+        A dictionary of the values to store
+        """
+        fields = self.fields
+        return dict((key, fields[key](value)) for key, value in data.items())
+
+
+class FieldValidator(object):
+    """
+    Validates values of an attribute using its precompiled constraints
+    """
+
+    __slots__ = (
+        'schema_name', 'name', 'type', 'is_collection', 'choices',
+        'collection_min', 'collection_max', 'value_min', 'value_max',
+        'pattern', 'measure')
+
+    def __init__(self, schema_name, attribute):
+        self.schema_name = schema_name
+        self.name = attribute.name
+        self.type = attribute.type
+        self.is_collection = attribute.is_collection
+        self.collection_min = attribute.collection_min
+        self.collection_max = attribute.collection_max
+        self.pattern = attribute.pattern and re.compile(attribute.pattern)
+
+        if attribute.type == 'choice':
+            self.choices = frozenset(attribute.choices)
+        else:
+            self.choices = None
+
+        coerce, self.measure = _LIMIT_TYPES.get(
+            attribute.type, (_unsupported(attribute.type), None))
+        self.value_min = (
+            None if attribute.value_min is None
+            else coerce(attribute.value_min))
+        self.value_max = (
+            None if attribute.value_max is None
+            else coerce(attribute.value_max))
+
+    def __call__(self, value):
+        if self.is_collection:
+            value = [self.convert(v) for v in value]
+        else:
+            value = self.convert(value)
+
+        if value is None:
+            return value
+
+        if self.is_collection:
+            if self.collection_min is not None \
+                    and self.collection_min > len(value):
+                raise ConstraintError(
+                    self.schema_name, self.name, self.collection_min, value)
+            elif self.collection_max is not None \
+                    and self.collection_max < len(value):
+                raise ConstraintError(
+                    self.schema_name, self.name, self.collection_max, value)
+        else:
+            if self.value_min is not None:
+                self.check_limit(
+                    lambda length, limit: limit <= length,
+                    '<=', self.value_min, value)
+
+            if self.value_max is not None:
+                self.check_limit(
+                    lambda length, limit: limit >= length,
+                    '>=', self.value_max, value)
+
+            if self.pattern is not None \
+                    and not self.pattern.match(str(value)):
+                raise ConstraintError(
+                    self.schema_name, self.name, self.pattern.pattern, value)
+
+        return value
+
+    def convert(self, value):
+        if value is None:
+            return value
+        elif self.type == 'boolean':
+            return bool(value)
+        elif self.choices is not None and value not in self.choices:
+            raise ConstraintError(
+                self.schema_name, self.name, sorted(self.choices), value)
+        return value
+
+    def check_limit(self, func, op, limit, value):
+        """
+        Perform limit check operation
+
+        Arguments:
+        func -- callback function to perform the actual operation,
+                must return true for pass
+        op -- label for the function
+        limit -- precoerced limit value
+        value -- value to validate
+        """
+        if isinstance(limit, NotImplementedError):
+            raise limit
+
+        if not func(self.measure(value), limit):
+            raise ConstraintError(
+                self.schema_name, self.name, limit, op, value, value)
+
+
+def _unsupported(type_):
+    """
+    Limits of unsupported types only fail when a value is checked
+    """
+    return lambda limit: NotImplementedError(
+        'Cannot coerce limit for type: %s' % type_)
+
+
+def _to_decimal(value):
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+
+def _to_date(value):
+    return value if isinstance(value, date) else date.fromisoformat(value)
+
+
+def _to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+# How limits are coerced and how values are measured against them by type
+_LIMIT_TYPES = {
+    'string': (int, len),
+    'text': (int, len),
+    'number': (Decimal, _to_decimal),
+    'date': (date.fromtimestamp, _to_date),
+    'datetime': (datetime.fromtimestamp, _to_datetime),
+}
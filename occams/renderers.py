@@ -6,25 +6,29 @@ and associated plugins must be enabled.
 """
 
 from __future__ import division
+from collections import OrderedDict
 from collections.abc import Iterable
 from decimal import Decimal
 from datetime import date, datetime
 import os
 from itertools import groupby
 import cgi
+import hashlib
+import json
 from decimal import ROUND_UP
 import tempfile
 
 import magic
 from pyramid.renderers import render
+from pyramid.threadlocal import get_current_request
 from dateutil.parser import parse as dateutil_parse
 import sqlalchemy as sa
-from sqlalchemy.orm.attributes import flag_modified
 import wtforms
 import wtforms.fields.html5
 import wtforms.widgets.html5
 import wtforms.ext.dateutil.fields
 from wtforms_components import DateRange
+from zope.sqlalchemy import mark_changed
 
 from . import _, log, models
 from .fields import FileField
@@ -49,6 +53,24 @@ class modes:
     AUTO, AVAILABLE, ALL = range(3)
 
 
+# Maximum number of attributes and choices whose fields are kept compiled
+# (See `make_fields`)
+FIELD_CACHE_SIZE = 50000
+
+# Compiled field sets of published schemata by snapshot, least recently
+# used first
+_field_cache = OrderedDict()
+
+# Number of seconds rendered field markup is cached (See `render_fields`)
+FRAGMENT_EXPIRE = 86400
+
+# Templates the cached field markup is rendered from, so that cached markup
+# is not reused once they change
+FRAGMENT_TEMPLATES = ('form/fields.pt', 'wtforms.pt')
+
+_fragment_templates_digest = None
+
+
 def version2json(schema):
     """
     Returns a single schema json record
@@ -138,6 +160,24 @@ def strip_whitespace(value):
         return value.strip() or None
 
 
+class _SharedFieldsForm(wtforms.Form):
+    """
+    Base class of forms whose fields are shared (See `make_fields`)
+
+    Bound fields get their own validators and filters, so that they can be
+    changed for a single form (e.g. adding a validator for a request).
+    """
+
+    class Meta:
+
+        def bind_field(self, form, unbound_field, options):
+            field = wtforms.meta.DefaultMeta.bind_field(
+                self, form, unbound_field, options)
+            field.validators = list(field.validators)
+            field.filters = list(field.filters)
+            return field
+
+
 def make_field(attribute):
     """
     Converts an attribute to a WTForm field
@@ -152,7 +192,7 @@ def make_field(attribute):
 
     if attribute.type == 'section':
 
-        class Section(wtforms.Form):
+        class Section(_SharedFieldsForm):
             pass
 
         for subattribute in attribute.itertraverse():
@@ -279,6 +319,58 @@ def make_field(attribute):
     return field_class(**kw)
 
 
+def make_fields(schema):
+    """
+    Converts a models schema to a WTForm containing only its attribute fields
+
+    Field sets of published schemata are compiled once and cached. Least
+    recently used field sets are discarded once the cache holds more than
+    ``FIELD_CACHE_SIZE`` attributes and choices. The returned class is
+    shared, so per-request fields should be added to a subclass.
+
+    Parameters:
+    schema -- the form to convert
+
+    Returns:
+    A WTForm class
+    """
+    snapshot = models.get_snapshot(schema)
+
+    if snapshot is schema:
+        return _compile_fields(schema)[0]
+
+    if snapshot in _field_cache:
+        _field_cache.move_to_end(snapshot)
+        return _field_cache[snapshot][0]
+
+    _field_cache[snapshot] = fields_class, size = _compile_fields(snapshot)
+
+    total = sum(size for fields_class, size in _field_cache.values())
+    while total > FIELD_CACHE_SIZE and len(_field_cache) > 1:
+        total -= _field_cache.popitem(last=False)[1][1]
+
+    return fields_class
+
+
+def _compile_fields(schema):
+    """
+    Helper method to generate the field set of a schema
+
+    Returns:
+    A tuple of the WTForm class and its size (attributes and choices)
+    """
+
+    class SchemaFields(_SharedFieldsForm):
+        pass
+
+    for attribute in schema.itertraverse():
+        setattr(SchemaFields, attribute.name, make_field(attribute))
+
+    size = sum(1 + len(a.choices) for a in schema.iterlist())
+
+    return SchemaFields, size
+
+
 def make_form(session,
               schema,
               entity=None,
@@ -301,14 +393,29 @@ def make_form(session,
     Returns:
     A WTForm class. The reason why an instance is not returns is in case
     the user wants to sitch together multiple forms for Long Forms.
+    The attribute fields are shared with other forms of the same version
+    (See `make_fields`), only the metadata and workflow fields are
+    generated for each call.
     """
 
-    class modelsForm(wtforms.Form):
+    fields_schema = schema
+
+    # If there was a version change so we render the correct form
+    if show_metadata and formdata and 'ofmetadata_-version' in formdata:
+        fields_schema = (
+            session.query(models.Schema)
+            .filter_by(
+                name=schema.name,
+                publish_date=formdata['ofmetadata_-version'])
+            .one())
+
+    class modelsForm(make_fields(fields_schema)):
 
         class Meta:
             pass
 
         setattr(Meta, 'schema', schema)
+        setattr(Meta, 'fields_schema', fields_schema)
         setattr(Meta, 'entity', entity)
 
         def validate(self, **kw):
@@ -333,16 +440,9 @@ def make_form(session,
             else:
                 return status and super(modelsForm, self).validate(**kw)
 
-    if show_metadata:
+    schema = fields_schema
 
-        # If there was a version change so we render the correct form
-        if formdata and 'ofmetadata_-version' in formdata:
-            schema = (
-                session.query(models.Schema)
-                .filter_by(
-                    name=schema.name,
-                    publish_date=formdata['ofmetadata_-version'])
-                .one())
+    if show_metadata:
 
         if not allowed_versions:
             allowed_versions = []
@@ -377,7 +477,11 @@ def make_form(session,
                 choices=actual_versions,
                 validators=[wtforms.validators.InputRequired()])
 
-        setattr(modelsForm, 'ofmetadata_', wtforms.FormField(Metadata))
+        metadata_field = wtforms.FormField(Metadata)
+        # Fields are ordered by creation, and the attribute fields were
+        # created beforehand
+        metadata_field.creation_counter = -2
+        setattr(modelsForm, 'ofmetadata_', metadata_field)
 
     if transition == modes.ALL:
         allowed_states = TRANSITIONS.keys()
@@ -414,10 +518,9 @@ def make_form(session,
                         _('Please select a state'))
                 ])
 
-        setattr(modelsForm, 'ofworkflow_', wtforms.FormField(Workflow))
-
-    for attribute in schema.itertraverse():
-        setattr(modelsForm, attribute.name, make_field(attribute))
+        workflow_field = wtforms.FormField(Workflow)
+        workflow_field.creation_counter = -1
+        setattr(modelsForm, 'ofworkflow_', workflow_field)
 
     return modelsForm
 
@@ -441,9 +544,13 @@ def render_form(form,
                 cancel_url=None,
                 disabled=False,
                 show_footer=True,
-                attr=None):
+                attr=None,
+                redis=None):
     """
     Helper function to render a WTForm by OCCAMS standards
+
+    If a redis connection is specified, the field markup of blank and
+    read-only forms is cached (See `render_fields`).
     """
 
     entity = form.meta.entity
@@ -459,19 +566,132 @@ def render_form(form,
     fields_disabled = bool(disabled or metadata_disabled or (
         entity and entity.not_done))
 
+    fields = render_fields(
+        form,
+        metadata_disabled=metadata_disabled,
+        fields_disabled=fields_disabled,
+        redis=redis)
+
     return render('occams:templates/form.pt', {
         'cancel_url': cancel_url,
         'schema': schema,
         'entity': entity,
         'form': form,
+        'fields': fields,
         'show_footer': show_footer,
-        'metadata_disabled': metadata_disabled,
-        'fields_disabled': fields_disabled,
         'disabled': disabled,
         'attr': attr or {},
     })
 
 
+def render_fields(form,
+                  metadata_disabled=False,
+                  fields_disabled=False,
+                  redis=None):
+    """
+    Renders the field markup of a WTForm
+
+    Field markup of published schemata is shared by all processes through
+    redis as long as the form is either blank or read-only, has no errors,
+    and is rendered with the same data, disabled flags and locale.
+
+    Parameters:
+    form -- the WTForm instance to render
+    metadata_disabled -- render metadata fields as disabled
+    fields_disabled -- render attribute fields as disabled
+    redis -- (Optional) redis connection used to cache the markup
+
+    Returns:
+    The rendered HTML string
+    """
+    key = None
+
+    if redis is not None:
+        key = _fragment_key(form, metadata_disabled, fields_disabled)
+
+    if key is not None:
+        cached = redis.get(key)
+        if cached is not None:
+            return cached.decode('utf-8') \
+                if isinstance(cached, bytes) else cached
+
+    fields = render('occams:templates/form/fields.pt', {
+        'form': form,
+        'metadata_disabled': metadata_disabled,
+        'fields_disabled': fields_disabled,
+    })
+
+    if key is not None:
+        redis.set(key, fields, ex=FRAGMENT_EXPIRE)
+
+    return fields
+
+
+def _fragment_key(form, metadata_disabled, fields_disabled):
+    """
+    Helper method to generate the redis key of the field markup of a form
+
+    Returns:
+    The key, or None if the markup should not be cached
+    """
+    schema = form.meta.fields_schema
+    entity = form.meta.entity
+
+    # Drafts can still change and errors are particular to a submission
+    if schema.publish_date is None or form.errors:
+        return None
+
+    # Forms being worked on change on every save, not worth caching
+    if entity is not None and not metadata_disabled:
+        return None
+
+    versions = None
+    if 'ofmetadata_' in form:
+        versions = form.ofmetadata_.version.choices
+
+    # Markup is translated for the locale of the current request
+    request = get_current_request()
+    locale_name = getattr(request, 'locale_name', None)
+
+    digest = hashlib.sha1(json.dumps(
+        [_get_fragment_templates_digest(),
+         locale_name,
+         metadata_disabled,
+         fields_disabled,
+         versions,
+         form.data],
+        sort_keys=True,
+        default=_fragment_value).encode('utf-8')).hexdigest()
+
+    return 'forms:{}:{}:{}'.format(schema.id, schema.publish_date, digest)
+
+
+def _fragment_value(value):
+    """
+    Helper method to serialize form data that is not JSON-compatible
+    """
+    if isinstance(value, models.EntityAttachment):
+        return [value.id, value.file_name]
+    return str(value)
+
+
+def _get_fragment_templates_digest():
+    """
+    Helper method to fingerprint the templates field markup is rendered from
+    """
+    global _fragment_templates_digest
+
+    if _fragment_templates_digest is None:
+        digest = hashlib.sha1()
+        templates = os.path.join(os.path.dirname(__file__), 'templates')
+        for name in FRAGMENT_TEMPLATES:
+            with open(os.path.join(templates, name), 'rb') as fp:
+                digest.update(fp.read())
+        _fragment_templates_digest = digest.hexdigest()
+
+    return _fragment_templates_digest
+
+
 def entity_data(entity):
     """
     Serializes an entity into a dictionary for data entry
@@ -486,7 +706,7 @@ def entity_data(entity):
         }
     }
 
-    for attribute in entity.schema.iterleafs():
+    for attribute in models.get_snapshot(entity.schema).iterleafs():
 
         if attribute.parent_attribute:
             parent = data.setdefault(attribute.parent_attribute.name, {})
@@ -562,7 +782,9 @@ def apply_data(session, entity, data, upload_path):
     if entity.data is None:
         entity.data = {}
 
-    for attribute in entity.schema.iterleafs():
+    values = {}
+
+    for attribute in models.get_snapshot(entity.schema).iterleafs():
 
         value = None
 
@@ -641,8 +863,13 @@ def apply_data(session, entity, data, upload_path):
                 and attribute.type in ('number', 'date', 'datetime'):
             value = str(value)
 
-        entity[attribute.name] = value
+        values[attribute.name] = value
+
+    # Validate everything at once against the compiled schema validator,
+    # only the changed values are written
+    entity.patch(values)
 
-    flag_modified(entity, 'data')
+    # The patch may be the only change of the transaction
+    mark_changed(session)
 
     return entity
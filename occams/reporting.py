@@ -3,13 +3,23 @@ A utility for allowing the access of entered schema data to be represented
 in a SQL table-like fashion.
 """
 from collections import OrderedDict
+from itertools import chain
+import threading
 
 import sqlalchemy as sa
 from sqlalchemy import orm, cast, null, literal, Integer, case, Unicode, func
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, aggregate_order_by
 
 from . import models
-from .utils.sql import group_concat, to_date, to_datetime
+from .utils.sql import group_concat, to_date, to_datetime, with_ordinality
+
+
+# Maximum number of compiled report plans kept per process
+REPORT_CACHE_SIZE = 256
+
+# Process-wide cache of compiled report plans, see ``build_report``
+_report_cache = OrderedDict()
+_report_cache_lock = threading.Lock()
 
 
 def build_report(session,
@@ -43,9 +53,33 @@ def build_report(session,
     Developer note: the results that will be returned by the subquery are
     named tuples of each result using the names of the naming schema as the
     property names.
+
+    Compiled plans are cached per process and keyed by the published
+    versions that make up the report, so only the first call for a given set
+    of versions and options pays for planning the columns.
     """
     is_sqlite = 'sqlite' == session.bind.url.drivername
 
+    # Published versions are immutable, so the set of versions that make up
+    # the report (and their publication dates) is enough to identify a plan
+    versions = _report_versions(session, schema_name, ids)
+    key = (
+        session.bind.url.drivername,
+        schema_name,
+        versions,
+        None if attributes is None else frozenset(attributes),
+        bool(expand_collections),
+        bool(use_choice_labels),
+        context,
+        bool(ignore_private),
+        delimiter)
+
+    with _report_cache_lock:
+        cte = _report_cache.get(key)
+        if cte is not None:
+            _report_cache.move_to_end(key)
+            return cte
+
     query = (
         session.query(
             models.Entity.id.label('id'),
@@ -73,6 +107,20 @@ def build_report(session,
 
     columns = build_columns(session, schema_name, ids, expand_collections)
 
+    label_lookup = None
+
+    def choice_labels():
+        """
+        Joins the choice label lookup on first use
+        """
+        nonlocal query, label_lookup
+        if label_lookup is None:
+            label_lookup = build_choice_labels(session, schema_name, ids)
+            query = query.outerjoin(
+                label_lookup,
+                label_lookup.c.schema_id == models.Entity.schema_id)
+        return label_lookup
+
     attributes = None if attributes is None else set(attributes)
 
     for column in columns.values():
@@ -112,49 +160,51 @@ def build_report(session,
         elif column.type == 'choice' and column.is_collection:
             if expand_collections:
                 if use_choice_labels:
-                    # Query for the correspoinding label if is in the selection
-                    Choice = orm.aliased(models.Choice)
-                    Attribute = orm.aliased(models.Attribute)
-                    value_column = (
-                        session.query(Choice.title)
-                            .select_from(Choice)
-                            .join(Attribute)
-                            .filter(Attribute.schema_id == models.Entity.schema_id)
-                            .filter(Attribute.name == column.attribute_name)
-                            .filter(Choice.name == column.choice.name)
-                            .filter(models.Entity.data[column.attribute_name].has_key(column.choice.name))
-                            .correlate(models.Entity)
-                            .as_scalar()
-                    )
+                    # Use the corresponding label if is in the selection
+                    labels = choice_labels()
+                    value_column = case([(
+                        models.Entity.data[column.attribute_name]
+                            .has_key(column.choice.name),
+                        labels.c.labels[column.attribute_name]
+                            [column.choice.name].astext
+                    )])
                 else:
                     # Coerce to true/false if the selection contains the choice for this column
                     value_column = models.Entity.data[column.attribute_name].has_key(column.choice.name).cast(sa.Integer)
             else:
                 if use_choice_labels:
-                    # Replace with corresponding selected labels for the current version of the form
-                    Choice = orm.aliased(models.Choice)
-                    Attribute = orm.aliased(models.Attribute)
+                    # Replace with corresponding selected labels for the current version of the form,
+                    # in the order they were selected
+                    labels = choice_labels()
+                    selected = with_ordinality(
+                        func.jsonb_array_elements_text(
+                            models.Entity.data[column.name])
+                    ).alias('selected')
                     value_column = (
-                        session.query(func.string_agg(Choice.title, literal(delimiter)))
-                            .select_from(Choice)
-                            .join(Attribute)
-                            .filter(Attribute.schema_id == models.Entity.schema_id)
-                            .filter(Attribute.name == column.attribute_name)
-                            .filter(models.Entity.data[column.name].has_key(Choice.name))
-                            .correlate(models.Entity)
-                            .as_scalar()
+                        sa.select([
+                            func.string_agg(
+                                labels.c.labels[column.attribute_name]
+                                [sa.literal_column('selected')].astext,
+                                aggregate_order_by(
+                                    literal(delimiter),
+                                    sa.literal_column('ordinality')))
+                        ])
+                        .select_from(selected)
+                        .correlate(models.Entity, labels)
+                        .as_scalar()
                     )
                 else:
                     # expand the json array a a listing of values
-                    selected_subquery = (
-                        session.query(
-                            func.jsonb_array_elements_text(models.Entity.data[column.name]).label('selected')
-                        )
-                        .subquery()
-                    )
+                    selected = func.jsonb_array_elements_text(
+                        models.Entity.data[column.name]).alias('selected')
                     # aggregate the elisting of values as a single delimited list
                     value_column = (
-                        session.query(func.string_agg(selected_subquery.c.selected, literal(delimiter)))
+                        sa.select([
+                            func.string_agg(
+                                sa.literal_column('selected'),
+                                literal(delimiter))
+                        ])
+                        .select_from(selected)
                         .as_scalar()
                     )
 
@@ -164,19 +214,10 @@ def build_report(session,
             value_column = models.Entity.data[column.name].astext.cast(sa.Unicode)
 
             if use_choice_labels:
-                # use a subquery to replace the code with the choice label
-                Choice = orm.aliased(models.Choice)
-                Attribute = orm.aliased(models.Attribute)
-                value_column = (
-                    session.query(Choice.title)
-                        .select_from(Choice)
-                        .join(Attribute)
-                        .filter(Attribute.schema_id == models.Entity.schema_id)
-                        .filter(Attribute.name == column.name)
-                        .filter(Choice.name == value_column)
-                        .correlate(models.Entity)
-                        .as_scalar()
-                )
+                # use the choice lookup to replace the code with the label
+                labels = choice_labels()
+                value_column = \
+                    labels.c.labels[column.name][value_column].astext
 
         query = query.add_column(value_column.label(column.name))
 
@@ -199,10 +240,61 @@ def build_report(session,
     else:
         cte = query.cte(schema_name)
 
-    print(cte)
+    with _report_cache_lock:
+        _report_cache[key] = cte
+        while len(_report_cache) > REPORT_CACHE_SIZE:
+            _report_cache.popitem(last=False)
+
     return cte
 
 
+def _report_versions(session, schema_name, ids=None):
+    """
+    Helper method to list the published versions that make up a report
+
+    Parameters:
+    session -- The session to query versions from
+    schema_name -- The name of the schema
+    ids -- (Optional) Specific id numbers of the forms
+
+    Returns:
+    A sorted tuple of (id, publish_date) pairs
+    """
+    query = (
+        session.query(models.Schema.id, models.Schema.publish_date)
+        .filter(models.Schema.name == schema_name)
+        .filter(models.Schema.publish_date != null())
+        .filter(models.Schema.retract_date == null()))
+
+    if ids:
+        query = query.filter(models.Schema.id.in_(ids))
+
+    return tuple(sorted((id, publish_date) for id, publish_date in query))
+
+
+def invalidate_report_cache():
+    """
+    Discards all compiled report plans in the current process
+    """
+    with _report_cache_lock:
+        _report_cache.clear()
+
+
+@sa.event.listens_for(orm.Session, 'after_flush')
+def _invalidate_report_cache_on_flush(session, flush_context):
+    """
+    Discards compiled report plans when form metadata is modified.
+
+    Other processes will miss their cached plans on the next call anyway,
+    since publishing or retracting a version changes the plan key.
+    """
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance,
+                      (models.Schema, models.Attribute, models.Choice)):
+            invalidate_report_cache()
+            break
+
+
 def build_columns(session, schema_name, ids=None, expand_collections=False):
     """
     Helper method to determine the columns of the report to generate
@@ -280,6 +372,60 @@ def build_columns(session, schema_name, ids=None, expand_collections=False):
     return columns
 
 
+def build_choice_labels(session, schema_name, ids=None):
+    """
+    Helper method to build a lookup of choice labels for each form version
+
+    The lookup is aggregated once per version so that reports can decode
+    choice codes with a single join rather than a subquery per row.
+
+    Paramters:
+    session -- The session to query plan from
+    schema_name -- The name of the schema to get labels for
+    ids -- (Optional) Specific id numbers of the forms
+
+    Returns:
+    A SQLAlchemy aliased sub-query with a ``schema_id`` column and a
+    ``labels`` JSONB column mapping attribute name to its choice labels
+    (e.g. ``{"color": {"001": "Green", "002": "Red"}}``)
+    """
+
+    query = (
+        session.query(
+            models.Attribute.schema_id.label('schema_id'),
+            models.Attribute.name.label('attribute_name'),
+            func.jsonb_object_agg(models.Choice.name, models.Choice.title)
+            .label('choices'))
+        .select_from(models.Choice)
+        .join(models.Choice.attribute)
+        .join(models.Attribute.schema)
+        .filter(models.Schema.name == schema_name)
+        .filter(models.Schema.publish_date != null())
+        .filter(models.Schema.retract_date == null()))
+
+    if ids:
+        query = query.filter(models.Schema.id.in_(ids))
+
+    attribute_labels = (
+        query
+        .group_by(models.Attribute.schema_id, models.Attribute.name)
+        .subquery())
+
+    labels = (
+        session.query(
+            attribute_labels.c.schema_id.label('schema_id'),
+            sa.type_coerce(
+                func.jsonb_object_agg(
+                    attribute_labels.c.attribute_name,
+                    attribute_labels.c.choices),
+                JSONB)
+            .label('labels'))
+        .group_by(attribute_labels.c.schema_id)
+        .subquery(schema_name + '_labels'))
+
+    return labels
+
+
 class DataColumn(object):
     """
     A data dictionary column for reference when inspecting a report column.
@@ -3,16 +3,20 @@ Command-line interface for exporting data
 """
 
 import argparse
-from itertools import chain
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import os
 import shutil
 import sys
+import time
 import uuid
 
+from dateutil.parser import parse as parse_date
 from pyramid.paster import bootstrap, setup_logging
+import sqlalchemy as sa
 from tabulate import tabulate
 
-from .. import exports
+from .. import exports, models
 
 
 def parse_args(argv=sys.argv):
@@ -71,6 +75,36 @@ def parse_args(argv=sys.argv):
         dest='show_private',
         action='store_true',
         help='De-identifies private data.')
+    export_group.add_argument(
+        '--fetch-size',
+        metavar='ROWS',
+        dest='fetch_size',
+        type=int,
+        default=exports.FETCH_SIZE,
+        help='Number of rows to fetch from the database at a time')
+    export_group.add_argument(
+        '--since',
+        metavar='TIMESTAMP|MANIFEST',
+        dest='since',
+        type=parse_since,
+        help='Only export rows modified since an ISO timestamp, '
+             'or since the export described by a previous '
+             '%s file' % exports.MANIFEST_FILE_NAME)
+    export_group.add_argument(
+        '--format',
+        dest='file_format',
+        choices=['csv', 'sqlite'],
+        default='csv',
+        help='Write a CSV file per data file (default), or a single '
+             'SQLite database that includes the codebook')
+    export_group.add_argument(
+        '-j', '--jobs',
+        metavar='N',
+        dest='jobs',
+        type=int,
+        default=1,
+        help='Number of processes to generate data files with '
+             '(PostgreSQL only)')
     export_group.add_argument(
         '--dir',
         metavar='PATH',
@@ -84,6 +118,19 @@ def parse_args(argv=sys.argv):
     return parser.parse_args(argv)
 
 
+def parse_since(value):
+    """
+    Parses the start of a delta export from a timestamp or a manifest file
+    """
+    if os.path.isfile(value):
+        return exports.read_watermark(value)
+    try:
+        return parse_date(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Not a timestamp or manifest file: %s' % value)
+
+
 def main(argv=sys.argv):
     args = parse_args(argv[1:])
 
@@ -109,8 +156,7 @@ def print_list(args, env):
 
     header = ['sys', 'priv', 'rand', 'name', 'title']
     dbsession = env['request'].dbsession
-    plans = exports.plans
-    rows = iter(format(e) for e in exports.list_all(plans, dbsession).values())
+    rows = iter(format(e) for e in exports.list_all(dbsession).values())
     print(tabulate(rows, header, tablefmt='simple'))
 
 
@@ -127,8 +173,7 @@ def make_export(args, env):
         sys.exit('You must specifiy something to export!')
 
     dbsession = env['request'].dbsession
-    plans = exports.plans
-    exportables = exports.list_all(plans, dbsession)
+    exportables = exports.list_all(dbsession)
 
     if args.atomic:
         out_dir = '%s-%s' % (args.dir.rstrip('/'), uuid.uuid4())
@@ -138,25 +183,58 @@ def make_export(args, env):
         if not os.path.exists(args.dir):
             os.makedirs(args.dir)
 
-    for plan in exportables.values():
+    # Determine before reading any data, so that nothing is missed next time
+    watermark = exports.get_watermark(dbsession)
+
+    selected = [
+        plan for plan in exportables.values()
         if (args.all
-                or (args.all_private
-                    and plan.has_private
-                    and not plan.has_rand)
-                or (args.all_public
-                    and not plan.has_private
-                    and not plan.has_rand)
-                or (args.all_rand and plan.has_rand)
-                or (args.names and plan.name in args.names)):
-            with open(os.path.join(out_dir, plan.file_name), 'w') as fp:
-                exports.write_data(fp, plan.data(
-                    use_choice_labels=args.use_choice_labels,
-                    expand_collections=args.expand_collections,
-                    ignore_private=not args.show_private))
+            or (args.all_private
+                and plan.has_private
+                and not plan.has_rand)
+            or (args.all_public
+                and not plan.has_private
+                and not plan.has_rand)
+            or (args.all_rand and plan.has_rand)
+            or (args.names and plan.name in args.names))]
+
+    try:
+        if args.file_format == 'sqlite':
+            results = export_sqlite(
+                args, out_dir, selected, exportables, dbsession)
+            file_names = [exports.sqlite.FILE_NAME]
+        elif (args.jobs > 1
+                and len(selected) > 1
+                and dbsession.bind.dialect.name == 'postgresql'):
+            results = export_parallel(args, env, out_dir, selected)
+            file_names = [p.file_name for p in selected]
+        else:
+            results = [export_plan(args, out_dir, p) for p in selected]
+            file_names = [p.file_name for p in selected]
+
+        if args.since is not None:
+            tombstones_path = \
+                os.path.join(out_dir, exports.TOMBSTONES_FILE_NAME)
+            with open(tombstones_path, 'w') as fp:
+                exports.write_tombstones(fp, selected, args.since)
+
+        manifest_path = os.path.join(out_dir, exports.MANIFEST_FILE_NAME)
+        with open(manifest_path, 'w') as fp:
+            exports.write_manifest(fp, args.since, watermark, file_names)
 
-    with open(os.path.join(out_dir, exports.codebook.FILE_NAME), 'w') as fp:
-        codebooks = [p.codebook() for p in exportables.values()]
-        exports.write_codebook(fp, chain.from_iterable(codebooks))
+        # The database already includes the codebook
+        if args.file_format == 'csv':
+            codebook_path = os.path.join(out_dir, exports.codebook.FILE_NAME)
+            with open(codebook_path, 'w') as fp:
+                exports.write_codebook(
+                    fp, exports.iter_codebook(dbsession, exportables.values()))
+    except:
+        # Leave the current data files in place
+        if args.atomic:
+            shutil.rmtree(out_dir)
+        raise
+
+    print_summary(results)
 
     if args.atomic:
         old_dir = os.path.realpath(args.dir)
@@ -165,3 +243,136 @@ def make_export(args, env):
         os.symlink(os.path.abspath(out_dir), args.dir)
         if not os.path.islink(old_dir):
             shutil.rmtree(old_dir)
+
+
+def export_plan(args, out_dir, plan):
+    """
+    Generates the data file of a single plan
+
+    Returns:
+    A tuple of the plan name, number of rows and seconds elapsed
+    """
+    start = time.monotonic()
+    with open(os.path.join(out_dir, plan.file_name), 'w') as fp:
+        count = exports.write_data(fp, plan.data(
+            use_choice_labels=args.use_choice_labels,
+            expand_collections=args.expand_collections,
+            ignore_private=not args.show_private,
+            since=args.since),
+            fetch_size=args.fetch_size,
+            use_copy=plan.is_copyable)
+    return plan.name, count, time.monotonic() - start
+
+
+def export_sqlite(args, out_dir, plans, exportables, dbsession):
+    """
+    Generates the data files of the plans as tables of a SQLite database
+
+    Returns:
+    A list of `export_plan` results
+    """
+    codebook_rows = list(
+        exports.iter_codebook(dbsession, exportables.values()))
+
+    tables = defaultdict(list)
+    for row in codebook_rows:
+        tables[row['table']].append(row)
+
+    path = os.path.join(out_dir, exports.sqlite.FILE_NAME)
+    results = []
+
+    with exports.sqlite.open_database(path) as connection:
+        for plan in plans:
+            start = time.monotonic()
+            count = exports.sqlite.write_table(
+                connection, plan.name, plan.data(
+                    use_choice_labels=args.use_choice_labels,
+                    expand_collections=args.expand_collections,
+                    ignore_private=not args.show_private,
+                    since=args.since),
+                tables[plan.name],
+                args.fetch_size)
+            results.append((plan.name, count, time.monotonic() - start))
+
+        exports.sqlite.write_codebook(connection, codebook_rows)
+
+    return results
+
+
+def export_parallel(args, env, out_dir, plans):
+    """
+    Generates the data files of the plans in a pool of processes
+
+    Every process uses its own database connection, but reads from the
+    snapshot exported by this process so that the data files agree with
+    each other.
+
+    Returns:
+    A list of `export_plan` results
+    """
+    settings = env['registry'].settings
+    engine_settings = dict(
+        (key, value) for key, value in settings.items()
+        if key.startswith('sqlalchemy.'))
+
+    connection = env['request'].dbsession.bind.connect()
+    snapshot_transaction = connection.begin()
+
+    try:
+        connection.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        snapshot = connection.execute('SELECT pg_export_snapshot()').scalar()
+
+        with ProcessPoolExecutor(
+                max_workers=args.jobs,
+                initializer=_init_worker,
+                initargs=(engine_settings,)) as executor:
+            futures = [
+                executor.submit(_export_plan_worker,
+                                args, out_dir, plan.name, snapshot)
+                for plan in plans]
+            return [future.result() for future in futures]
+    finally:
+        # The snapshot is no longer needed once all workers are done
+        snapshot_transaction.rollback()
+        connection.close()
+
+
+_worker_session = None
+
+
+def _init_worker(engine_settings):
+    """
+    Configures a database session for a worker process
+    """
+    global _worker_session
+    engine = models.get_engine(engine_settings)
+    _worker_session = models.get_session_factory(engine)()
+
+
+def _export_plan_worker(args, out_dir, name, snapshot):
+    """
+    Generates a data file in a worker process
+    """
+    dbsession = _worker_session
+    try:
+        # Only allowed before the first query of the transaction
+        dbsession.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        dbsession.execute(
+            sa.text('SET TRANSACTION SNAPSHOT :snapshot'),
+            {'snapshot': snapshot})
+        plan = exports.list_all(dbsession)[name]
+        return export_plan(args, out_dir, plan)
+    finally:
+        dbsession.rollback()
+
+
+def print_summary(results):
+    """
+    Prints tabulated timings of the generated data files
+    """
+    header = ['name', 'rows', 'seconds']
+    rows = [(name, count, '%.2f' % seconds) for name, count, seconds in results]
+    total_rows = sum(count or 0 for name, count, seconds in results)
+    total_seconds = sum(seconds for name, count, seconds in results)
+    rows.append(('(total)', total_rows, '%.2f' % total_seconds))
+    print(tabulate(rows, header, tablefmt='simple'))
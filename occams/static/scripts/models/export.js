@@ -10,11 +10,15 @@ function Export(data) {
   self.title = ko.observable();
   self.name = ko.observable();
   self.status = ko.observable();
+  self.queued = ko.observable();
   self.use_choice_labels = ko.observable();
   self.expand_collections = ko.observable();
+  self.file_format = ko.observable();
   self.contents = ko.observable();
   self.count = ko.observable();
   self.total = ko.observable();
+  self.rows = ko.observable();
+  self.total_rows = ko.observable();
   self.file_size = ko.observable();
   self.download_url = ko.observable();
   self.delete_url = ko.observable();
@@ -27,11 +31,15 @@ function Export(data) {
     self.title(data.title);
     self.name(data.name);
     self.status(data.status);
+    self.queued(data.queued);
     self.use_choice_labels(data.use_choice_labels);
     self.expand_collections(data.expand_collections);
+    self.file_format(data.file_format);
     self.contents(data.contents);
     self.count(data.count);
     self.total(data.total);
+    self.rows(data.rows);
+    self.total_rows(data.total_rows);
     self.file_size(data.file_size);
     self.download_url(data.download_url);
     self.delete_url(data.delete_url);
@@ -43,6 +51,10 @@ function Export(data) {
    * Calculates this export's current progress
    */
   self.progress = ko.pureComputed(function(){
+    // Row counts are estimates, so don't let them overshoot
+    if (self.total_rows() > 0) {
+      return Math.min(Math.ceil((self.rows() / self.total_rows()) * 100), 100);
+    }
     return Math.ceil((self.count() / self.total()) * 100);
   }).extend({ throttle: 1 });
 
@@ -99,7 +99,11 @@ function StatusViewModel(options) {
 
       export_.count(data['count']);
       export_.total(data['total']);
+      export_.rows(data['rows']);
+      export_.total_rows(data['total_rows']);
       export_.status(data['status']);
+      // Exports only broadcast once they are started
+      export_.queued(false);
       export_.file_size(data['file_size']);
     });
 
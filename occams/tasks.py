@@ -6,20 +6,24 @@ can continue to use the application and download their exports at a
 later time.
 """
 
+import base64
 import csv
-from collections import OrderedDict
+from collections import defaultdict, OrderedDict
 from datetime import timedelta
-from itertools import chain
+import functools
 import json
 import os
-import tempfile
+import re
+import shutil
+import time
 from urllib.parse import urlparse
-from zipfile import ZipFile, ZIP_DEFLATED
+import uuid
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
-from celery import Celery, bootsteps, signals, Task
+from celery import Celery, bootsteps, chord, signals, Task
 from celery.bin import Option
 from celery.utils.log import get_task_logger
-from pyramid.settings import aslist
+from pyramid.settings import asbool, aslist
 from pyramid.paster import get_appsettings
 import humanize
 from redis import Redis
@@ -37,6 +41,7 @@ class IniConfigLoader(bootsteps.Step):
     def __init__(self, worker, ini, **options):
         settings = get_appsettings(ini[0])
         configure(settings)
+        _check_worker_queues(worker.app, settings)
 
 
 app = Celery(__name__)
@@ -46,6 +51,37 @@ app.steps['worker'].add(IniConfigLoader)
 log = get_task_logger(__name__)
 
 
+# Subdirectory of ``studies.export.dir`` with reusable data files
+CACHE_DIR = 'cache'
+
+# Default queue of the subtasks of parallel exports (See `_fan_out_export`)
+MEMBER_QUEUE = 'export_members'
+
+# Supported ``studies.export.sendfile`` settings for export downloads
+SENDFILE_TYPES = (None, 'x-accel-redirect', 'x-sendfile')
+
+# Advisory lock that serializes `schedule_exports`
+SCHEDULE_LOCK = 0x6f636361
+
+# Number of seconds a cancellation flag is kept for running exports
+CANCEL_EXPIRE = 86400
+
+# Export files are named after their task id (with optional suffixes)
+EXPORT_FILE_PATTERN = re.compile(
+    r'^(?P<name>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})'
+    r'(\.parts|\.sqlite)?$')
+
+# Prebuilt codebook files (See `exports.get_codebook`)
+CODEBOOK_FILE_PATTERN = re.compile(r'^codebook-(?P<fingerprint>\w+)\.\w+$')
+
+
+# Supported ``studies.export.compression`` settings for export archives
+COMPRESSION_TYPES = {
+    'stored': ZIP_STORED,
+    'deflated': ZIP_DEFLATED,
+}
+
+
 def includeme(config):
     """
     Configures the Celery connection from the pyramid side of the application.
@@ -81,21 +117,115 @@ def configure(settings):
         settings['studies.export.expire'] = \
             int(settings['studies.export.expire'])
 
+    if 'studies.export.fetch_size' in settings:
+        settings['studies.export.fetch_size'] = \
+            int(settings['studies.export.fetch_size'])
+
+    compression = settings.get('studies.export.compression', 'deflated')
+    assert compression in COMPRESSION_TYPES, \
+        'Unsupported export compression: %s' % compression
+    settings['studies.export.compression'] = compression
+
+    settings['studies.export.parallel'] = \
+        asbool(settings.get('studies.export.parallel', False))
+
+    settings['studies.export.member_queue'] = \
+        settings.get('studies.export.member_queue') or MEMBER_QUEUE
+
+    if 'studies.export.snapshot_timeout' in settings:
+        settings['studies.export.snapshot_timeout'] = \
+            int(settings['studies.export.snapshot_timeout'])
+
+    if 'studies.export.compresslevel' in settings:
+        settings['studies.export.compresslevel'] = \
+            int(settings['studies.export.compresslevel'])
+
+    if 'studies.export.progress_interval' in settings:
+        settings['studies.export.progress_interval'] = \
+            float(settings['studies.export.progress_interval'])
+
+    if 'studies.export.progress_rows' in settings:
+        settings['studies.export.progress_rows'] = \
+            int(settings['studies.export.progress_rows'])
+
+    settings['studies.export.reuse'] = \
+        asbool(settings.get('studies.export.reuse', False))
+
+    sendfile = settings.get('studies.export.sendfile') or None
+    assert sendfile in SENDFILE_TYPES, \
+        'Unsupported export sendfile: %s' % sendfile
+    settings['studies.export.sendfile'] = sendfile
+
+    if 'studies.export.reap_batch' in settings:
+        settings['studies.export.reap_batch'] = \
+            int(settings['studies.export.reap_batch'])
+
+    if 'studies.export.reap_grace' in settings:
+        settings['studies.export.reap_grace'] = \
+            int(settings['studies.export.reap_grace'])
+
+    settings['studies.export.max_running'] = \
+        int(settings.get('studies.export.max_running', 4))
+
+    settings['studies.export.max_running_per_user'] = \
+        int(settings.get('studies.export.max_running_per_user', 1))
+
+    settings['studies.export.max_wait'] = \
+        int(settings.get('studies.export.max_wait', 3600))
+
+    # Unacknowledged export tasks are redelivered after this long,
+    # so it must be longer than the longest export
+    settings['celery.broker.visibility_timeout'] = \
+        int(settings.get('celery.broker.visibility_timeout', 43200))
+
+    # Crashed exports are redelivered after the visibility timeout, so only
+    # claims older than that (and then some) can have lost their task
+    settings['studies.export.claim_timeout'] = int(settings.get(
+        'studies.export.claim_timeout',
+        settings['celery.broker.visibility_timeout'] * 2))
+
     app.conf.update(
         broker_url=settings['celery.broker.url'],
         result_backend=settings['celery.backend.url'],
         broker_transport_options={
             'fanout_prefix': True,
-            'fanout_patterns': True
+            'fanout_patterns': True,
+            'visibility_timeout': settings['celery.broker.visibility_timeout'],
         },
         imports=aslist(settings.get('celery.include', [])),
-        beat_schedule=_get_schedule(settings)
+        beat_schedule=_get_schedule(settings),
+        task_routes={
+            'make_export_member': {
+                'queue': settings['studies.export.member_queue'],
+            },
+        },
     )
 
     # OCCAMS-specific settings
     app.conf.settings = settings
 
 
+def _check_worker_queues(app, settings):
+    """
+    Ensures a worker does not run both exports and their parallel subtasks
+
+    A parallel export holds its worker slot until all of its subtasks have
+    started (See `_fan_out_export`). If the same workers ran both, every
+    slot could be taken by exports waiting on subtasks that never start.
+    """
+    if not settings['studies.export.parallel']:
+        return
+
+    queues = set(app.amqp.queues.consume_from)
+    member_queue = settings['studies.export.member_queue']
+
+    if member_queue in queues and app.conf.task_default_queue in queues:
+        raise Exception(
+            'Parallel export subtasks must be run by dedicated workers, '
+            'start this worker with either "-Q {}" or "-X {}"'.format(
+                member_queue, member_queue))
+
+
 def _get_schedule(settings):
     """
     Schedule parser if configuration specifies celery-beat operations
@@ -151,6 +281,7 @@ def with_transaction(func):
     Function decoratator that commits on successul execution, aborts otherwise.
     Also releases connection to prevent leaked open connections.
     """
+    @functools.wraps(func)
     def decorated(*args, **kw):
         task, *_ = args
         userid = task.app.conf.settings['celery.blame']
@@ -224,23 +355,89 @@ class OccamsTask(Task):
         return self._redis
 
 
+class ExportCancelled(Exception):
+    """
+    Raised when an export was cancelled (deleted) while it was running
+    """
+
+
+def cancel_export(redis, export):
+    """
+    Flags a running export to stop at its next checkpoint
+
+    Revoking the task only prevents exports that have not started yet.
+
+    Parameters:
+    redis -- redis connection
+    export -- the export to cancel
+    """
+    redis.set(_cancel_key(export), 1, ex=CANCEL_EXPIRE)
+
+
+def _cancel_key(export):
+    return export.redis_key + ':cancel'
+
+
+def _check_cancelled(redis, export):
+    """
+    Raises `ExportCancelled` if the export has been cancelled
+    """
+    if redis.exists(_cancel_key(export)):
+        raise ExportCancelled(export.name)
+
+
+def _discard_export(redis, export):
+    """
+    Removes any files and progress of a cancelled export
+    """
+    for path in (export.path, export.path + '.sqlite'):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(_parts_dir(export), ignore_errors=True)
+    redis.delete(
+        export.redis_key, _cancel_key(export), _checkpoint_key(export))
+
+
+def _fail_export(task, name):
+    """
+    Marks the export as failed dispatches failure to listening applications.
+    """
+    dbsession = task.dbsession
+    redis = task.redis
+
+    export = dbsession.query(models.Export).filter_by(name=name).first()
+
+    if export is None:
+        # Deleted while it was running
+        return
+
+    export.status = u'failed'
+
+    redis.hset(export.redis_key, 'status', export.status)
+    redis.publish('export', json.dumps(redis.hgetall(export.redis_key)))
+
+
 @with_transaction
 def on_failure_make_export(self, exc, task_id, args, kwargs, einfo):
     """
     Error handler for `make_export` task.
     Marks the export as failed dispatches failure to listening applications.
     """
-    dbsession = self.dbsession
-    redis = self.redis
-
     log.error('Task {0} raised exception: {1!r}\n{2!r}'.format(
               task_id, exc, einfo))
+    _fail_export(self, task_id)
 
-    export = dbsession.query(models.Export).filter_by(name=task_id).one()
-    export.status = u'failed'
 
-    redis.hset(export.redis_key, 'status', export.status)
-    redis.publish('export', json.dumps(redis.hgetall(export.redis_key)))
+@with_transaction
+def on_failure_make_export_member(self, exc, task_id, args, kwargs, einfo):
+    """
+    Error handler for `make_export_member` and `assemble_export` tasks.
+    Marks the parent export as failed.
+    """
+    log.error('Task {0} raised exception: {1!r}\n{2!r}'.format(
+              task_id, exc, einfo))
+    name = kwargs['name'] if 'name' in kwargs else args[0]
+    _fail_export(self, name)
 
 
 @app.task(
@@ -248,6 +445,8 @@ def on_failure_make_export(self, exc, task_id, args, kwargs, einfo):
     base=OccamsTask,
     bind=True,
     ignore_result=True,
+    acks_late=True,
+    reject_on_worker_lost=True,
     on_failure=on_failure_make_export
 )
 @with_transaction
@@ -266,16 +465,54 @@ def make_export(self, name):
     owner_user -- the user who this export belongs to
     count -- the current number of files processed
     total -- the total number of files that will be processed
+    rows -- the current number of rows processed
+    total_rows -- the estimated number of rows that will be processed
     status -- current status of the export
 
+    Row progress is throttled, see `_ExportProgress`.
+
+    Exports are started by `schedule_exports`, which limits how many of
+    them run at the same time.
+
+    Data files are streamed directly into the archive, which is closed and
+    checkpointed after each one (See `_checkpoint_archive`). If the task is
+    redelivered (e.g. the worker crashed) it resumes after the last data
+    file that was completed. Note that resumed data files may come from
+    different snapshots of the database.
+
+    Deleting the export cancels the task at the next batch of rows
+    (See `cancel_export`).
+
+    If ``studies.export.parallel`` is enabled, each data file is generated
+    by its own `make_export_member` task (run by dedicated workers) and
+    `assemble_export` builds the final archive once they are all done.
+    See `_fan_out_export`. Since a zip archive can only be written by one
+    process, parallel exports stage their data files on disk first, which
+    needs up to twice the space and reads every data file again.
+
+    If ``studies.export.reuse`` is enabled, data files whose fingerprint
+    has not changed since a previous export are reused. See `_cache_plan`.
+
     Parameters:
     export_id -- export to process
     """
 
     redis = self.redis
     dbsession = self.dbsession
+    settings = self.app.conf.settings
 
-    export = dbsession.query(models.Export).filter_by(name=name).one()
+    export = dbsession.query(models.Export).filter_by(name=name).first()
+
+    if export is None:
+        log.info(f'Export {name} was deleted before it started')
+        return
+
+    exportables = exports.list_all(dbsession, redis=redis)
+
+    estimates = dict(
+        (item['name'], exports.estimate_rows(
+            _plan_query(exportables[item['name']], export)) or 0)
+        for item in export.contents)
 
     redis.hmset(export.redis_key, {
         'export_id': export.id,
@@ -283,33 +520,543 @@ def make_export(self, name):
         'status': export.status,
         'count': 0,
         'total': len(export.contents),
+        'rows': 0,
+        'total_rows': sum(estimates.values()),
     })
 
-    with ZipFile(export.path, mode='w', compression=ZIP_DEFLATED) as zfp:
-        exportables = exports.list_all(dbsession)
+    try:
+        if export.file_format == 'sqlite':
+            _make_sqlite_export(self, export, exportables, estimates)
+            return
+
+        if (settings.get('studies.export.parallel')
+                and len(export.contents) > 1
+                and dbsession.bind.dialect.name == 'postgresql'):
+            _fan_out_export(self, export, exportables)
+            return
+
+        completed = _resume_archive(redis, export)
 
         for item in export.contents:
+            _check_cancelled(redis, export)
             plan = exportables[item['name']]
+            progress = _ExportProgress(self, export, estimates[plan.name])
+            if plan.file_name in completed:
+                log.info(f'Resuming {export.name} after {plan.file_name}')
+            else:
+                with _open_archive(settings, export.path, mode='a') as zfp:
+                    _write_member(settings, zfp, plan, export, progress)
+                completed.append(plan.file_name)
+                _checkpoint_archive(redis, export, completed)
+            progress.complete(item['name'])
+
+        _check_cancelled(redis, export)
+
+        with _open_archive(settings, export.path, mode='a') as zfp:
+            _write_codebook(settings, zfp, dbsession, exportables)
+
+        redis.delete(_checkpoint_key(export))
+        _complete_export(redis, export)
+
+    except ExportCancelled:
+        log.info(f'Export {name} was cancelled')
+        _discard_export(redis, export)
+
+
+def _make_sqlite_export(task, export, exportables, estimates):
+    """
+    Writes the data files of the export as tables of a SQLite database.
+
+    The database (which includes the codebook) is the only member of the
+    export archive.
+    """
+    redis = task.redis
+    dbsession = task.dbsession
+    settings = task.app.conf.settings
+    fetch_size = settings.get('studies.export.fetch_size') or exports.FETCH_SIZE
+
+    codebook_rows = list(
+        exports.iter_codebook(dbsession, exportables.values()))
+
+    tables = defaultdict(list)
+    for row in codebook_rows:
+        tables[row['table']].append(row)
+
+    path = export.path + '.sqlite'
+
+    # The database is not resumable, start over if the task was redelivered
+    if os.path.exists(path):
+        os.remove(path)
+
+    try:
+        with exports.sqlite.open_database(path) as connection:
+            for item in export.contents:
+                _check_cancelled(redis, export)
+                plan = exportables[item['name']]
+                progress = _ExportProgress(task, export, estimates[plan.name])
+                exports.sqlite.write_table(
+                    connection, plan.name, _plan_query(plan, export),
+                    tables[plan.name], fetch_size, progress.add_rows)
+                progress.complete(item['name'])
+
+            exports.sqlite.write_codebook(connection, codebook_rows)
+
+        with _open_archive(settings, export.path) as zfp:
+            zfp.write(path, exports.sqlite.FILE_NAME)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+    _complete_export(redis, export)
+
+
+def _fan_out_export(task, export, exportables):
+    """
+    Dispatches each data file of the export to its own subtask.
+
+    All subtasks read from the snapshot of the current transaction
+    (via ``pg_export_snapshot()``) so that the data files agree with each
+    other. The snapshot only exists while this transaction is open, so we
+    wait until every subtask has imported it before returning.
+
+    Since this blocks the worker slot, subtasks are routed to the
+    ``studies.export.member_queue`` queue (``export_members`` by default),
+    which must be consumed by dedicated workers (e.g.
+    ``celery worker -Q export_members``). Subtasks never wait on other tasks,
+    so their workers always make progress. See `_check_worker_queues`.
+    """
+    redis = task.redis
+    dbsession = task.dbsession
+    settings = task.app.conf.settings
+    timeout = settings.get('studies.export.snapshot_timeout', 3600)
+
+    snapshot = dbsession.execute('SELECT pg_export_snapshot()').scalar()
+    snapshot_key = export.redis_key + ':snapshot'
+
+    os.makedirs(_parts_dir(export), exist_ok=True)
+
+    # The export only frees its slot once the archive is assembled
+    callback = assemble_export.s(name=export.name)
+    callback.link(schedule_exports.si())
+    callback.link_error(schedule_exports.si())
+
+    chord(
+        make_export_member.s(
+            export.name, item['name'], snapshot,
+            file_name=exportables[item['name']].file_name)
+        for item in export.contents
+    )(callback)
+
+    for item in export.contents:
+        if redis.blpop(snapshot_key, timeout=timeout) is None:
+            raise Exception(
+                'Timed out waiting for export subtasks to import snapshot')
+
+    redis.delete(snapshot_key)
+
+
+@app.task(
+    name='make_export_member',
+    base=OccamsTask,
+    bind=True,
+    acks_late=True,
+    reject_on_worker_lost=True,
+    on_failure=on_failure_make_export_member
+)
+@with_transaction
+def make_export_member(self, name, plan_name, snapshot=None, file_name=None):
+    """
+    Generates a single data file of a parallel export.
+
+    The data file is staged in the export's parts directory until
+    `assemble_export` adds it to the archive. A redelivered subtask
+    skips data files that were already staged.
+
+    The snapshot only exists until `_fan_out_export` returns, so a subtask
+    that is redelivered after that and has not staged its data file yet
+    fails the export.
+
+    Parameters:
+    name -- the export being processed
+    plan_name -- the data file to generate
+    snapshot -- (Optional) exported snapshot id to read data from
+    file_name -- (Optional) file name of the data file, used to check for
+                 a staged data file before the snapshot is imported
+    """
+    redis = self.redis
+    dbsession = self.dbsession
+    settings = self.app.conf.settings
+
+    if file_name and os.path.exists(_part_path(settings, name, file_name)):
+        log.info(f'Resuming {name} after {file_name}')
+        return file_name
+
+    if snapshot:
+        # Only allowed before the first query of the transaction
+        try:
+            dbsession.execute(
+                'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            dbsession.execute(
+                sa.text('SET TRANSACTION SNAPSHOT :snapshot'),
+                {'snapshot': snapshot})
+        except sa.exc.DBAPIError as e:
+            raise Exception(
+                f'Snapshot of export {name} is no longer available') from e
+
+    export = dbsession.query(models.Export).filter_by(name=name).one()
+
+    if snapshot:
+        redis.rpush(export.redis_key + ':snapshot', plan_name)
 
-            with tempfile.NamedTemporaryFile(mode='w') as tfp:
-                exports.write_data(tfp, plan.data(
-                    use_choice_labels=export.use_choice_labels,
-                    expand_collections=export.expand_collections))
-                zfp.write(tfp.name, plan.file_name)
+    _check_cancelled(redis, export)
 
-            redis.hincrby(export.redis_key, 'count')
-            data = redis.hgetall(export.redis_key)
-            redis.publish('export', json.dumps(data))
+    plan = exports.list_all(dbsession, redis=redis)[plan_name]
+    estimate = exports.estimate_rows(_plan_query(plan, export)) or 0
+    progress = _ExportProgress(self, export, estimate)
+    _write_part(settings, plan, export, progress)
+    progress.complete(plan_name)
 
-            count, total, name = data['count'], data['total'], item['name']
-            log.info(f'{count} of {total}: {name}')
+    return plan.file_name
 
-        with tempfile.NamedTemporaryFile(mode='w') as tfp:
-            codebook_chain = \
-                [p.codebook() for p in exportables.values()]
-            exports.write_codebook(tfp, chain.from_iterable(codebook_chain))
-            zfp.write(tfp.name, exports.codebook.FILE_NAME)
 
+@app.task(
+    name='assemble_export',
+    base=OccamsTask,
+    bind=True,
+    ignore_result=True,
+    on_failure=on_failure_make_export_member
+)
+@with_transaction
+def assemble_export(self, file_names, name):
+    """
+    Builds the archive of a parallel export from its staged data files.
+
+    Parameters:
+    file_names -- the staged data files (results of `make_export_member`)
+    name -- the export being processed
+    """
+    redis = self.redis
+    dbsession = self.dbsession
+    settings = self.app.conf.settings
+
+    export = dbsession.query(models.Export).filter_by(name=name).one()
+    exportables = exports.list_all(dbsession, redis=redis)
+    _assemble_archive(self, export, exportables, file_names)
+
+
+def _assemble_archive(task, export, exportables, file_names):
+    """
+    Builds the export archive from its staged data files and completes it
+    """
+    redis = task.redis
+    dbsession = task.dbsession
+    settings = task.app.conf.settings
+    parts_dir = _parts_dir(export)
+
+    _check_cancelled(redis, export)
+
+    with _open_archive(settings, export.path) as zfp:
+        for file_name in file_names:
+            zfp.write(os.path.join(parts_dir, file_name), file_name)
+
+        _write_codebook(settings, zfp, dbsession, exportables)
+
+    shutil.rmtree(parts_dir)
+
+    _complete_export(redis, export)
+
+
+def _open_archive(settings, path, mode='w'):
+    """
+    Opens the export archive for writing using the configured compression
+    """
+    compression = settings['studies.export.compression']
+    return ZipFile(
+        path,
+        mode=mode,
+        compression=COMPRESSION_TYPES[compression],
+        compresslevel=settings.get('studies.export.compresslevel'))
+
+
+def _checkpoint_key(export):
+    return export.redis_key + ':checkpoint'
+
+
+def _checkpoint_archive(redis, export, completed):
+    """
+    Records the data files that are complete in the (closed) export archive
+
+    Appending to the archive overwrites its central directory, so the
+    directory is recorded along with its offset.
+    """
+    with ZipFile(export.path) as zfp:
+        offset = zfp.start_dir
+
+    with open(export.path, 'rb') as fp:
+        fp.seek(offset)
+        directory = fp.read()
+
+    redis.hmset(_checkpoint_key(export), {
+        'offset': offset,
+        'directory': base64.b64encode(directory).decode('ascii'),
+        'members': json.dumps(completed),
+    })
+
+
+def _resume_archive(redis, export):
+    """
+    Restores the export archive to its last checkpoint
+
+    Any partially written data file is discarded by writing back the
+    central directory at the checkpoint and truncating the rest.
+    Without a (valid) checkpoint the archive is started over.
+
+    Returns:
+    The file names of the data files already in the archive
+    """
+    checkpoint = redis.hgetall(_checkpoint_key(export))
+    offset = int(checkpoint.get('offset') or 0)
+
+    if offset and os.path.exists(export.path) \
+            and os.path.getsize(export.path) >= offset:
+        with open(export.path, 'r+b') as fp:
+            fp.seek(offset)
+            fp.write(base64.b64decode(checkpoint['directory']))
+            fp.truncate()
+        return json.loads(checkpoint['members'])
+
+    if os.path.exists(export.path):
+        os.remove(export.path)
+
+    redis.delete(_checkpoint_key(export))
+    return []
+
+
+def _write_member(settings, zfp, plan, export, progress=None):
+    """
+    Writes the data file of a plan into the export archive
+    """
+    cached_path = _cache_plan(settings, plan, export, progress)
+
+    if cached_path:
+        zfp.write(cached_path, plan.file_name)
+    else:
+        with exports.open_member(zfp, plan.file_name) as fp:
+            _write_plan(settings, fp, plan, export, progress)
+
+
+def _parts_dir(export):
+    """
+    Staging directory for data files of parallel exports
+    """
+    return export.path + '.parts'
+
+
+def _part_path(settings, name, file_name):
+    """
+    Path of a staged data file, without having to query the export
+    """
+    return os.path.join(
+        settings['studies.export.dir'], name + '.parts', file_name)
+
+
+def _write_part(settings, plan, export, progress=None):
+    """
+    Stages the data file of a plan in the export's parts directory
+
+    Data files are only moved into place once they are complete, so that
+    existing data files can be skipped when the export is resumed.
+
+    Returns:
+    The path to the staged data file
+    """
+    path = os.path.join(_parts_dir(export), plan.file_name)
+
+    if os.path.exists(path):
+        log.info(f'Resuming {export.name} after {plan.file_name}')
+        return path
+
+    cached_path = _cache_plan(settings, plan, export, progress)
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4())
+
+    try:
+        if cached_path:
+            _link_or_copy(cached_path, tmp_path)
+        else:
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as fp:
+                _write_plan(settings, fp, plan, export, progress)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return path
+
+
+def _link_or_copy(source, destination):
+    """
+    Hard links a file if possible (i.e. same file system), copies it otherwise
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def _plan_query(plan, export):
+    """
+    Generates the data query of a plan using the export's options
+    """
+    return plan.data(
+        use_choice_labels=export.use_choice_labels,
+        expand_collections=export.expand_collections)
+
+
+def _write_plan(settings, fp, plan, export, progress=None):
+    """
+    Writes the data file of a plan using the export's options
+    """
+    exports.write_data(
+        fp,
+        _plan_query(plan, export),
+        fetch_size=settings.get('studies.export.fetch_size'),
+        use_copy=plan.is_copyable,
+        progress=progress.add_rows if progress else None)
+
+
+def _cache_plan(settings, plan, export, progress=None):
+    """
+    Looks up a previously generated data file of a plan by its fingerprint
+
+    If the data file has not been generated for the current fingerprint, it
+    is generated into the cache so that subsequent exports can reuse it.
+
+    Returns:
+    The path to the cached data file, or None if reuse is disabled
+    """
+    if not settings.get('studies.export.reuse'):
+        return None
+
+    fingerprint = plan.fingerprint(
+        use_choice_labels=export.use_choice_labels,
+        expand_collections=export.expand_collections)
+
+    if fingerprint is None:
+        return None
+
+    cache_dir = os.path.join(settings['studies.export.dir'], CACHE_DIR)
+    path = os.path.join(cache_dir, fingerprint + '.csv')
+
+    if os.path.exists(path):
+        log.info(f'Reusing {path} for {plan.name}')
+        # Mark it as recently used so that `reap_exports` keeps it
+        os.utime(path)
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Concurrent exports may generate the same file, so only publish it
+    # into the cache once it is complete
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4())
+    try:
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as fp:
+            _write_plan(settings, fp, plan, export, progress)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return path
+
+
+def _write_codebook(settings, zfp, dbsession, exportables):
+    """
+    Copies the prebuilt codebook of the export's catalog into the archive
+    """
+    fingerprint, path = exports.get_codebook(
+        dbsession, settings['studies.export.dir'], exportables.values())
+    zfp.write(path, exports.codebook.FILE_NAME)
+
+
+# Increments the progress counters of an export and broadcasts the result
+# in a single round trip (KEYS: export hash, ARGV: rows, files, channel)
+_PROGRESS_SCRIPT = """
+redis.call('HINCRBY', KEYS[1], 'rows', ARGV[1])
+redis.call('HINCRBY', KEYS[1], 'count', ARGV[2])
+local fields = redis.call('HGETALL', KEYS[1])
+local data = {}
+for i = 1, #fields, 2 do
+    data[fields[i]] = fields[i + 1]
+end
+redis.call('PUBLISH', ARGV[3], cjson.encode(data))
+return fields
+"""
+
+
+class _ExportProgress(object):
+    """
+    Broadcasts the progress of a data file of an export
+
+    The export is also checked for cancellation whenever rows are broadcast.
+
+    Rows are accumulated locally and only broadcast every
+    ``studies.export.progress_interval`` seconds or
+    ``studies.export.progress_rows`` rows, whichever comes first.
+    The counters live in the export's redis hash so that concurrent
+    subtasks of the same export can share them.
+    """
+
+    def __init__(self, task, export, estimate):
+        settings = task.app.conf.settings
+        self.redis = task.redis
+        self.export = export
+        self.estimate = estimate
+        self.interval = settings.get('studies.export.progress_interval', 2)
+        self.step = settings.get('studies.export.progress_rows', 10000)
+        self.script = task.redis.register_script(_PROGRESS_SCRIPT)
+        self.written = 0
+        self.pending = 0
+        self.published_at = time.monotonic()
+
+    def add_rows(self, rows):
+        """
+        Records rows written, broadcasting them if due
+        """
+        self.written += rows
+        self.pending += rows
+        if (self.pending >= self.step
+                or time.monotonic() - self.published_at >= self.interval):
+            _check_cancelled(self.redis, self.export)
+            self._publish()
+
+    def complete(self, item_name):
+        """
+        Broadcasts that the data file has been processed
+        """
+        # Account for the rest of the estimate so that the row progress
+        # matches the file progress (e.g. if the data file was reused)
+        self.pending += max(0, self.estimate - self.written)
+        fields = self._publish(files=1)
+        data = dict(zip(fields[::2], fields[1::2]))
+        count, total = data['count'], data['total']
+        log.info(f'{count} of {total}: {item_name}')
+
+    def _publish(self, files=0):
+        fields = self.script(
+            keys=[self.export.redis_key],
+            args=[self.pending, files, 'export'])
+        self.pending = 0
+        self.published_at = time.monotonic()
+        return fields
+
+
+def _complete_export(redis, export):
+    """
+    Marks the export as complete and broadcasts it
+
+    Queued exports identical to this one that were requested before it
+    started are completed with a copy of its file (See `schedule_exports`).
+    """
     export.status = 'complete'
     redis.hmset(export.redis_key, {
         'status': export.status,
@@ -317,20 +1064,341 @@ def make_export(self, name):
     })
     redis.publish('export', json.dumps(redis.hgetall(export.redis_key)))
 
+    if not export.fingerprint or not export.start_date:
+        return
+
+    dbsession = orm.object_session(export)
+
+    # Exports requested after this one started expect more recent data
+    followers = (
+        dbsession.query(models.Export)
+        .filter_by(status='pending', start_date=None)
+        .filter_by(fingerprint=export.fingerprint)
+        .filter(models.Export.create_date < export.start_date)
+        .filter(models.Export.id != export.id))
+
+    for follower in followers.all():
+        _link_or_copy(export.path, follower.path)
+        follower.start_date = sa.func.now()
+        follower.status = 'complete'
+        redis.hmset(follower.redis_key, {
+            'export_id': follower.id,
+            'owner_user': follower.owner_user.key,
+            'status': follower.status,
+            'count': len(follower.contents),
+            'total': len(follower.contents),
+            'file_size': humanize.naturalsize(export.file_size)
+        })
+        redis.publish('export', json.dumps(redis.hgetall(follower.redis_key)))
+        log.info(f'Coalesced {follower.name} onto {export.name}')
+
+
+@app.task(
+    name='schedule_exports',
+    base=OccamsTask,
+    bind=True,
+    ignore_result=True
+)
+def schedule_exports(self):
+    """
+    Starts queued exports while there are running slots available.
+
+    At most ``studies.export.max_running`` exports run at a time, and at most
+    ``studies.export.max_running_per_user`` per user (values below one
+    disable the limit). Smaller exports are started first, then older
+    exports. Exports queued for longer than ``studies.export.max_wait``
+    seconds are started before any others (oldest first), so that a steady
+    stream of small exports cannot hold back a large one forever.
+
+    Queued exports that are identical to a running export (i.e. same
+    fingerprint) which started after they were requested are not started,
+    they are completed with the running export's file instead
+    (See `_complete_export`).
+
+    Exports are claimed (their ``start_date`` is set) before their task is
+    sent. If the task cannot be sent the claim is released right away,
+    and claims older than ``studies.export.claim_timeout`` seconds (twice
+    the broker's visibility timeout by default) are assumed to have lost
+    their task (e.g. the message was lost) and are queued again.
+
+    This task is dispatched whenever an export is requested, finishes
+    or is deleted, and may also be scheduled with celery-beat in case
+    a notification was lost.
+    """
+    for name in _claim_exports(self):
+        try:
+            make_export.apply_async(
+                args=[name],
+                task_id=name,
+                link=schedule_exports.si(),
+                link_error=schedule_exports.si())
+        except Exception:
+            log.exception(f'Could not start export {name}')
+            _release_export(self, name)
+            raise
+
+
+@with_transaction
+def _release_export(task, name):
+    """
+    Queues a claimed export again
+    """
+    (task.dbsession.query(models.Export)
+        .filter_by(name=name, status='pending')
+        .update({'start_date': None}, synchronize_session=False))
+
+
+@with_transaction
+def _claim_exports(task):
+    """
+    Marks the queued exports that can be started as running
+
+    Returns:
+    The names of the exports to start
+    """
+    dbsession = task.dbsession
+    settings = task.app.conf.settings
+    max_running = settings.get('studies.export.max_running', 4)
+    max_per_user = settings.get('studies.export.max_running_per_user', 1)
+    claim_timeout = settings.get('studies.export.claim_timeout', 86400)
+    max_wait = settings.get('studies.export.max_wait', 3600)
+
+    if dbsession.bind.dialect.name == 'postgresql':
+        # Concurrent schedulers must not claim the same slots
+        dbsession.execute(
+            sa.text('SELECT pg_advisory_xact_lock(:key)'),
+            {'key': SCHEDULE_LOCK})
+
+    Export = models.Export
+
+    # Start date of the exports claimed now
+    now = dbsession.query(sa.cast(sa.func.now(), sa.DateTime)).scalar()
+
+    # The tasks of these exports were lost (a running task would have
+    # completed or been redelivered and completed by now)
+    stale = (
+        dbsession.query(Export)
+        .filter_by(status='pending')
+        .filter(Export.start_date
+                < sa.func.now() - timedelta(seconds=claim_timeout)))
+
+    for export in stale:
+        log.warning(f'Export {export.name} lost its task, queueing it again')
+        export.start_date = None
+
+    dbsession.flush()
+
+    running = (
+        dbsession.query(Export)
+        .filter_by(status='pending')
+        .filter(Export.start_date != sa.null())
+        .all())
+
+    # Exports that waited too long go first, regardless of their size
+    overdue = sa.case([(
+        Export.create_date < now - timedelta(seconds=max_wait),
+        Export.create_date)])
+
+    queued = (
+        dbsession.query(Export)
+        .filter_by(status='pending', start_date=None)
+        .order_by(
+            overdue.asc().nullslast(),
+            sa.func.jsonb_array_length(Export.contents).asc(),
+            Export.create_date.asc(),
+            Export.id.asc()))
+
+    per_user = defaultdict(int)
+    for export in running:
+        per_user[export.owner_user_id] += 1
+    total = len(running)
+
+    # Latest start date of the running exports by fingerprint
+    started = {}
+    for export in running:
+        if export.fingerprint:
+            started[export.fingerprint] = max(
+                export.start_date,
+                started.get(export.fingerprint, export.start_date))
+
+    claimed = []
+
+    for export in queued:
+        if 0 < max_running <= total:
+            break
+        if (export.fingerprint in started
+                and export.create_date < started[export.fingerprint]):
+            # Will be completed by the identical export
+            continue
+        if 0 < max_per_user <= per_user[export.owner_user_id]:
+            continue
+        export.start_date = now
+        per_user[export.owner_user_id] += 1
+        total += 1
+        if export.fingerprint:
+            started[export.fingerprint] = now
+        claimed.append(export.name)
+
+    return claimed
+
+
+@app.task(name='reap_exports', base=OccamsTask, ignore_result=True, bind=True)
+def reap_exports(self):
+    """
+    Removes expired exports and files left behind in the export directory
+
+    Meant to be scheduled with celery-beat, for example::
+
+        celery.beat = reaper
+        celery.beat.reaper.task = reap_exports
+        celery.beat.reaper.schedule = timedelta
+        celery.beat.reaper.schedule.hours = 1
+
+    Exports that have not been modified in ``studies.export.expire`` days
+    are deleted ``studies.export.reap_batch`` rows at a time, along with
+    their files. Reusable data files that have not been used in as long
+    are also removed.
+
+    Files not modified in ``studies.export.reap_grace`` seconds are
+    considered abandoned if they are:
+    * temporary files
+    * files of exports that no longer exist (e.g. deleted while running)
+    * codebooks other than the one of the current catalog
+
+    Returns:
+    The number of bytes reclaimed
+    """
+    settings = self.app.conf.settings
+    export_dir = settings['studies.export.dir']
+    expire = settings.get('studies.export.expire') or 0
+    batch_size = settings.get('studies.export.reap_batch', 1000)
+    grace = settings.get('studies.export.reap_grace', 3600)
+    now = time.time()
+
+    reclaimed = 0
+    expired = 0
+
+    if expire > 0:
+        while True:
+            names = _delete_expired_exports(self, expire, batch_size)
+            for name in names:
+                for suffix in ('', '.parts', '.sqlite'):
+                    path = os.path.join(export_dir, name + suffix)
+                    reclaimed += _remove_path(path)
+                key = models.Export.__tablename__ + ':' + name
+                self.redis.delete(key, key + ':checkpoint')
+            expired += len(names)
+            if len(names) < batch_size:
+                break
+
+        cache_dir = os.path.join(export_dir, CACHE_DIR)
+        if os.path.isdir(cache_dir):
+            for entry in os.scandir(cache_dir):
+                age = now - entry.stat().st_mtime
+                if (entry.name.endswith('.tmp') and age > grace
+                        or age > expire * 86400):
+                    reclaimed += _remove_path(entry.path)
+
+    entries = list(os.scandir(export_dir))
+    existing = _query_export_names(self)
+    keep = _current_codebook_fingerprint(self)
+
+    for entry in entries:
+        if now - entry.stat().st_mtime <= grace:
+            continue
+        export_match = EXPORT_FILE_PATTERN.match(entry.name)
+        codebook_match = CODEBOOK_FILE_PATTERN.match(entry.name)
+        if (entry.name.endswith('.tmp')
+                or export_match and export_match.group(1) not in existing
+                or codebook_match and codebook_match.group(1) != keep):
+            reclaimed += _remove_path(entry.path)
+
+    log.info('Reaped {} expired exports, reclaimed {}'.format(
+        expired, humanize.naturalsize(reclaimed)))
+
+    return reclaimed
+
+
+@with_transaction
+def _delete_expired_exports(task, expire, batch_size):
+    """
+    Deletes a batch of exports not modified in the specified number of days
+
+    Returns:
+    The names of the deleted exports
+    """
+    dbsession = task.dbsession
+    cutoff = sa.func.now() - timedelta(expire)
+
+    rows = (
+        dbsession.query(models.Export.id, models.Export.name)
+        .filter(models.Export.modify_date < cutoff)
+        .order_by(models.Export.id)
+        .limit(batch_size)
+        .all())
+
+    if not rows:
+        return []
+
+    (dbsession.query(models.Export)
+        .filter(models.Export.id.in_([r.id for r in rows]))
+        .delete(synchronize_session=False))
+
+    return [r.name for r in rows]
+
+
+@with_transaction
+def _query_export_names(task):
+    """
+    Returns the names of all current exports
+    """
+    query = task.dbsession.query(models.Export.name)
+    return set(name for name, in query)
+
+
+@with_transaction
+def _current_codebook_fingerprint(task):
+    """
+    Returns the fingerprint of the codebook of the current catalog
+    """
+    exportables = exports.list_all(task.dbsession, redis=task.redis)
+    return exports.codebook_fingerprint(exportables.values())
+
+
+def _remove_path(path):
+    """
+    Removes a file or directory if it exists
+
+    Returns:
+    The number of bytes removed
+    """
+    if os.path.isdir(path):
+        size = sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, dirs, files in os.walk(path)
+            for f in files)
+        shutil.rmtree(path, ignore_errors=True)
+        return size
+    elif os.path.exists(path):
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    return 0
+
 
 @app.task(name='make_codebook', base=OccamsTask, ignore_result=True, bind=True)
 def make_codebook(self):
     """
     Creates a coodebook file that is ready to be served on demand by the web app
+
+    The codebook is only rebuilt if the catalog has changed since it was
+    last built. See `exports.get_codebook`.
     """
     dbsession = self.dbsession
     export_dir= self.app.conf.settings['studies.export.dir']
     try:
-        codebook_chain = \
-            [p.codebook() for p in exports.list_all(dbsession).values()]
-        path = os.path.join(export_dir, exports.codebook.FILE_NAME)
-        with open(path, 'w') as fp:
-            exports.write_codebook(fp, chain.from_iterable(codebook_chain))
+        exportables = exports.list_all(dbsession, redis=self.redis)
+        exports.get_codebook(dbsession, export_dir, exportables.values())
     except Exception as exc:
         # Need to keep retrying (default is every 3 min)
         self.retry(exc=exc)
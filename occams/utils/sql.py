@@ -82,6 +82,21 @@ def to_datetime_pg(element, compiler, **kw):
     return 'CAST(%s AS TIMESTAMP)' % compiler.process(element.clauses)
 
 
+class with_ordinality(FunctionElement):
+    """
+    Numbers the rows of a set-returning function in an ``ordinality`` column
+    (PostgreSQL only)
+    Parameters:
+    function -- The set-returning function
+    """
+    name = 'with_ordinality'
+
+
+@compiles(with_ordinality, 'postgresql')
+def with_ordinality_pg(element, compiler, **kw):
+    return '%s WITH ORDINALITY' % compiler.process(element.clauses, **kw)
+
+
 class JSON(TypeDecorator):
     """
     Represents an immutable structure as a json-encoded string.
@@ -259,6 +259,7 @@ def terminate_ajax(context, request):
 
     return render_form(
         form,
+        redis=request.redis,
         cancel_url=request.current_route_path(_route_name='studies.patient'),
         attr={
             'method': 'POST',
@@ -330,7 +331,7 @@ def _make_challenge_form(context, request):
     renderer='../templates/enrollment/randomize-print.pt')
 def randomize_print(context, request):
     form = _get_randomized_form(context, request)
-    return {'form': render_form(form, disabled=True)}
+    return {'form': render_form(form, disabled=True, redis=request.redis)}
 
 
 @view_config(
@@ -555,6 +556,7 @@ def randomize_ajax(context, request):
             'request': request,
             'form': render_form(
                 form,
+                redis=request.redis,
                 disabled=enrollment.is_randomized,
                 show_footer=False,
                 attr={
@@ -202,7 +202,7 @@ def markup_ajax(context, request):
         data = None
     Form = make_form(dbsession, schema, show_metadata=False)
     form = Form(request.POST, data=data)
-    return render_form(form)
+    return render_form(form, redis=request.redis)
 
 
 @view_config(
@@ -54,7 +54,8 @@ def checkout(context, request):
     isn't left with an unresponsive page.
     """
     dbsession = request.dbsession
-    exportables = exports.list_all(request.dbsession, include_rand=False)
+    exportables = exports.list_all(
+        request.dbsession, include_rand=False, redis=request.redis)
     limit = request.registry.settings.get('app.export.limit')
     exceeded = limit is not None and query_exports(request).count() > limit
     errors = {}
@@ -73,35 +74,47 @@ def checkout(context, request):
                     wtforms.validators.InputRequired()])
             expand_collections = wtforms.BooleanField(default=False)
             use_choice_labels = wtforms.BooleanField(default=False)
+            file_format = wtforms.RadioField(
+                choices=[('csv', 'CSV'), ('sqlite', 'SQLite')],
+                default='csv')
 
         form = CheckoutForm(request.POST)
 
         if not form.validate():
             errors = wtferrors(form)
         else:
-            task_id = str(uuid.uuid4())
-            dbsession.add(models.Export(
-                name=task_id,
+            contents = [exportables[k].to_json() for k in form.contents.data]
+            fingerprint = models.Export.make_fingerprint(
+                contents,
                 expand_collections=form.expand_collections.data,
                 use_choice_labels=form.use_choice_labels.data,
-                owner_user=(dbsession.query(models.User)
-                            .filter_by(key=request.authenticated_userid)
-                            .one()),
-                contents=[exportables[k].to_json() for k in form.contents.data]
-            ))
-
-            def apply_after_commit(success):
-                if success:
-                    tasks.make_export.apply_async(
-                        args=[task_id],
-                        task_id=task_id,
-                        countdown=4)
-
-            # Avoid race-condition by executing the task after succesful commit
-            transaction.get().addAfterCommitHook(apply_after_commit)
-
-            msg = _(u'Your request has been received!')
-            request.session.flash(msg, 'success')
+                file_format=form.file_format.data)
+
+            duplicate = (
+                query_exports(request)
+                .filter_by(status=u'pending', fingerprint=fingerprint)
+                .first())
+
+            if duplicate is not None:
+                msg = _(u'An identical export has already been requested')
+                request.session.flash(msg, 'info')
+            else:
+                dbsession.add(models.Export(
+                    name=str(uuid.uuid4()),
+                    expand_collections=form.expand_collections.data,
+                    use_choice_labels=form.use_choice_labels.data,
+                    file_format=form.file_format.data,
+                    fingerprint=fingerprint,
+                    owner_user=(dbsession.query(models.User)
+                                .filter_by(key=request.authenticated_userid)
+                                .one()),
+                    contents=contents
+                ))
+
+                schedule_on_commit(request)
+
+                msg = _(u'Your request has been received!')
+                request.session.flash(msg, 'success')
 
             next_url = request.route_path('studies.exports_status')
             return HTTPFound(location=next_url)
@@ -114,6 +127,37 @@ def checkout(context, request):
     }
 
 
+def schedule_on_commit(request):
+    """
+    Starts queued exports once the current transaction commits
+
+    Should be used by views that add or remove exports so that their
+    running slots are updated (See `tasks.schedule_exports`).
+    """
+    def apply_after_commit(success):
+        if success:
+            tasks.schedule_exports.apply_async()
+
+    # Avoid race-condition by executing the task after succesful commit
+    transaction.get().addAfterCommitHook(apply_after_commit)
+
+
+def invalidate_catalog_on_commit(request):
+    """
+    Discards the cached export catalog once the current transaction commits
+
+    Should be used by views that publish/retract schemata or add
+    randomization data. The codebook is also rebuilt for the new catalog.
+    """
+    def apply_after_commit(success):
+        if success:
+            exports.invalidate_catalog(request.redis)
+            # Rebuild the codebook for the new catalog
+            tasks.make_codebook.apply_async()
+
+    transaction.get().addAfterCommitHook(apply_after_commit)
+
+
 @view_config(
     route_name='studies.exports_codebook',
     permission='view',
@@ -123,7 +167,8 @@ def codebook(context, request):
     Codebook viewer
     """
     dbsession = request.dbsession
-    return {'exportables': exports.list_all(dbsession).values()}
+    exportables = exports.list_all(dbsession, redis=request.redis)
+    return {'exportables': exportables.values()}
 
 
 @view_config(
@@ -134,24 +179,25 @@ def codebook(context, request):
 def codebook_json(context, request):
     """
     Loads codebook rows for the specified data file
+
+    Rows are served from the prebuilt codebook, and can be cached by the
+    client until the codebook changes.
     """
     dbsession = request.dbsession
+    export_dir = request.registry.settings['studies.export.dir']
 
-    def massage(row):
-        publish_date = row['publish_date']
-        if publish_date:
-            row['publish_date'] = publish_date.isoformat()
-        return row
-
-    exportables = exports.list_all(dbsession)
+    exportables = exports.list_all(dbsession, redis=request.redis)
 
     file = request.GET.get('file')
 
     if file not in exportables:
         raise HTTPBadRequest(u'File specified does not exist')
 
-    plan = exportables[file]
-    return [massage(row) for row in plan.codebook()]
+    fingerprint, path = exports.get_codebook(
+        dbsession, export_dir, exportables.values())
+    request.response.etag = '{}-{}'.format(fingerprint, file)
+    request.response.conditional_response = True
+    return exports.read_codebook(export_dir, fingerprint)[file]
 
 
 @view_config(
@@ -162,14 +208,18 @@ def codebook_download(context, request):
     """
     Returns full codebook file
     """
+    dbsession = request.dbsession
     export_dir = request.registry.settings['studies.export.dir']
     codebook_name = exports.codebook.FILE_NAME
-    path = os.path.join(export_dir, codebook_name)
-    if not os.path.isfile(path):
-        log.warn('Trying to download codebook before it\'s pre-cooked!')
-        raise HTTPBadRequest(u'Codebook file is not ready yet')
-    response = FileResponse(path)
+
+    exportables = exports.list_all(dbsession, redis=request.redis)
+    fingerprint, path = exports.get_codebook(
+        dbsession, export_dir, exportables.values())
+
+    response = FileResponse(path, request=request)
     response.content_disposition = 'attachment;filename=%s' % codebook_name
+    response.etag = fingerprint
+    response.conditional_response = True
     return response
 
 
@@ -224,11 +274,15 @@ def status_json(context, request):
                 count, 'occams', mapping={'count': count}),
             'name': export.name,
             'status': export.status,
+            'queued': export.status == 'pending' and not export.start_date,
             'use_choice_labels': export.use_choice_labels,
             'expand_collections': export.expand_collections,
+            'file_format': export.file_format,
             'contents': sorted(export.contents, key=lambda v: v['title']),
             'count': data.get('count'),
             'total': data.get('total'),
+            'rows': data.get('rows'),
+            'total_rows': data.get('total_rows'),
             'file_size': (naturalsize(export.file_size)
                           if export.file_size else None),
             'download_url': request.route_path('studies.export_download',
@@ -307,7 +361,11 @@ def delete_json(context, request):
     export = context
     dbsession.delete(export)
     dbsession.flush()
+    # Revoking only prevents the export from starting, a running export
+    # needs to be told to stop
     tasks.app.control.revoke(export.name)
+    tasks.cancel_export(request.redis, export)
+    schedule_on_commit(request)
     return HTTPOk()
 
 
@@ -319,16 +377,41 @@ def download(context, request):
     Returns specific download attachement
 
     The user should only be allowed to download their exports.
+
+    Downloads support conditional and range requests so that broken
+    transfers can be resumed. If ``studies.export.sendfile`` is configured,
+    the file is streamed by the fronting web server instead:
+
+    x-accel-redirect -- nginx serves the file from the internal location
+                        ``studies.export.sendfile_prefix``
+    x-sendfile -- the web server (e.g. Apache mod_xsendfile) serves the file
+                  from its path on disk
     """
     export = context
 
     if export.status != 'complete':
         raise HTTPBadRequest('Export is not complete')
 
-    export_dir = request.registry.settings['studies.export.dir']
+    settings = request.registry.settings
+    export_dir = settings['studies.export.dir']
     path = os.path.join(export_dir, export.name)
-
-    response = FileResponse(path)
+    sendfile = settings.get('studies.export.sendfile')
+
+    if sendfile == 'x-accel-redirect':
+        prefix = settings.get('studies.export.sendfile_prefix', '/exports/')
+        response = request.response
+        response.headers['X-Accel-Redirect'] = \
+            prefix.rstrip('/') + '/' + export.name
+    elif sendfile == 'x-sendfile':
+        response = request.response
+        response.headers['X-Sendfile'] = path
+    else:
+        response = FileResponse(path, request=request)
+        response.etag = '{}-{}'.format(export.name, os.path.getsize(path))
+        response.accept_ranges = 'bytes'
+        response.conditional_response = True
+
+    response.content_type = 'application/zip'
     response.content_disposition = 'attachment;filename=export.zip'
     return response
 
@@ -596,6 +596,7 @@ def form(context, request):
         'patient': view_json(patient, request),
         'form': render_form(
             form,
+            redis=request.redis,
             disabled=not request.has_permission('edit'),
             cancel_url=previous_url,
             attr={
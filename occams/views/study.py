@@ -16,6 +16,7 @@ from zope.sqlalchemy import mark_changed
 
 from .. import _, models
 from . import cycle as cycle_views
+from .export import invalidate_catalog_on_commit
 from ..utils.forms import Form, wtferrors, ModelField
 from ..utils.pagination import Pagination
 from ..renderers import form2json, version2json
@@ -926,6 +927,8 @@ def upload_randomization_json(context, request):
                 u'The submitted file contains existing reference numbers. '
                 u'Please upload a file with new reference numbers.'))
 
+    invalidate_catalog_on_commit(request)
+
     return HTTPOk()
 
 
@@ -97,6 +97,7 @@ def search_view(context, request):
             return {
                 'form': render_form(
                     form,
+                    redis=request.redis,
                     attr={
                         'method': 'POST',
                         'action': request.current_route_path(),
@@ -18,6 +18,7 @@ from .. import _, models
 from ..utils.forms import Form
 from ..renderers import make_form, render_form, apply_data
 from . import field as field_views
+from .export import invalidate_catalog_on_commit
 
 
 @view_config(
@@ -104,6 +105,7 @@ def preview(context, request):
         'form_id': form_id,
         'form_content': render_form(
             form,
+            redis=request.redis,
             cancel_url=request.current_route_path(),
             attr={
                 'id': form_id,
@@ -175,6 +177,8 @@ def publish_json(context, request):
 
     dbsession.flush()
 
+    invalidate_catalog_on_commit(request)
+
     return view_json(context, request)
 
 
@@ -266,6 +270,7 @@ def delete_json(context, request):
     dbsession.delete(context)
 
     if context.publish_date:
+        invalidate_catalog_on_commit(request)
         msg = _(u'Successfully deleted ${name} version ${version}',
                 mapping={'name': context.name,
                          'version': context.publish_date})
@@ -348,6 +348,7 @@ def form(context, request):
         'visit': view_json(visit, request),
         'form': render_form(
             form,
+            redis=request.redis,
             disabled=not request.has_permission('edit'),
             cancel_url=request.current_route_path(_route_name='studies.visit'),
             attr={
@@ -178,6 +178,9 @@ def req(dbsession):
     dummy_request.dbsession = dbsession
     dbsession.info['request'] = dummy_request
 
+    # No shared cache unless a test specifically mocks one
+    dummy_request.redis = None
+
     return dummy_request
 
 
@@ -22,6 +22,93 @@ class TestWriteData:
         assert sorted(['anumeric', 'astring']) == sorted(rows[0])
         assert sorted(['420', '¿Qué pasa?']) == sorted(rows[1])
 
+    def test_fetch_size(self, dbsession):
+        """
+        It should write every row regardless of the fetch size
+        """
+        from contextlib import closing
+        import io
+        from sqlalchemy import func
+        from occams import exports
+
+        query = dbsession.query(func.generate_series(1, 7).label('num'))
+
+        with closing(io.StringIO()) as fp:
+            count = exports.write_data(fp, query, fetch_size=3)
+            fp.seek(0)
+            rows = [r for r in exports.csv.reader(fp)]
+
+        assert rows[0] == ['num']
+        assert [r[0] for r in rows[1:]] == [str(i) for i in range(1, 8)]
+        assert count == 7
+
+    def test_progress(self, dbsession):
+        """
+        It should report the rows written as they are written
+        """
+        from contextlib import closing
+        import io
+        from sqlalchemy import func
+        from occams import exports
+
+        query = dbsession.query(func.generate_series(1, 7).label('num'))
+        reported = []
+
+        with closing(io.StringIO()) as fp:
+            exports.write_data(
+                fp, query, fetch_size=3, progress=reported.append)
+
+        assert reported == [3, 3, 1]
+
+    def test_estimate_rows(self, dbsession):
+        """
+        It should estimate the number of rows from the query plan
+        """
+        from sqlalchemy import func
+        from occams import exports
+
+        query = dbsession.query(func.generate_series(1, 7).label('num'))
+
+        assert exports.estimate_rows(query) > 0
+
+    def test_copy(self, dbsession):
+        """
+        It should generate the same contents when using COPY
+        """
+        from contextlib import closing
+        import io
+        from sqlalchemy import func, literal_column, Boolean, Integer, Unicode
+        from occams import exports
+
+        query = (
+            dbsession.query(
+                literal_column(u"'420'", Integer).label('anumeric'),
+                literal_column(u"'¿Qué pasa?'", Unicode).label('aunicode'),
+                literal_column(u"'100%'", Unicode).label('apercent'),
+                literal_column(u"NULL", Unicode).label('anull'),
+                literal_column(
+                    u"CASE n WHEN 1 THEN TRUE WHEN 2 THEN FALSE END",
+                    Boolean).label('abool'),
+                literal_column(
+                    u"CASE n WHEN 1 THEN E'multi\\nline' "
+                    u"WHEN 2 THEN '\"quoted\"' ELSE '' END",
+                    Unicode).label('astring'),
+                )
+            .select_from(func.generate_series(1, 3).alias('n'))
+            .order_by(literal_column('n')))
+
+        def dump(use_copy):
+            with closing(io.StringIO(newline='')) as fp:
+                exports.write_data(fp, query, use_copy=use_copy)
+                return fp.getvalue()
+
+        contents = dump(use_copy=False)
+
+        assert dump(use_copy=True) == contents
+        assert 'True' in contents
+        assert 'False' in contents
+        assert '"multi\nline"' in contents
+
 
 class TestDumpCodeBook:
 
@@ -39,3 +126,30 @@ class TestDumpCodeBook:
             fieldnames = exports.csv.DictReader(fp).fieldnames
 
         assert sorted(fieldnames) == sorted(exports.codebook.HEADER)
+
+
+class TestOpenMember:
+
+    def test_write_data(self, dbsession):
+        """
+        It should write data files directly into a zip archive
+        """
+        import io
+        from zipfile import ZipFile
+        from sqlalchemy import literal_column, Unicode
+        from occams import exports
+
+        query = dbsession.query(
+            literal_column(u"'¿Qué pasa?'", Unicode).label('astring'))
+
+        buffer = io.BytesIO()
+
+        with ZipFile(buffer, mode='w') as zfp:
+            with exports.open_member(zfp, 'data.csv') as fp:
+                exports.write_data(fp, query)
+
+        with ZipFile(buffer) as zfp:
+            contents = zfp.read('data.csv').decode('utf-8')
+
+        rows = list(exports.csv.reader(io.StringIO(contents)))
+        assert rows == [['astring'], ['¿Qué pasa?']]
@@ -86,6 +86,74 @@ class TestPidPlan:
         data = query.one()._asdict()
         assert data['med_num'] == '999'
 
+    def test_data_since(self, dbsession):
+        """
+        It should only include patients modified since the given timestamp
+        """
+        from datetime import timedelta
+        from occams import models
+        plan = self._create_one(dbsession)
+
+        patient = models.Patient(
+            pid=u'xxx-xxx',
+            site=models.Site(name=u'someplace', title=u'Some Place')
+        )
+
+        dbsession.add(patient)
+        dbsession.flush()
+
+        since = patient.modify_date - timedelta(seconds=1)
+        assert plan.data(since=since).one().pid == patient.pid
+
+        since = patient.modify_date + timedelta(seconds=1)
+        assert plan.data(since=since).count() == 0
+
+    def test_fingerprint(self, dbsession):
+        """
+        It should only change the fingerprint when the data file changes
+        """
+        from occams import models
+        plan = self._create_one(dbsession)
+
+        patient = models.Patient(
+            pid=u'xxx-xxx',
+            site=models.Site(name=u'someplace', title=u'Some Place')
+        )
+
+        dbsession.add(patient)
+        dbsession.flush()
+
+        fingerprint = plan.fingerprint()
+        assert fingerprint == plan.fingerprint()
+        assert fingerprint != plan.fingerprint(use_choice_labels=True)
+
+        dbsession.add(models.Patient(pid=u'yyy-yyy', site=patient.site))
+        dbsession.flush()
+
+        assert fingerprint != plan.fingerprint()
+
+    def test_fingerprint_related(self, dbsession):
+        """
+        It should change the fingerprint when joined tables change
+        """
+        from occams import models
+        plan = self._create_one(dbsession)
+
+        patient = models.Patient(
+            pid=u'xxx-xxx',
+            site=models.Site(name=u'someplace', title=u'Some Place')
+        )
+
+        dbsession.add(patient)
+        dbsession.flush()
+
+        fingerprint = plan.fingerprint()
+
+        patient.site = models.Site(name=u'otherplace', title=u'Other Place')
+        dbsession.flush()
+
+        assert fingerprint != plan.fingerprint()
+
     @pytest.mark.parametrize('study_code', [u'ET', u'LTW', u'CVCT'])
     def test_data_with_early_test(self, dbsession, study_code):
         """
@@ -78,6 +78,72 @@ class TestSchemaPlan:
         plans = SchemaPlan.list_all(dbsession, include_rand=False)
         assert len(plans) == 0
 
+    def test_list_all_cached(self, dbsession):
+        """
+        It should reuse the cached catalog until it is invalidated
+        """
+        from datetime import date
+        import mock
+        from occams import models
+        from occams.exports.schema import SchemaPlan, invalidate_catalog
+
+        cache = {}
+        redis = mock.Mock(
+            get=cache.get,
+            set=lambda key, value, ex=None: cache.__setitem__(key, value),
+            delete=lambda key: cache.pop(key, None))
+
+        dbsession.add(models.Schema(
+            name=u'vitals', title=u'Vitals', publish_date=date.today()))
+        dbsession.flush()
+
+        plans = SchemaPlan.list_all(dbsession, redis=redis)
+        assert [p.name for p in plans] == ['vitals']
+
+        dbsession.add(models.Schema(
+            name=u'contact', title=u'Contact', publish_date=date.today()))
+        dbsession.flush()
+
+        plans = SchemaPlan.list_all(dbsession, redis=redis)
+        assert [p.name for p in plans] == ['vitals']
+
+        invalidate_catalog(redis)
+
+        plans = SchemaPlan.list_all(dbsession, redis=redis)
+        assert [p.name for p in plans] == ['contact', 'vitals']
+        assert plans[1].versions == [date.today()]
+
+    def test_bulk_codebook(self, dbsession):
+        """
+        It should generate the same codebooks as the individual plans
+        """
+        from datetime import date, timedelta
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        for name, versions in [(u'vitals', 2), (u'contact', 1)]:
+            for days in range(versions):
+                dbsession.add(models.Schema(
+                    name=name,
+                    title=name.title(),
+                    publish_date=date.today() - timedelta(days),
+                    attributes={
+                        'foo': models.Attribute(
+                            name='foo',
+                            title=u'Foo',
+                            type='choice',
+                            order=0,
+                            choices={
+                                '001': models.Choice(
+                                    name='001', title=u'Yes', order=0),
+                                '002': models.Choice(
+                                    name='002', title=u'No', order=1)})}))
+        dbsession.flush()
+
+        plans = SchemaPlan.list_all(dbsession)
+        expected = [row for plan in plans for row in plan.codebook()]
+        assert list(SchemaPlan.bulk_codebook(dbsession, plans)) == expected
+
     def test_patient(self, dbsession):
         """
         It should add patient-specific metadata to the report
@@ -314,3 +380,41 @@ class TestSchemaPlan:
         assert record.block_number == stratum.block_number
         assert record.arm_name == stratum.arm.title
         assert record.randid == stratum.randid
+
+    def test_context_per_entity(self, dbsession):
+        """
+        It should only attach each entity's own context metadata
+        """
+        from datetime import date
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        schema = models.Schema(
+            name=u'contact',
+            title=u'Contact Details',
+            publish_date=date.today(),
+            attributes={
+                'foo': models.Attribute(
+                    name='foo',
+                    title=u'',
+                    type='string',
+                    order=0,
+                )})
+        site = models.Site(name='ucsd', title=u'UCSD')
+        entity1 = models.Entity(schema=schema, collect_date=date.today())
+        entity2 = models.Entity(schema=schema, collect_date=date.today())
+        entity3 = models.Entity(schema=schema, collect_date=date.today())
+        patient1 = models.Patient(site=site, pid=u'11111', entities=[entity1])
+        patient2 = models.Patient(site=site, pid=u'22222', entities=[entity2])
+        dbsession.add_all([schema, entity1, entity2, entity3,
+                           patient1, patient2])
+        dbsession.flush()
+
+        plan = SchemaPlan.from_schema(dbsession, schema.name)
+        records = plan.data().all()
+        assert [r.id for r in records] == \
+            sorted([entity1.id, entity2.id, entity3.id])
+        pids = dict((r.id, r.pid) for r in records)
+        assert pids[entity1.id] == patient1.pid
+        assert pids[entity2.id] == patient2.pid
+        assert pids[entity3.id] is None
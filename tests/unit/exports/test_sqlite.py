@@ -0,0 +1,56 @@
+class TestWriteTable:
+
+    def test_typed_columns(self, dbsession, tmpdir):
+        """
+        It should type columns based on the codebook
+        """
+        import sqlite3
+        from sqlalchemy import func, literal_column, Unicode
+        from occams.exports import sqlite
+        from occams.exports.codebook import row, types
+
+        query = dbsession.query(
+            func.generate_series(1, 7).label('id'),
+            literal_column(u"'007'", Unicode).label('code'))
+        rows = [
+            row('id', 'aform', types.NUMBER, decimal_places=0),
+            row('code', 'aform', types.CHOICE)]
+        path = str(tmpdir.join('test.sqlite'))
+
+        with sqlite.open_database(path) as connection:
+            count = sqlite.write_table(connection, 'aform', query, rows, 3)
+
+        assert count == 7
+
+        connection = sqlite3.connect(path)
+        records = connection.execute(
+            'SELECT id, code FROM aform ORDER BY id').fetchall()
+        assert records[0] == (1, '007')
+        assert len(records) == 7
+        indexes = [r[1] for r in connection.execute(
+            "PRAGMA index_list('aform')")]
+        assert indexes == ['ix_aform_id']
+        connection.close()
+
+
+class TestWriteCodebook:
+
+    def test_codebook(self, tmpdir):
+        """
+        It should write the codebook as a table
+        """
+        import sqlite3
+        from occams.exports import sqlite
+        from occams.exports.codebook import row, types
+
+        rows = [row('foo', 'aform', types.CHOICE, choices=[('1', 'Yes')])]
+        path = str(tmpdir.join('test.sqlite'))
+
+        with sqlite.open_database(path) as connection:
+            sqlite.write_codebook(connection, rows)
+
+        connection = sqlite3.connect(path)
+        records = connection.execute(
+            'SELECT "table", field, choices FROM codebook').fetchall()
+        assert records == [('aform', 'foo', '1=Yes')]
+        connection.close()
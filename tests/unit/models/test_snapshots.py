@@ -0,0 +1,59 @@
+"""
+Tests for published schema snapshots
+"""
+
+import pytest
+
+
+def test_draft(dbsession):
+    """
+    It should not snapshot drafts, since they can still change
+    """
+    from occams import models
+
+    schema = models.Schema(name='Foo', title='')
+    dbsession.add(schema)
+    dbsession.flush()
+
+    assert models.get_snapshot(schema) is schema
+
+
+def test_published(dbsession):
+    """
+    It should snapshot published schemata once with their attributes
+    """
+    from datetime import date
+    from occams import models
+
+    schema = models.Schema(
+        name='Foo', title='Foo', publish_date=date(2000, 1, 1))
+    s1 = models.Attribute(
+        schema=schema, name='s1', title='Section 1', type='section', order=0)
+    models.Attribute(
+        schema=schema, parent_attribute=s1,
+        name='b', title='', type='choice', order=2,
+        choices={
+            '002': models.Choice(name='002', title='Bar', order=1),
+            '001': models.Choice(name='001', title='Foo', order=0)})
+    models.Attribute(
+        schema=schema, parent_attribute=s1,
+        name='a', title='', type='string', order=1)
+    dbsession.add(schema)
+    dbsession.flush()
+
+    snapshot = models.get_snapshot(schema)
+
+    assert snapshot is models.get_snapshot(schema)
+    assert snapshot.title == 'Foo'
+    assert [a.name for a in snapshot.itertraverse()] == ['s1']
+    assert [a.name for a in snapshot.iterleafs()] == ['a', 'b']
+    assert snapshot.attributes['b'].parent_attribute.name == 's1'
+    assert [c.name for c in snapshot.attributes['b'].iterchoices()] == \
+        ['001', '002']
+
+    with pytest.raises(AttributeError):
+        snapshot.title = 'Changed'
+
+    # Changes made in the process discard the snapshot
+    schema.attributes['a'].title = 'Changed'
+    assert models.get_snapshot(schema) is not snapshot
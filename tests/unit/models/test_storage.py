@@ -486,3 +486,222 @@ def test_choice_constraint(dbsession):
 
     with pytest.raises(ConstraintError):
         entity['test'] = '999'
+
+
+def test_collection_constraint(dbsession):
+    """
+    It should validate against collection length constraints
+    """
+    from datetime import date
+    from occams import models
+    from occams.exc import ConstraintError
+
+    schema = models.Schema(name='Foo', title='',
+                           publish_date=date(2000, 1, 1))
+    models.Attribute(
+        schema=schema,
+        name='test', title='', type='choice', is_collection=True, order=0,
+        collection_min=1, collection_max=2,
+        choices={
+            '001': models.Choice(name='001', title='Foo', order=0),
+            '002': models.Choice(name='002', title='Bar', order=1),
+            '003': models.Choice(name='003', title='Baz', order=2)})
+    dbsession.add(schema)
+    dbsession.flush()
+
+    entity = models.Entity(schema=schema)
+    dbsession.add(entity)
+    dbsession.flush()
+
+    entity['test'] = ['001', '002']
+
+    with pytest.raises(ConstraintError):
+        entity['test'] = []
+
+    with pytest.raises(ConstraintError):
+        entity['test'] = ['001', '002', '003']
+
+
+def test_validator_cached(dbsession):
+    """
+    It should compile validators once per published schema version
+    """
+    from datetime import date
+    from occams import models
+    from occams.exc import ConstraintError
+    from occams.models.validators import get_validator
+
+    schema = models.Schema(name='Foo', title='',
+                           publish_date=date(2000, 1, 1))
+    models.Attribute(
+        schema=schema, name='test', title='', type='string', order=0)
+    dbsession.add(schema)
+    dbsession.flush()
+
+    assert get_validator(schema) is get_validator(schema)
+
+    entity = models.Entity(schema=schema)
+    entity.update({'test': 'foo'})
+    assert entity['test'] == 'foo'
+
+    with pytest.raises(KeyError):
+        entity.update({'test': 'foo', 'missing': 'bar'})
+
+    # Changes to the schema are picked up
+    schema.attributes['test'].pattern = r'\d+'
+
+    with pytest.raises(ConstraintError):
+        entity['test'] = 'foo'
+
+
+def test_draft_validator_cached(dbsession):
+    """
+    It should reuse validators of drafts until the schema changes
+    """
+    from occams import models
+    from occams.exc import ConstraintError
+    from occams.models.validators import get_validator
+
+    schema = models.Schema(name='Foo', title='')
+    models.Attribute(
+        schema=schema, name='test', title='', type='string', order=0)
+    dbsession.add(schema)
+    dbsession.flush()
+
+    validator = get_validator(schema)
+    assert get_validator(schema) is validator
+
+    entity = models.Entity(schema=schema)
+    entity['test'] = 'foo'
+
+    schema.attributes['test'].pattern = r'\d+'
+    assert get_validator(schema) is not validator
+
+    with pytest.raises(ConstraintError):
+        entity['test'] = 'foo'
+
+    models.Attribute(
+        schema=schema, name='other', title='', type='string', order=1)
+    entity['other'] = 'bar'
+    assert entity['other'] == 'bar'
+
+
+def test_entity_patch(dbsession):
+    """
+    It should only write the changed values of a stored entity
+    """
+    from datetime import date
+    import sqlalchemy as sa
+    from occams import models
+
+    schema = models.Schema(name='Foo', title='',
+                           publish_date=date(2000, 1, 1))
+    models.Attribute(
+        schema=schema, name='foo', title='', type='string', order=0)
+    models.Attribute(
+        schema=schema, name='bar', title='', type='string', order=1)
+    dbsession.add(schema)
+    dbsession.flush()
+
+    entity = models.Entity(schema=schema)
+    assert entity.patch({'foo': 'a', 'bar': 'b'}) == {'foo': 'a', 'bar': 'b'}
+    dbsession.add(entity)
+    dbsession.flush()
+
+    statements = []
+
+    @sa.event.listens_for(dbsession.bind, 'before_cursor_execute')
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    try:
+        assert entity.patch({'foo': 'a', 'bar': 'b'}) == {}
+        dbsession.flush()
+        assert not statements
+
+        entity.not_done = True
+        assert entity.patch({'foo': 'a', 'bar': 'c'}) == {'bar': 'c'}
+        assert entity.data == {'foo': 'a', 'bar': 'c'}
+        # Other changes of the entity are written in the same UPDATE
+        assert len(statements) == 1
+        assert 'not_done' in statements[0]
+        assert entity not in dbsession.dirty
+    finally:
+        sa.event.remove(dbsession.bind, 'before_cursor_execute', record)
+
+    dbsession.flush()
+    dbsession.expire(entity, ['data', 'not_done'])
+    assert entity.data == {'foo': 'a', 'bar': 'c'}
+    assert entity.not_done
+
+
+def test_entity_patch_committed(dbsession):
+    """
+    It should commit a patch that is the only change of a transaction
+    """
+    from datetime import date
+    import transaction
+    from zope.sqlalchemy import mark_changed
+    from occams import models
+    from occams.models import set_pg_locals
+
+    schema = models.Schema(name='Foo', title='',
+                           publish_date=date(2000, 1, 1))
+    models.Attribute(
+        schema=schema, name='foo', title='', type='string', order=0)
+    entity = models.Entity(schema=schema, data={'foo': 'a'})
+    dbsession.add(entity)
+    dbsession.flush()
+    entity_id = entity.id
+    transaction.commit()
+
+    try:
+        set_pg_locals(dbsession, 'pytest', 'test_user')
+        entity = dbsession.query(models.Entity).get(entity_id)
+        assert entity.patch({'foo': 'b'}) == {'foo': 'b'}
+        transaction.commit()
+
+        entity = dbsession.query(models.Entity).get(entity_id)
+        assert entity.data == {'foo': 'b'}
+    finally:
+        transaction.abort()
+        with transaction.manager:
+            dbsession.execute('DELETE FROM "entity"')
+            dbsession.execute('DELETE FROM "schema"')
+            dbsession.execute('DELETE FROM "state"')
+            dbsession.execute('DELETE FROM "account"')
+            mark_changed(dbsession)
+
+
+@pytest.mark.parametrize('mutate', [
+    lambda e: e.__setitem__('foo', 'x'),
+    lambda e: e.update({'foo': 'x'}),
+    lambda e: e.setdefault('baz', 'x'),
+    lambda e: e.pop('foo'),
+    lambda e: e.clear(),
+])
+def test_entity_patch_mutated(dbsession, mutate):
+    """
+    It should write the whole document if it was changed in place
+    """
+    from datetime import date
+    from occams import models
+
+    schema = models.Schema(name='Foo', title='',
+                           publish_date=date(2000, 1, 1))
+    models.Attribute(
+        schema=schema, name='foo', title='', type='string', order=0)
+    models.Attribute(
+        schema=schema, name='bar', title='', type='string', order=1)
+    entity = models.Entity(schema=schema, data={'foo': 'a', 'bar': 'b'})
+    dbsession.add(entity)
+    dbsession.flush()
+
+    mutate(entity)
+    expected = dict(entity.data, bar='c')
+
+    assert entity.patch({'bar': 'c'}) == {'bar': 'c'}
+    dbsession.flush()
+
+    dbsession.expire(entity, ['data'])
+    assert entity.data == expected
@@ -119,6 +119,36 @@ class TestPrintList:
             assert plan.file_name in files
             assert FILE_NAME in files
 
+    def test_make_export_summary(self, plan):
+        """
+        It should print the timing and row count of each data file
+        """
+        import mock
+        # force list_all to return only the test form
+        with mock.patch('occams.exports.list_all',
+                        return_value={plan.name: plan}):
+            output = self._call_fut(
+                [None, '--config', 'fake.ini', '--dir', self.dir, '--all'])
+        assert plan.name in output
+        assert '(total)' in output
+
+    def test_make_export_sqlite(self, plan):
+        """
+        It should be able to export data files into a SQLite database
+        """
+        import os
+        import mock
+        from occams.exports import sqlite
+        # force list_all to return only the test form
+        with mock.patch('occams.exports.list_all',
+                        return_value={plan.name: plan}):
+            self._call_fut(
+                [None, '--config', 'fake.ini', '--dir', self.dir, '--all',
+                 '--format', 'sqlite'])
+        files = os.listdir(self.dir)
+        assert sqlite.FILE_NAME in files
+        assert plan.file_name not in files
+
     def test_make_export_private(self, plan):
         """
         It should be able to export only private data
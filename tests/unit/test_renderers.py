@@ -254,6 +254,36 @@ class TestMakeForm:
         assert not form.validate()
         assert 'dummy_field' in form.errors
 
+    def test_fields_reused(self, dbsession):
+        from occams.renderers import make_form, modes
+
+        schema = self._make_schema(dbsession)
+        Form1 = make_form(dbsession, schema, transition=modes.ALL)
+        Form2 = make_form(dbsession, schema, show_metadata=False)
+
+        assert Form1 is not Form2
+        assert Form1.__bases__ == Form2.__bases__
+        assert hasattr(Form1, 'ofworkflow_')
+        assert not hasattr(Form2, 'ofworkflow_')
+
+        form = Form1()
+        names = [field.name for field in form]
+        assert names[:2] == ['ofmetadata_', 'ofworkflow_']
+        assert 'dummy_field' in names
+
+    def test_validators_not_shared(self, dbsession):
+        from occams.renderers import make_form
+
+        schema = self._make_schema(dbsession)
+        Form = make_form(dbsession, schema, show_metadata=False)
+
+        form = Form()
+        count = len(form.dummy_field.validators)
+        form.dummy_field.validators.append(lambda form, field: None)
+
+        Form = make_form(dbsession, schema, show_metadata=False)
+        assert len(Form().dummy_field.validators) == count
+
 
 class TestRenderForm:
 
@@ -329,6 +359,78 @@ class TestRenderForm:
 
         assert field.has_attr('disabled')
 
+    def test_cached_if_complete(self, dbsession):
+        import mock
+        from occams import models
+        from occams.renderers import render_form, states
+
+        Form = self._make_form(dbsession)
+        form = Form()
+
+        form.meta.entity.state = (
+            dbsession.query(models.State)
+            .filter_by(name=states.COMPLETE)
+            .one())
+
+        redis = mock.Mock()
+        redis.get.return_value = None
+        markup = render_form(form, redis=redis)
+
+        key, fields = redis.set.call_args[0]
+        assert fields in markup
+
+        redis.get.return_value = '<p id="cached"></p>'
+        markup = render_form(form, redis=redis)
+
+        assert redis.get.call_args[0][0] == key
+        assert '<p id="cached"></p>' in markup
+
+    def test_cached_by_locale(self, dbsession):
+        import mock
+        from occams import models
+        from occams.renderers import render_form, states
+
+        Form = self._make_form(dbsession)
+        form = Form()
+
+        form.meta.entity.state = (
+            dbsession.query(models.State)
+            .filter_by(name=states.COMPLETE)
+            .one())
+
+        redis = mock.Mock()
+        redis.get.return_value = None
+        keys = []
+
+        for locale_name in ('en', 'fr', 'en'):
+            request = mock.Mock(locale_name=locale_name)
+            with mock.patch('occams.renderers.get_current_request',
+                            return_value=request):
+                render_form(form, redis=redis)
+            keys.append(redis.set.call_args[0][0])
+
+        assert keys[0] != keys[1]
+        assert keys[0] == keys[2]
+
+    def test_not_cached_if_editable(self, dbsession):
+        import mock
+        from occams import models
+        from occams.renderers import render_form, states
+
+        Form = self._make_form(dbsession)
+        form = Form()
+
+        form.meta.entity.state = (
+            dbsession.query(models.State)
+            .filter_by(name=states.PENDING_ENTRY)
+            .one())
+
+        redis = mock.Mock()
+        render_form(form, redis=redis)
+
+        assert not redis.get.called
+        assert not redis.set.called
+
 
 class TestApplyData:
 
@@ -782,3 +782,134 @@ def test_build_report_ignore_private(dbsession):
     report = reporting.build_report(dbsession, 'A', ignore_private=True)
     result = dbsession.query(report).one()
     assert '[PRIVATE]' == result.name
+
+
+def test_build_report_cached(dbsession):
+    """
+    It should reuse the compiled plan until a version is published/retracted
+    """
+
+    from copy import deepcopy
+    from datetime import date, timedelta
+    from occams import models, reporting
+
+    today = date.today()
+
+    schema1 = models.Schema(
+        name='A',
+        title='A',
+        publish_date=today,
+        attributes={
+            's1': models.Attribute(
+                name='s1',
+                title='S1',
+                type='section',
+                order=0,
+                attributes={
+                    'a': models.Attribute(
+                        name='a',
+                        title='',
+                        type='string',
+                        order=1)})})
+    dbsession.add(schema1)
+    dbsession.flush()
+
+    report = reporting.build_report(dbsession, 'A')
+    assert report is reporting.build_report(dbsession, 'A')
+    assert report is not reporting.build_report(
+        dbsession, 'A', use_choice_labels=True)
+
+    schema2 = deepcopy(schema1)
+    schema2.attributes['s1'].attributes['b'] = models.Attribute(
+        name='b',
+        title='',
+        type='string',
+        order=2)
+    dbsession.add(schema2)
+    dbsession.flush()
+
+    # not published yet
+    assert 'b' not in reporting.build_report(dbsession, 'A').c
+
+    schema2.publish_date = today + timedelta(1)
+    dbsession.flush()
+    assert 'b' in reporting.build_report(dbsession, 'A').c
+
+    schema2.retract_date = today + timedelta(2)
+    dbsession.flush()
+    assert 'b' not in reporting.build_report(dbsession, 'A').c
+
+
+def test_build_report_choice_labels_per_version(dbsession):
+    """
+    It should decode choice labels using each entity's own form version
+    """
+
+    from copy import deepcopy
+    from datetime import date, timedelta
+    from occams import models, reporting
+
+    today = date.today()
+
+    schema1 = models.Schema(
+        name='A',
+        title='A',
+        publish_date=today,
+        attributes={
+            's1': models.Attribute(
+                name='s1',
+                title='S1',
+                type='section',
+                order=0,
+                attributes={
+                    'a': models.Attribute(
+                        name='a',
+                        title='',
+                        type='choice',
+                        is_collection=True,
+                        order=1,
+                        choices={
+                            '001': models.Choice(
+                                name='001',
+                                title='Green',
+                                order=0),
+                            '002': models.Choice(
+                                name='002',
+                                title='Red',
+                                order=1)
+                            })})})
+    dbsession.add(schema1)
+    dbsession.flush()
+
+    schema2 = deepcopy(schema1)
+    schema2.publish_date = today + timedelta(1)
+    schema2.attributes['s1'].attributes['a'].choices['002'].title = 'Crimson'
+    dbsession.add(schema2)
+    dbsession.flush()
+
+    entity1 = models.Entity(schema=schema1)
+    entity1['a'] = ['002']
+    entity2 = models.Entity(schema=schema2)
+    # Labels follow the order of the selection, not of the choices
+    entity2['a'] = ['002', '001']
+    dbsession.add_all([entity1, entity2])
+    dbsession.flush()
+
+    report = reporting.build_report(dbsession, 'A', use_choice_labels=True)
+    result1, result2 = dbsession.query(report).order_by(report.c.id)
+    assert result1.a == 'Red'
+    assert result2.a == 'Crimson;Green'
+
+    report = reporting.build_report(dbsession, 'A', use_choice_labels=False)
+    result1, result2 = dbsession.query(report).order_by(report.c.id)
+    assert result1.a == '002'
+    assert result2.a == '002;001'
+
+    report = reporting.build_report(dbsession, 'A',
+                                    expand_collections=True,
+                                    use_choice_labels=True)
+    result1, result2 = dbsession.query(report).order_by(report.c.id)
+    assert result1.a_001 is None
+    assert result1.a_002 == 'Red'
+    assert result2.a_001 == 'Green'
+    assert result2.a_002 == 'Crimson'
@@ -0,0 +1,673 @@
+import pytest
+
+
+@pytest.fixture
+def export_dir(dbsession, tmpdir):
+    """
+    Stores export files in a temporary directory
+    """
+    dbsession.info['settings']['studies.export.dir'] = str(tmpdir)
+    return str(tmpdir)
+
+
+@pytest.fixture
+def task(dbsession, export_dir):
+    """
+    Mocks a task bound to the testing database session
+    """
+    import mock
+
+    task = mock.Mock(dbsession=dbsession, redis=mock.Mock())
+    task.app.conf.settings = {
+        'studies.export.dir': export_dir,
+        'studies.export.parallel': True,
+        'studies.export.member_queue': 'export_members',
+        'studies.export.snapshot_timeout': 1,
+    }
+    return task
+
+
+class TestFanOutExport:
+
+    def _make_export(self, factories):
+        return factories.ExportFactory(contents=[
+            {'name': 'pid', 'title': 'PID', 'versions': []},
+            {'name': 'visit', 'title': 'Visit', 'versions': []},
+        ])
+
+    def _make_exportables(self):
+        import mock
+        return {
+            'pid': mock.Mock(file_name='pid.csv'),
+            'visit': mock.Mock(file_name='visit.csv'),
+        }
+
+    def test_chord(self, dbsession, factories, task):
+        """
+        It should dispatch a subtask per data file and assemble them after
+        """
+        import os
+        import mock
+        from occams import tasks
+
+        export = self._make_export(factories)
+        dbsession.flush()
+
+        task.redis.blpop.return_value = ('key', 'value')
+
+        with mock.patch('occams.tasks.chord') as chord:
+            tasks._fan_out_export(
+                task, export, self._make_exportables())
+
+        (header,), kw = chord.call_args
+        members = list(header)
+        assert [m.task for m in members] == ['make_export_member'] * 2
+        assert [m.args[:2] for m in members] == [
+            (export.name, 'pid'), (export.name, 'visit')]
+        # All subtasks share the snapshot of the export's transaction
+        assert len(set(m.args[2] for m in members)) == 1
+        assert [m.kwargs for m in members] == [
+            {'file_name': 'pid.csv'}, {'file_name': 'visit.csv'}]
+
+        (callback,), kw = chord.return_value.call_args
+        assert callback.task == 'assemble_export'
+        assert callback.kwargs == {'name': export.name}
+        assert [s.task for s in callback.options['link']] == \
+            ['schedule_exports']
+        assert [s.task for s in callback.options['link_error']] == \
+            ['schedule_exports']
+
+        assert task.redis.blpop.call_count == 2
+        assert os.path.isdir(tasks._parts_dir(export))
+
+    def test_snapshot_timeout(self, dbsession, factories, task):
+        """
+        It should fail if the subtasks don't import the snapshot in time
+        """
+        import mock
+        from occams import tasks
+
+        export = self._make_export(factories)
+        dbsession.flush()
+
+        task.redis.blpop.return_value = None
+
+        with mock.patch('occams.tasks.chord'):
+            with pytest.raises(Exception):
+                tasks._fan_out_export(
+                    task, export, self._make_exportables())
+
+    def test_member_queue(self, export_dir):
+        """
+        It should route subtasks to their own queue
+        """
+        from occams import tasks
+
+        tasks.configure({
+            'celery.blame': 'celery@localhost',
+            'celery.broker.url': 'memory://',
+            'celery.backend.url': 'cache+memory://',
+            'studies.export.dir': export_dir,
+        })
+
+        routes = tasks.app.conf.task_routes
+        assert routes['make_export_member'] == {'queue': tasks.MEMBER_QUEUE}
+
+
+class TestMakeExportMember:
+
+    def _call(self, task, *args, **kw):
+        from occams import tasks
+        # Undecorated, so the test transaction is not committed
+        return tasks.make_export_member.run.__func__.__wrapped__(
+            task, *args, **kw)
+
+    def test_redelivered_staged(self, task, export_dir):
+        """
+        It should skip a staged data file without importing the snapshot
+        """
+        import os
+        import mock
+        task.dbsession = mock.Mock()
+
+        os.makedirs(os.path.join(export_dir, 'foo.parts'))
+        with open(os.path.join(export_dir, 'foo.parts', 'pid.csv'), 'w'):
+            pass
+
+        result = self._call(
+            task, 'foo', 'pid', 'expired-snapshot', file_name='pid.csv')
+
+        assert result == 'pid.csv'
+        assert not task.dbsession.execute.called
+
+    def test_snapshot_gone(self, task):
+        """
+        It should fail if the snapshot is no longer available
+        """
+        import mock
+        import sqlalchemy as sa
+        task.dbsession = mock.Mock()
+        task.dbsession.execute.side_effect = [
+            None,
+            sa.exc.OperationalError(
+                'SET TRANSACTION SNAPSHOT', {},
+                Exception('invalid snapshot identifier')),
+        ]
+
+        with pytest.raises(Exception) as excinfo:
+            self._call(
+                task, 'foo', 'pid', 'expired-snapshot', file_name='pid.csv')
+
+        assert 'no longer available' in str(excinfo.value)
+
+
+class TestCheckWorkerQueues:
+
+    def _make_app(self, queues):
+        import mock
+        app = mock.Mock()
+        app.conf.task_default_queue = 'celery'
+        app.amqp.queues.consume_from = dict((q, None) for q in queues)
+        return app
+
+    def _settings(self, parallel):
+        return {
+            'studies.export.parallel': parallel,
+            'studies.export.member_queue': 'export_members',
+        }
+
+    def test_shared_queues(self):
+        """
+        It should not allow workers to run exports and their subtasks
+        """
+        from occams import tasks
+
+        app = self._make_app(['celery', 'export_members'])
+
+        with pytest.raises(Exception):
+            tasks._check_worker_queues(app, self._settings(True))
+
+    @pytest.mark.parametrize('queues', [['celery'], ['export_members']])
+    def test_dedicated_queues(self, queues):
+        """
+        It should allow workers dedicated to either queue
+        """
+        from occams import tasks
+
+        app = self._make_app(queues)
+        tasks._check_worker_queues(app, self._settings(True))
+
+    def test_not_parallel(self):
+        """
+        It should allow any queues if exports are not parallel
+        """
+        from occams import tasks
+
+        app = self._make_app(['celery', 'export_members'])
+        tasks._check_worker_queues(app, self._settings(False))
+
+
+class TestExportProgress:
+
+    @pytest.fixture
+    def progress_task(self, task):
+        task.app.conf.settings.update({
+            'studies.export.progress_interval': 60,
+            'studies.export.progress_rows': 10,
+        })
+        task.redis.exists.return_value = False
+        script = task.redis.register_script.return_value
+        script.return_value = ['count', '1', 'total', '2']
+        return task
+
+    def _call(self, task, export, estimate=0):
+        from occams import tasks
+        return tasks._ExportProgress(task, export, estimate)
+
+    def test_throttled(self, factories, progress_task):
+        """
+        It should only publish rows once enough have accumulated
+        """
+        export = factories.ExportFactory()
+        script = progress_task.redis.register_script.return_value
+
+        progress = self._call(progress_task, export)
+        progress.add_rows(4)
+        progress.add_rows(5)
+
+        assert not script.called
+        assert not progress_task.redis.exists.called
+
+        progress.add_rows(3)
+
+        script.assert_called_once_with(
+            keys=[export.redis_key], args=[12, 0, 'export'])
+        assert progress_task.redis.exists.called
+
+        progress.add_rows(1)
+        assert script.call_count == 1
+
+    def test_interval(self, factories, progress_task):
+        """
+        It should publish rows once the interval elapsed
+        """
+        import mock
+        export = factories.ExportFactory()
+        script = progress_task.redis.register_script.return_value
+
+        with mock.patch('occams.tasks.time.monotonic', return_value=0):
+            progress = self._call(progress_task, export)
+
+        with mock.patch('occams.tasks.time.monotonic', return_value=61):
+            progress.add_rows(1)
+
+        script.assert_called_once_with(
+            keys=[export.redis_key], args=[1, 0, 'export'])
+
+    def test_cancelled(self, factories, progress_task):
+        """
+        It should stop at the next publish if the export was cancelled
+        """
+        from occams import tasks
+        export = factories.ExportFactory()
+        progress_task.redis.exists.return_value = True
+
+        progress = self._call(progress_task, export)
+        # Cancellation is only checked when rows are published
+        progress.add_rows(1)
+
+        with pytest.raises(tasks.ExportCancelled):
+            progress.add_rows(10)
+
+        progress_task.redis.exists.assert_called_with(
+            export.redis_key + ':cancel')
+
+    def test_complete(self, factories, progress_task):
+        """
+        It should publish the rest of the estimate with the completed file
+        """
+        export = factories.ExportFactory()
+        script = progress_task.redis.register_script.return_value
+
+        progress = self._call(progress_task, export, estimate=100)
+        progress.add_rows(5)
+        progress.complete('pid')
+
+        script.assert_called_once_with(
+            keys=[export.redis_key], args=[100, 1, 'export'])
+
+    def test_script(self, request, factories, task):
+        """
+        It should increment the counters and publish them in one call
+        """
+        import json
+        from redis import Redis
+
+        redis_url = request.config.getoption('--redis')
+        if not redis_url:
+            pytest.skip('Requires --redis')
+
+        redis = Redis.from_url(redis_url, decode_responses=True)
+        task.redis = redis
+        export = factories.ExportFactory()
+        redis.delete(export.redis_key)
+        redis.hmset(export.redis_key, {
+            'export_id': 1, 'count': 0, 'total': 2, 'rows': 5})
+
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe('export')
+        try:
+            progress = self._call(task, export)
+            progress.pending = 7
+            fields = progress._publish(files=1)
+
+            message = None
+            for i in range(10):
+                message = pubsub.get_message(timeout=1)
+                if message:
+                    break
+        finally:
+            pubsub.close()
+            redis.delete(export.redis_key)
+
+        expected = {'export_id': '1', 'count': '1', 'total': '2', 'rows': '12'}
+        assert dict(zip(fields[::2], fields[1::2])) == expected
+        assert json.loads(message['data']) == expected
+
+
+class TestClaimExports:
+
+    def _call(self, task):
+        from occams import tasks
+        # Undecorated, so the test transaction is not committed
+        return tasks._claim_exports.__wrapped__(task)
+
+    def test_stale_claim(self, dbsession, factories, task):
+        """
+        It should queue exports again once their claim timed out
+        """
+        from datetime import datetime, timedelta
+        task.app.conf.settings['studies.export.claim_timeout'] = 60
+
+        export = factories.ExportFactory(
+            contents=[], start_date=datetime.now() - timedelta(hours=1))
+        dbsession.flush()
+
+        assert self._call(task) == [export.name]
+        assert export.start_date is not None
+
+    def test_running_claim(self, dbsession, factories, task):
+        """
+        It should not start more exports while a claim is running
+        """
+        from datetime import datetime
+        task.app.conf.settings.update({
+            'studies.export.claim_timeout': 3600,
+            'studies.export.max_running': 1,
+        })
+
+        factories.ExportFactory(contents=[], start_date=datetime.now())
+        factories.ExportFactory(contents=[])
+        dbsession.flush()
+
+        assert self._call(task) == []
+
+    @pytest.mark.parametrize('started, claimed', [
+        (1, False),
+        (-1, True),
+    ])
+    def test_identical_running(
+            self, dbsession, factories, task, started, claimed):
+        """
+        It should only leave identical exports to a running export that
+        started after they were requested
+        """
+        from datetime import datetime, timedelta
+        task.app.conf.settings['studies.export.claim_timeout'] = 3600
+
+        factories.ExportFactory(
+            contents=[], fingerprint='abc',
+            start_date=datetime.now() + timedelta(minutes=started))
+        follower = factories.ExportFactory(contents=[], fingerprint='abc')
+        dbsession.flush()
+
+        assert self._call(task) == ([follower.name] if claimed else [])
+
+    def test_overdue(self, dbsession, factories, task):
+        """
+        It should start exports that waited too long before smaller ones
+        """
+        from datetime import datetime, timedelta
+        task.app.conf.settings.update({
+            'studies.export.max_running': 1,
+            'studies.export.max_wait': 3600,
+        })
+
+        large = factories.ExportFactory(contents=[{}, {}, {}])
+        small = factories.ExportFactory(contents=[{}])
+        dbsession.flush()
+
+        assert self._call(task) == [small.name]
+        small.start_date = None
+
+        # Temporarily override timestamp triggers so we can set a custom date
+        dbsession.execute('SET session_replication_role = replica')
+        large.create_date = datetime.now() - timedelta(hours=2)
+        dbsession.flush()
+        dbsession.execute('SET session_replication_role = DEFAULT')
+
+        assert self._call(task) == [large.name]
+
+    def test_release_on_failure(self, dbsession, factories, task):
+        """
+        It should release the claim if the task cannot be sent
+        """
+        import mock
+        from occams import tasks
+
+        with mock.patch('occams.tasks._claim_exports', return_value=['x']), \
+                mock.patch('occams.tasks._release_export') as release, \
+                mock.patch('occams.tasks.make_export') as make_export:
+            make_export.apply_async.side_effect = Exception('Broker is down')
+            with pytest.raises(Exception):
+                tasks.schedule_exports.run()
+
+        assert release.call_args[0][1] == 'x'
+
+
+class TestCompleteExport:
+
+    @pytest.mark.parametrize('started, coalesced', [
+        (1, True),
+        (-1, False),
+    ])
+    def test_followers(self, dbsession, factories, task, started, coalesced):
+        """
+        It should only complete identical exports requested before it started
+        """
+        import os
+        from datetime import datetime, timedelta
+        from occams import tasks
+
+        export = factories.ExportFactory(
+            contents=[], fingerprint='abc',
+            start_date=datetime.now() + timedelta(minutes=started))
+        follower = factories.ExportFactory(contents=[], fingerprint='abc')
+        dbsession.flush()
+
+        with open(export.path, 'w') as fp:
+            fp.write('data')
+
+        tasks._complete_export(task.redis, export)
+
+        assert export.status == 'complete'
+        assert follower.status == ('complete' if coalesced else 'pending')
+        assert os.path.exists(follower.path) == coalesced
+
+
+class TestResumeArchive:
+
+    def _write_member(self, export, name):
+        from zipfile import ZipFile
+        with ZipFile(export.path, mode='a') as zfp:
+            zfp.writestr(name, 'id\n1\n')
+
+    def test_checkpoint(self, dbsession, factories, task):
+        """
+        It should discard data written after the last checkpoint
+        """
+        import os
+        from zipfile import ZipFile
+        from occams import tasks
+
+        export = factories.ExportFactory()
+        dbsession.flush()
+
+        checkpoint = {}
+        task.redis.hmset.side_effect = lambda key, value: \
+            checkpoint.update((k, str(v)) for k, v in value.items())
+        task.redis.hgetall.return_value = checkpoint
+
+        self._write_member(export, 'pid.csv')
+        tasks._checkpoint_archive(task.redis, export, ['pid.csv'])
+        size = os.path.getsize(export.path)
+
+        # Partial data file of a crashed worker
+        self._write_member(export, 'visit.csv')
+        with open(export.path, 'ab') as fp:
+            fp.write(b'garbage')
+
+        assert tasks._resume_archive(task.redis, export) == ['pid.csv']
+        assert os.path.getsize(export.path) == size
+
+        self._write_member(export, 'visit.csv')
+        with ZipFile(export.path) as zfp:
+            assert zfp.namelist() == ['pid.csv', 'visit.csv']
+            assert zfp.testzip() is None
+
+    def test_no_checkpoint(self, dbsession, factories, task):
+        """
+        It should start over if there is no checkpoint
+        """
+        import os
+        from occams import tasks
+
+        export = factories.ExportFactory()
+        dbsession.flush()
+
+        self._write_member(export, 'pid.csv')
+        task.redis.hgetall.return_value = {}
+
+        assert tasks._resume_archive(task.redis, export) == []
+        assert not os.path.exists(export.path)
+
+
+class TestReapExports:
+
+    def _call(self, task):
+        from occams import tasks
+        return tasks.reap_exports.run.__func__(task)
+
+    def _touch(self, path, age=86400):
+        import os
+        import time
+        with open(path, 'w') as fp:
+            fp.write('data')
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    @pytest.fixture(autouse=True)
+    def patch_transactions(self):
+        import mock
+        with mock.patch('occams.tasks._delete_expired_exports',
+                        return_value=[]) as delete_expired, \
+                mock.patch('occams.tasks._query_export_names',
+                           return_value=set()), \
+                mock.patch('occams.tasks._current_codebook_fingerprint',
+                           return_value='abc123'):
+            yield delete_expired
+
+    def test_current_codebook(self, task, export_dir):
+        """
+        It should keep the codebook of the current catalog
+        """
+        import os
+        current = os.path.join(export_dir, 'codebook-abc123.csv')
+        newer = os.path.join(export_dir, 'codebook-def456.csv')
+        self._touch(current, age=7200)
+        self._touch(newer, age=3700)
+
+        self._call(task)
+
+        assert os.path.exists(current)
+        assert not os.path.exists(newer)
+
+    def test_abandoned(self, task, export_dir):
+        """
+        It should remove abandoned files after the grace period
+        """
+        import os
+        import uuid
+        abandoned = os.path.join(export_dir, str(uuid.uuid4()))
+        recent = os.path.join(export_dir, str(uuid.uuid4()))
+        tmp = os.path.join(export_dir, 'foo.tmp')
+        self._touch(abandoned)
+        self._touch(recent, age=0)
+        self._touch(tmp)
+
+        assert self._call(task) == 8
+
+        assert not os.path.exists(abandoned)
+        assert os.path.exists(recent)
+        assert not os.path.exists(tmp)
+
+    def test_expired(self, task, export_dir, patch_transactions):
+        """
+        It should remove the files of expired exports in batches
+        """
+        import os
+        import uuid
+        task.app.conf.settings.update({
+            'studies.export.expire': 1,
+            'studies.export.reap_batch': 1,
+            'studies.export.reap_grace': 86400 * 7,
+        })
+        name = str(uuid.uuid4())
+        self._touch(os.path.join(export_dir, name), age=0)
+        os.mkdir(os.path.join(export_dir, name + '.parts'))
+        self._touch(os.path.join(export_dir, name + '.parts', 'pid.csv'))
+        patch_transactions.side_effect = [[name], []]
+
+        assert self._call(task) == 8
+
+        assert os.listdir(export_dir) == []
+        assert patch_transactions.call_count == 2
+        task.redis.delete.assert_called_once_with(
+            'export:' + name, 'export:' + name + ':checkpoint')
+
+
+class TestDeleteExpiredExports:
+
+    def _call(self, *args):
+        from occams import tasks
+        # Undecorated, so the test transaction is not committed
+        return tasks._delete_expired_exports.__wrapped__(*args)
+
+    def test_batch(self, dbsession, factories, task):
+        """
+        It should delete a batch of exports not modified since the cutoff
+        """
+        from datetime import datetime, timedelta
+        from occams import models
+
+        expired = factories.ExportFactory.create_batch(3)
+        current = factories.ExportFactory()
+        dbsession.flush()
+
+        # Temporarily override timestamp triggers so we can set a custom date
+        dbsession.execute('SET session_replication_role = replica')
+        for export in expired:
+            export.modify_date = datetime.now() - timedelta(2)
+        dbsession.flush()
+        dbsession.execute('SET session_replication_role = DEFAULT')
+
+        names = self._call(task, 1, 2)
+        assert names == [e.name for e in expired[:2]]
+        names = self._call(task, 1, 2)
+        assert names == [expired[2].name]
+        assert self._call(task, 1, 2) == []
+
+        dbsession.expire_all()
+        query = dbsession.query(models.Export.name)
+        assert set(name for name, in query) == {current.name}
+
+
+class TestRemovePath:
+
+    def test_file(self, tmpdir):
+        """
+        It should remove a file and return its size
+        """
+        from occams import tasks
+        path = tmpdir.join('file')
+        path.write('data')
+        assert tasks._remove_path(str(path)) == 4
+        assert not path.exists()
+
+    def test_directory(self, tmpdir):
+        """
+        It should remove a directory and return the size of its files
+        """
+        from occams import tasks
+        path = tmpdir.mkdir('dir')
+        path.join('a').write('data')
+        path.mkdir('sub').join('b').write('more data')
+        assert tasks._remove_path(str(path)) == 13
+        assert not path.exists()
+
+    def test_missing(self, tmpdir):
+        """
+        It should ignore paths that do not exist
+        """
+        from occams import tasks
+        assert tasks._remove_path(str(tmpdir.join('missing'))) == 0
@@ -95,7 +95,7 @@ class TestAdd:
         req.POST = MultiDict([('contents', str('vitals'))])
 
         # Don't invoke subtasks
-        with mock.patch('occams.tasks.make_export'):
+        with mock.patch('occams.tasks.schedule_exports'):
             res = self._call_fut(models.ExportFactory(req), req)
 
         check_csrf_token.assert_called_with(req)
@@ -103,6 +103,52 @@ class TestAdd:
         assert res.location == req.route_path('studies.exports_status')
         export = dbsession.query(models.Export).one()
         assert export.owner_user.key == 'joe'
+        assert export.fingerprint is not None
+        assert export.start_date is None
+
+    def test_coalesce_pending(self, req, dbsession, config, check_csrf_token):
+        """
+        It should not add an export identical to one that is pending
+        """
+        from datetime import date
+        import mock
+        from pyramid.httpexceptions import HTTPFound
+        from webob.multidict import MultiDict
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        req.registry.settings['app.export.dir'] = '/tmp'
+        req.registry.settings['studies.export.plans'] = [SchemaPlan.list_all]
+
+        blame = models.User(key=u'joe')
+        dbsession.add(blame)
+        dbsession.flush()
+        dbsession.info['blame'] = blame
+
+        schema = models.Schema(
+            name=u'vitals', title=u'Vitals', publish_date=date.today())
+        dbsession.add(schema)
+        dbsession.flush()
+
+        config.testing_securitypolicy(userid='joe')
+        req.method = 'POST'
+        req.POST = MultiDict([('contents', str('vitals'))])
+
+        with mock.patch('occams.tasks.schedule_exports'):
+            self._call_fut(models.ExportFactory(req), req)
+            res = self._call_fut(models.ExportFactory(req), req)
+
+        assert isinstance(res, HTTPFound)
+        assert dbsession.query(models.Export).count() == 1
+
+        # Different options are a different export
+        req.POST = MultiDict([
+            ('contents', str('vitals')), ('use_choice_labels', 'y')])
+
+        with mock.patch('occams.tasks.schedule_exports'):
+            self._call_fut(models.ExportFactory(req), req)
+
+        assert dbsession.query(models.Export).count() == 2
 
     def test_exceed_limit(self, req, dbsession, config):
         """
@@ -394,7 +440,7 @@ class TestCodebookJSON:
         with pytest.raises(HTTPBadRequest):
             self._call_fut(models.ExportFactory(req), req)
 
-    def test_file(self, req, dbsession):
+    def test_file(self, req, dbsession, tmpdir):
         """
         It should return the json rows for the codebook fragment
         """
@@ -403,6 +449,8 @@ class TestCodebookJSON:
         from occams import models
         from occams.exports.schema import SchemaPlan
 
+        req.registry.settings['studies.export.dir'] = str(tmpdir)
+
         dbsession.add(models.Schema(
             name=u'aform',
             title=u'',
@@ -421,7 +469,32 @@ class TestCodebookJSON:
         req.GET = MultiDict([('file', 'aform')])
         req.registry.settings['studies.export.plans'] = [SchemaPlan.list_all]
         res = self._call_fut(models.ExportFactory(req), req)
-        assert res is not None
+        assert 'myfield' in [row['field'] for row in res]
+
+    def test_etag(self, req, dbsession, tmpdir):
+        """
+        It should let clients cache rows until the codebook changes
+        """
+        from datetime import date
+        from webob.multidict import MultiDict
+        from occams import models
+
+        req.registry.settings['studies.export.dir'] = str(tmpdir)
+        dbsession.add(models.Schema(
+            name=u'aform', title=u'', publish_date=date.today()))
+        dbsession.flush()
+
+        req.GET = MultiDict([('file', 'aform')])
+        self._call_fut(models.ExportFactory(req), req)
+        etag = req.response.etag
+        assert req.response.conditional_response
+
+        dbsession.add(models.Schema(
+            name=u'bform', title=u'', publish_date=date.today()))
+        dbsession.flush()
+
+        self._call_fut(models.ExportFactory(req), req)
+        assert req.response.etag != etag
 
 
 class TestCodebookDownload:
@@ -430,21 +503,17 @@ class TestCodebookDownload:
         from occams.views.export import codebook_download as view
         return view(*args, **kw)
 
-    def test_download(self, req, dbsession, config):
+    def test_download(self, req, dbsession, config, tmpdir):
         """
         It should allow downloading of entire codebook file
         """
-        import os
         from pyramid.response import FileResponse
-        from occams.exports.codebook import FILE_NAME
         from occams import models
-        req.registry.settings['studies.export.dir'] = '/tmp'
-        name = '/tmp/' + FILE_NAME
-        with open(name, 'w+b'):
-            config.testing_securitypolicy(userid='jane')
-            res = self._call_fut(models.ExportFactory(req), req)
-            assert isinstance(res, FileResponse)
-        os.remove(name)
+        req.registry.settings['studies.export.dir'] = str(tmpdir)
+        config.testing_securitypolicy(userid='jane')
+        res = self._call_fut(models.ExportFactory(req), req)
+        assert isinstance(res, FileResponse)
+        assert res.etag is not None
 
 
 class TestDelete:
@@ -480,12 +549,16 @@ class TestDelete:
         dbsession.expunge_all()
 
         config.testing_securitypolicy(userid='joe')
+        req.redis = mock.Mock()
         with mock.patch('occams.tasks.app.control.revoke') as revoke:
             res = self._call_fut(export, req)
         check_csrf_token.assert_called_with(req)
         assert isinstance(res, HTTPOk)
         assert dbsession.query(models.Export).get(export_id) is None
         revoke.assert_called_with(export_name)
+        # Running exports are flagged to stop
+        req.redis.set.assert_called_once_with(
+            'export:' + export_name + ':cancel', 1, ex=mock.ANY)
 
 
 class TestDownload:
@@ -520,3 +593,68 @@ class TestDownload:
 
         with pytest.raises(HTTPBadRequest):
             self._call_fut(export, req)
+
+    def test_range(self, req, dbsession, tmpdir):
+        """
+        It should serve partial content of the export
+        """
+        from webob import Request
+
+        req.registry.settings['studies.export.dir'] = str(tmpdir)
+        export = self._make_export(dbsession)
+        tmpdir.join(export.name).write_binary(b'0123456789')
+
+        res = self._call_fut(export, req)
+        client = Request.blank('/', headers={'Range': 'bytes=2-5'})
+        res = client.get_response(res)
+
+        assert res.status_code == 206
+        assert res.body == b'2345'
+        assert res.etag == '{}-10'.format(export.name)
+
+    def test_not_modified(self, req, dbsession, tmpdir):
+        """
+        It should not serve the export again if the client has it
+        """
+        from webob import Request
+
+        req.registry.settings['studies.export.dir'] = str(tmpdir)
+        export = self._make_export(dbsession)
+        tmpdir.join(export.name).write_binary(b'0123456789')
+
+        res = self._call_fut(export, req)
+        client = Request.blank(
+            '/', headers={'If-None-Match': '"{}-10"'.format(export.name)})
+        res = client.get_response(res)
+
+        assert res.status_code == 304
+
+    def test_x_accel_redirect(self, req, dbsession, tmpdir):
+        """
+        It should let the fronting web server stream the export
+        """
+        req.registry.settings['studies.export.dir'] = str(tmpdir)
+        req.registry.settings['studies.export.sendfile'] = 'x-accel-redirect'
+        req.registry.settings['studies.export.sendfile_prefix'] = '/private/'
+        export = self._make_export(dbsession)
+
+        res = self._call_fut(export, req)
+
+        assert res.headers['X-Accel-Redirect'] == '/private/' + export.name
+        assert not res.body
+
+    def _make_export(self, dbsession):
+        from occams import models
+
+        blame = models.User(key=u'joe')
+        dbsession.add(blame)
+        dbsession.flush()
+        dbsession.info['blame'] = blame
+
+        export = models.Export(
+            owner_user=blame,
+            contents=[],
+            status='complete')
+        dbsession.add(export)
+        dbsession.flush()
+        return export